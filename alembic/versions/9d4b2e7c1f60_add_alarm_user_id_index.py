@@ -0,0 +1,31 @@
+"""add alarm user id index
+
+Revision ID: 9d4b2e7c1f60
+Revises: 5c3e8f1a9b27
+Create Date: 2026-10-17 14:03:52.604118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4b2e7c1f60'
+down_revision: Union[str, None] = '5c3e8f1a9b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently so alarm writes keep going on large tables,
+    # which can't happen inside the migration transaction
+    # alarm_jobs.alarm_id is already indexed by its unique constraint
+    with op.get_context().autocommit_block():
+        op.create_index('ix_alarms_user_id_id', 'alarms', ['user_id', 'id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_alarms_user_id_id', table_name='alarms', postgresql_concurrently=True)
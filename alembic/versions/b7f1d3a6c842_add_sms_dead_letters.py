@@ -0,0 +1,39 @@
+"""add sms dead letters
+
+Revision ID: b7f1d3a6c842
+Revises: e2a7c4d9b513
+Create Date: 2026-10-17 18:42:31.574102
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7f1d3a6c842'
+down_revision: Union[str, None] = 'e2a7c4d9b513'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('sms_dead_letters',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('alarm_id', sa.Integer(), nullable=True),
+    sa.Column('event', sa.JSON(), nullable=False),
+    sa.Column('error_code', sa.String(length=255), nullable=False),
+    sa.Column('error_message', sa.Text(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('scheduled_time', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('replayed_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_sms_dead_letters_pending', 'sms_dead_letters', ['id'], unique=False, postgresql_where=sa.text('replayed_at IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_sms_dead_letters_pending', table_name='sms_dead_letters', postgresql_where=sa.text('replayed_at IS NULL'))
+    op.drop_table('sms_dead_letters')
@@ -0,0 +1,27 @@
+"""add user version
+
+Revision ID: c4e9a2f7d815
+Revises: b7f1d3a6c842
+Create Date: 2026-10-17 21:08:44.219637
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e9a2f7d815'
+down_revision: Union[str, None] = 'b7f1d3a6c842'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Bumped by the API on every change of the user or its alarms, existing users start at 1
+    op.add_column('users', sa.Column('version', sa.BigInteger(), server_default=sa.text('1'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'version')
@@ -0,0 +1,31 @@
+"""add alarm next_fire_at
+
+Revision ID: e2a7c4d9b513
+Revises: 9d4b2e7c1f60
+Create Date: 2026-10-17 15:21:07.913846
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a7c4d9b513'
+down_revision: Union[str, None] = '9d4b2e7c1f60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Filled in by the database scheduler backend on startup, from time, days_of_week and the timezone
+    op.add_column('alarms', sa.Column('next_fire_at', sa.TIMESTAMP(timezone=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_alarms_next_fire_at', 'alarms', ['next_fire_at'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_alarms_next_fire_at', table_name='alarms', postgresql_concurrently=True)
+    op.drop_column('alarms', 'next_fire_at')
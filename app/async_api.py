@@ -0,0 +1,223 @@
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import async_user_crud, async_alarm_crud, alarm_job_crud
+from app.schemas import user_schemas, alarm_schemas
+from app.config import settings
+from app.db.database import AsyncSessionLocal
+from app.utils.bulk_utils import accepts_ndjson, parse_bulk_alarms, merge_bulk_results
+from app.utils.responses import (
+    schema_response, user_adapter, alarm_adapter, alarm_bulk_results_adapter,
+    user_etag, etag_matches, etag_headers, not_modified_response
+)
+from app.utils.logger import logger
+
+# Async versions of the user and alarm endpoints, registered when DATABASE_ASYNC is enabled
+# They don't hold a threadpool slot while waiting on the database.
+router = APIRouter()
+
+# Dependency to get the asynchronous DB session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Get user by username
+# Answered with 304 Not Modified when If-None-Match has the ETag of the user's current version
+@router.get("/users/{username}", response_model=user_schemas.User)
+async def get_user_async(username: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Conditional requests check the version in the database, the cached user can be older
+    min_version = None
+    if request.headers.get('if-none-match'):
+        user_version = await async_user_crud.get_user_version_by_username(db, username)
+        if user_version is not None:
+            etag = user_etag('user', *user_version)
+            if etag_matches(request, etag):
+                return not_modified_response(etag)
+            min_version = user_version[1]
+
+    db_user = await async_user_crud.get_user_by_username(db, username, min_version)
+    if db_user is None:
+        logger.warning("User with username '%s' not found", username)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    etag = user_etag('user', db_user.id, db_user.version)
+    logger.info("User with username '%s' fetched successfully", username)
+    return schema_response(user_adapter, db_user, headers=etag_headers(etag))
+
+# Create user
+@router.post("/users/", response_model=user_schemas.User)
+async def create_user_async(user_create: user_schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_user_crud.get_user_by_username(db, user_create.username)
+    if db_user:
+        logger.warning("Username '%s' already registered", user_create.username)
+        raise HTTPException(status_code=400, detail="Username already registered")
+
+    db_user = await async_user_crud.get_user_by_phone_number(db, user_create.phone_number)
+    if db_user:
+        logger.warning("Phone number '%s' already registered", user_create.phone_number)
+        raise HTTPException(status_code=400, detail="Phone number already registered")
+
+    created_user = await async_user_crud.create_user(db, user_create)
+    logger.info("User '%s' created successfully", user_create.username)
+    return schema_response(user_adapter, created_user)
+
+# Update user by id
+@router.put("/users/{user_id}", response_model=user_schemas.User)
+async def update_user_async(user_id: int, user_update: user_schemas.UserUpdate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_user_crud.get_user_by_id(db, user_id)
+    if db_user is None:
+        logger.warning("User with ID '%s' not found", user_id)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if db_user.phone_number == user_update.phone_number and db_user.username == user_update.username:
+        return schema_response(user_adapter, db_user)
+
+    if user_update.username:
+        user_with_new_username = await async_user_crud.get_user_by_username(db, user_update.username)
+        if user_with_new_username:
+            logger.warning("Username '%s' already registered", user_update.username)
+            raise HTTPException(status_code=400, detail="Username already registered")
+
+    if user_update.phone_number:
+        user_with_new_phone = await async_user_crud.get_user_by_phone_number(db, user_update.phone_number)
+        if user_with_new_phone:
+            logger.warning("Phone number '%s' already registered", user_update.phone_number)
+            raise HTTPException(status_code=400, detail="Phone number already registered")
+
+    updated_user = await async_user_crud.update_user(db, db_user, user_update)
+    logger.info("User with ID '%s' updated successfully", user_id)
+    return schema_response(user_adapter, updated_user)
+
+# Delete user by id
+@router.delete("/users/{user_id}")
+async def delete_user_async(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_user_crud.get_user_by_id(db, user_id)
+    if db_user is None:
+        logger.warning("User with ID '%s' not found", user_id)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    await async_user_crud.delete_user_by_id(
+        db=db,
+        user=db_user,
+        delete_alarm_jobs_by_user_func=alarm_job_crud.delete_alarm_jobs_by_user_id
+    )
+    logger.info("User with ID '%s' deleted successfully", user_id)
+    return {"message": "User deleted successfully"}
+
+# Verify user's phone number
+@router.post("/users/{username}/verify")
+async def verify_phone_number_async(username: str, verification_code: str, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_user_crud.get_user_by_username(db, username)
+    if db_user is None:
+        logger.warning("User with username '%s' not found", username)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    await async_user_crud.verify_phone_number(db_user.aws_phone_number_id, verification_code)
+    logger.info("Phone number verified successfully for user '%s'", username)
+    return {"message": "Phone number verified successfully"}
+
+# Get alarms by username
+@router.get("/alarms/user/{username}", response_model=List[alarm_schemas.Alarm])
+async def get_alarms_by_username_async(
+    username: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=settings.alarm_page_max_limit),
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    user_version = await async_user_crud.get_user_version_by_username(db, username)
+    if user_version is None:
+        logger.warning("User with username '%s' not found", username)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # The version is read before the alarms, so a change committed in between can only make
+    # the next request get a 200 again, never a 304 for alarms it hasn't seen
+    user_id, version = user_version
+    ndjson = accepts_ndjson(request)
+    etag = user_etag('alarms', user_id, version, after_id, limit, 'ndjson' if ndjson else 'json')
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+
+    if ndjson:
+        logger.info("Streaming alarms for user '%s'", username)
+        return StreamingResponse(
+            async_alarm_crud.stream_alarms_by_user_id(user_id, after_id, limit),
+            media_type="application/x-ndjson",
+            headers=etag_headers(etag, {"Vary": "Accept"})
+        )
+
+    alarms = await async_alarm_crud.get_alarms_by_user_id(db, user_id, after_id, limit)
+    headers = {"Vary": "Accept"}
+    if limit is not None and len(alarms) == limit:
+        headers["X-Next-After-Id"] = str(alarms[-1]['id'])
+    logger.info("Fetched %s alarms for user '%s'", len(alarms), username)
+    return ORJSONResponse(alarms, headers=etag_headers(etag, headers))
+
+# Create alarm
+@router.post("/alarms/", response_model=alarm_schemas.Alarm)
+async def create_alarm_async(alarm_create: alarm_schemas.AlarmCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_user_crud.get_user_by_username(db, alarm_create.username)
+    if not db_user:
+        logger.warning("User with username '%s' not found", alarm_create.username)
+        raise HTTPException(status_code=404, detail="User not found")
+
+    created_alarm = await async_alarm_crud.create_alarm(
+        db=db,
+        alarm_create=alarm_create,
+        user=db_user
+    )
+    logger.info("Alarm with ID '%s' created successfully for user '%s'", created_alarm.id, alarm_create.username)
+    return schema_response(alarm_adapter, created_alarm)
+
+# Create alarms in bulk
+# Alarms are validated one by one and the response has one result per item, in request order
+@router.post("/alarms/bulk", response_model=List[alarm_schemas.AlarmBulkResult])
+async def create_alarms_bulk_async(request: Request, db: AsyncSession = Depends(get_async_db)):
+    results, alarm_creates, alarm_indexes = await parse_bulk_alarms(request)
+
+    # Resolve all usernames in one query, then insert everything in one transaction
+    users = await async_user_crud.get_users_by_usernames(db, (alarm.username for alarm in alarm_creates))
+    created_results = await async_alarm_crud.create_alarms_bulk(db, alarm_creates, users)
+    results = merge_bulk_results(results, created_results, alarm_indexes)
+
+    created_count = sum(1 for result in results if result.status_code == 201)
+    logger.info("Created %s of %s alarms in bulk", created_count, len(results))
+    return schema_response(alarm_bulk_results_adapter, results)
+
+# Update alarm (activate/deactivate)
+@router.put("/alarms/{alarm_id}", response_model=alarm_schemas.Alarm)
+async def update_alarm_async(alarm_id: int, alarm_update: alarm_schemas.AlarmUpdate, db: AsyncSession = Depends(get_async_db)):
+    db_alarm = await async_alarm_crud.get_alarm_by_id(db, alarm_id)
+    if not db_alarm:
+        logger.warning("Alarm with ID '%s' not found", alarm_id)
+        raise HTTPException(status_code=404, detail="Alarm not found")
+
+    if db_alarm.is_active == alarm_update.is_active:
+        return schema_response(alarm_adapter, alarm_schemas.Alarm.from_db(db_alarm))
+
+    updated_alarm = await async_alarm_crud.update_alarm(
+        db=db,
+        alarm=db_alarm,
+        alarm_update=alarm_update,
+        get_user_by_id_func=async_user_crud.get_user_by_id
+    )
+    logger.info("Alarm with ID '%s' updated successfully", alarm_id)
+    return schema_response(alarm_adapter, updated_alarm)
+
+# Delete alarm
+@router.delete("/alarms/{alarm_id}")
+async def delete_alarm_async(alarm_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_alarm = await async_alarm_crud.get_alarm_by_id(db, alarm_id)
+    if not db_alarm:
+        logger.warning("Alarm with ID '%s' not found", alarm_id)
+        raise HTTPException(status_code=404, detail="Alarm not found")
+
+    await async_alarm_crud.delete_alarm_by_id(
+        db=db,
+        alarm_id=alarm_id,
+        get_alarm_job_func=alarm_job_crud.get_alarm_job_by_alarm_id,
+        delete_alarm_job_func=alarm_job_crud.delete_alarm_job_by_alarm_id
+    )
+    logger.info("Alarm with ID '%s' deleted successfully", alarm_id)
+    return {"message": "Alarm deleted successfully"}
@@ -1,11 +1,14 @@
+from typing import Optional
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     database_url: str
-    aws_access_key_id: str
-    aws_secret_access_key: str
-    aws_default_region: str
-    end_user_messaging_sender_id_arn: str
+    # Only required with the Pinpoint transport on the real AWS backend
+    aws_access_key_id: Optional[str] = None
+    aws_secret_access_key: Optional[str] = None
+    aws_default_region: Optional[str] = None
+    end_user_messaging_sender_id_arn: Optional[str] = None
     postgres_user: str
     postgres_password: str
     postgres_db: str
@@ -13,6 +16,133 @@ class Settings(BaseSettings):
     postgres_port: str
     timezone: str
 
+    # Async database mode, the async url defaults to DATABASE_URL with the asyncpg driver
+    database_async: bool = False
+    async_database_url: Optional[str] = None
+
+    # Logging, written by a background thread as JSON lines ('json') or plain text ('text')
+    # INFO and DEBUG records above LOG_SAMPLE_PER_SECOND per call site and second are dropped (0 disables).
+    log_level: str = 'INFO'
+    log_format: str = 'json'
+    log_queue_size: int = 10000
+    log_sample_per_second: int = 10
+
+    # Database engine pools, one per engine (sync, and async when enabled)
+    # DATABASE_ECHO logs every statement, statements slower than DATABASE_SLOW_QUERY_MS are always logged (0 disables).
+    database_pool_size: int = 10
+    database_max_overflow: int = 20
+    database_pool_timeout: float = 30
+    database_pool_recycle_seconds: int = 1800
+    database_pool_pre_ping: bool = True
+    database_echo: bool = False
+    database_slow_query_ms: float = 500
+
+    # Scheduler backend, 'apscheduler' (default), 'timing_wheel', 'sharded' or 'database'
+    scheduler_backend: str = 'apscheduler'
+
+    # Database scheduler, due alarms are claimed from the alarms table by next_fire_at
+    scheduler_db_batch_size: int = 500
+    scheduler_db_poll_seconds: float = 1.0
+    scheduler_db_misfire_grace_seconds: float = 60
+
+    # Sharded scheduler, alarm ids are partitioned into shards leased by the workers
+    scheduler_shard_count: int = 64
+    scheduler_lease_ttl_seconds: float = 10
+    scheduler_lease_renew_seconds: float = 3
+
+    # Number of alarm events kept in memory for firing, jobs themselves only store the alarm id
+    alarm_payload_cache_size: int = 100000
+
+    # User cache, USER_CACHE_NOTIFY invalidates other workers' caches through Postgres LISTEN/NOTIFY
+    user_cache_max_size: int = 10000
+    user_cache_ttl_seconds: float = 60
+    user_cache_notify: bool = False
+
+    # How long the scheduled job count of /metrics is cached, counting them scans the jobstore or alarms table
+    metrics_scheduled_jobs_cache_seconds: float = 60
+
+    # Reconciliation between alarms, alarm_jobs and the scheduler
+    reconcile_on_startup: bool = True
+    reconcile_batch_size: int = 1000
+
+    # Maximum number of alarms per bulk creation request
+    alarm_bulk_max_items: int = 10000
+
+    # Maximum page size when listing alarms with `limit`
+    alarm_page_max_limit: int = 1000
+
+    # SMS dispatch worker pool
+    sms_dispatch_workers: int = 32
+    sms_dispatch_queue_size: int = 10000
+    sms_dispatch_enqueue_timeout: float = 5.0
+
+    # Pinpoint send rate, a token bucket cut on throttling and recovering up to SMS_RATE_LIMIT_PER_SECOND
+    # 0 disables the limit
+    sms_rate_limit_per_second: float = 0
+    sms_rate_limit_burst: int = 20
+    sms_rate_limit_min_per_second: float = 1
+    sms_rate_limit_recovery_per_second: float = 1
+    sms_throttle_max_retries: int = 5
+
+    # Retries of failed sends with exponential backoff and full jitter, then the sms_dead_letters table
+    sms_retry_max_attempts: int = 5
+    sms_retry_base_delay_seconds: float = 1.0
+    sms_retry_max_delay_seconds: float = 300
+    sms_retry_max_pending: int = 10000
+    dead_letter_batch_size: int = 100
+    dead_letter_flush_interval_ms: int = 1000
+    dead_letter_max_buffered: int = 10000
+    dead_letter_replay_max_items: int = 1000
+
+    # Fire lag tracking, fires slower than FIRE_LAG_SLA_SECONDS count as missing the SLA
+    fire_tracker_ring_size: int = 100000
+    fire_tracker_retention_minutes: int = 1440
+    fire_lag_sla_seconds: float = 60
+
+    # AWS client connection pool, shared by the dispatch workers
+    aws_max_pool_connections: int = 50
+    aws_connect_timeout: float = 5.0
+    aws_read_timeout: float = 10.0
+
+    # Pinpoint backend, 'aws' (default) or 'fake' to send through a local fake client
+    pinpoint_backend: str = 'aws'
+    fake_pinpoint_latency_ms: float = 50
+    fake_pinpoint_max_tps: float = 0
+
+    # How fired notifications are sent, 'pinpoint' (default), 'local' to keep them in memory
+    # (and append them to LOCAL_TRANSPORT_PATH when set) or 'noop' to discard them
+    notification_transport: str = 'pinpoint'
+    local_transport_max_messages: int = 1000
+    local_transport_path: Optional[str] = None
+
+    # Pinpoint verified destination numbers
+    pinpoint_max_verified_numbers: int = 10
+    pinpoint_verified_numbers_ttl_seconds: float = 300
+
+    # Batched notification logging to DynamoDB
+    notification_log_batch_size: int = 100
+    notification_log_flush_interval_ms: int = 1000
+    notification_log_max_buffered: int = 10000
+    notification_log_spill_path: str = 'notification_log_spill.jsonl'
+    notification_log_max_spill_bytes: int = 50 * 1024 * 1024
+
+    @model_validator(mode='after')
+    def set_async_database_url(self):
+        if not self.async_database_url:
+            self.async_database_url = self.database_url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+        return self
+
+    @model_validator(mode='after')
+    def check_aws_settings(self):
+        if self.notification_transport == 'pinpoint' and self.pinpoint_backend == 'aws':
+            missing = [
+                name.upper() for name in ('aws_access_key_id', 'aws_secret_access_key', 'aws_default_region', 'end_user_messaging_sender_id_arn')
+                if not getattr(self, name)
+            ]
+            if missing:
+                raise ValueError(f"{', '.join(missing)} must be set to send through Pinpoint")
+        return self
+
     class Config:
         env_file = ".env"
 
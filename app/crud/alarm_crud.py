@@ -1,160 +1,321 @@
-from typing import List
+import orjson
+from typing import Dict, Iterator, List, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import SQLAlchemyError
+from app.crud.user_crud import bump_user_versions_statements, invalidate_cached_users
 from app.db import models
-from app.schemas import user_schemas, alarm_schemas, alarm_job_schemas
-from app.utils.scheduler import schedule_alarm, unschedule_alarm
+from app.db.database import SessionLocal
+from app.schemas import user_schemas, alarm_schemas
+from app.utils.scheduler import schedule_alarm, schedule_alarms, unschedule_alarm, get_job_id
 from app.utils.logger import logger
 
+# Rows per multi-row insert statement of a bulk creation
+BULK_INSERT_CHUNK_SIZE = 1000
+
+# Rows fetched per round trip, and written per response chunk, when streaming alarms
+STREAM_CHUNK_SIZE = 1000
+
+# Alarms of a user in id order, after `after_id` and up to `limit` when paginating
+def alarms_by_user_query(user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None):
+    query = select(models.Alarm).filter(models.Alarm.user_id == user_id).order_by(models.Alarm.id)
+    if after_id is not None:
+        query = query.filter(models.Alarm.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+# Columns of an alarm, read as plain rows instead of ORM objects when listing or streaming
+def alarm_rows_by_user_query(user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return alarms_by_user_query(user_id, after_id, limit).with_only_columns(
+        models.Alarm.message,
+        models.Alarm.time,
+        models.Alarm.days_of_week,
+        models.Alarm.is_active,
+        models.Alarm.id,
+        models.Alarm.user_id
+    )
+
+# Insert an alarm, returning the created row so no refresh is needed
+def insert_alarm_statement(user_id: int, alarm_create: alarm_schemas.AlarmCreate):
+    return insert(models.Alarm).values(
+        user_id=user_id,
+        message=alarm_create.message,
+        time=alarm_create.time,
+        days_of_week=alarm_create.days_of_week,
+        is_active=alarm_create.is_active
+    ).returning(models.Alarm)
+
+# Set the job id of an alarm, creating its alarm job row if it's missing
+# Job ids are derived from the alarm id, so the row is written in the alarm's transaction.
+def upsert_alarm_job_statement(alarm: alarm_schemas.Alarm):
+    sms_job_id = get_job_id(alarm.id) if alarm.is_active else None
+    return (
+        postgresql.insert(models.AlarmJob)
+        .values(alarm_id=alarm.id, sms_job_id=sms_job_id)
+        .on_conflict_do_update(index_elements=['alarm_id'], set_={'sms_job_id': sms_job_id})
+    )
+
+# NDJSON line of a streamed alarm, same fields as alarm_schemas.Alarm
+def alarm_row_to_ndjson(row) -> str:
+    return orjson.dumps(row._asdict()).decode() + '\n'
+
 # Alarm CRUD operations
 def get_alarm_by_id(db: Session, alarm_id: int) -> alarm_schemas.Alarm:
     try:
         result = db.execute(select(models.Alarm).filter(models.Alarm.id == alarm_id))
         return result.scalars().first()
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching alarm with ID '{alarm_id}': {e}")
+        logger.error("Error fetching alarm with ID '%s': %s", alarm_id, e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching alarm with ID '{alarm_id}': {e}")
+        logger.error("Unexpected error fetching alarm with ID '%s': %s", alarm_id, e)
         raise
 
-def get_alarms_by_user_id(db: Session, user_id: int) -> List[alarm_schemas.Alarm]:
+# Alarms of a user as plain dicts with the fields of alarm_schemas.Alarm
+# Rows from the database aren't validated again, they are serialized as they are.
+def get_alarms_by_user_id(db: Session, user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
     try:
-        result = db.execute(select(models.Alarm).filter(models.Alarm.user_id == user_id))
-        return result.scalars().all()
+        result = db.execute(alarm_rows_by_user_query(user_id, after_id, limit))
+        return [row._asdict() for row in result]
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching alarms for user ID '{user_id}': {e}")
+        logger.error("Error fetching alarms for user ID '%s': %s", user_id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error occurred while getting alarms by user with ID '{user_id}': {e}")
+        logger.error("Unexpected error occurred while getting alarms by user with ID '%s': %s", user_id, e)
         raise
 
+# Stream the alarms of a user as NDJSON chunks, with a server-side cursor
+# Opens its own session, the request session is closed before a streaming response is sent.
+def stream_alarms_by_user_id(user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None) -> Iterator[str]:
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            alarm_rows_by_user_query(user_id, after_id, limit).execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        for rows in result.partitions():
+            yield ''.join(alarm_row_to_ndjson(row) for row in rows)
+    except Exception as e:
+        logger.error("Error streaming alarms for user ID '%s': %s", user_id, e)
+        raise
+    finally:
+        db.close()
+
+# Alarm write operations are made of steps shared with the async CRUD operations, which run the
+# database steps through AsyncSession.run_sync and the blocking scheduler steps in the threadpool.
+
+# Create an alarm and its alarm job in a single transaction, then schedule it
+# If scheduling fails the alarm stays created, the reconciler schedules it later.
 def create_alarm(
         db: Session, 
         alarm_create: alarm_schemas.AlarmCreate, 
-        user: user_schemas.User, 
-        create_alarm_job_func
+        user: user_schemas.User
     ) -> alarm_schemas.Alarm:
+    alarm = insert_alarm(db, alarm_create, user)
+    schedule_created_alarm(alarm, user)
+    return alarm
+
+def insert_alarm(db: Session, alarm_create: alarm_schemas.AlarmCreate, user: user_schemas.User) -> alarm_schemas.Alarm:
     try:
-        # Add alarm to db
-        db_alarm = models.Alarm(
-            user_id=user.id,
-            message=alarm_create.message,
-            time=alarm_create.time,
-            days_of_week=alarm_create.days_of_week,
-            is_active=alarm_create.is_active
-        )
-        db.add(db_alarm)
+        # Add alarm and alarm job to db
+        alarm = alarm_schemas.Alarm.from_db(db.scalars(insert_alarm_statement(user.id, alarm_create)).one())
+        db.execute(upsert_alarm_job_statement(alarm))
+        for statement in bump_user_versions_statements([user.id]):
+            db.execute(statement)
         db.commit()
-        db.refresh(db_alarm)
+        invalidate_cached_users([user.id])
+        return alarm
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error("Error creating alarm for user '%s': %s", user.id, e)
+        raise
+    except ValueError as e:
+        logger.error("Validation error for alarm creation: %s", e)
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.error("Unexpected error occurred while creating alarm for user '%s': %s", user.id, e)
+        raise
 
-        # Validate schema
-        alarm = alarm_schemas.Alarm.model_validate(db_alarm)
+# Schedule a created alarm once committed
+def schedule_created_alarm(alarm: alarm_schemas.Alarm, user: user_schemas.User) -> None:
+    if not alarm.is_active:
+        return
+    try:
+        schedule_alarm(
+            alarm,
+            user.phone_number
+        )
+    except Exception as e:
+        logger.error("Error scheduling created alarm with ID '%s', left to the reconciler: %s", alarm.id, e)
 
-        # Schedule alarms with APScheduler
-        sms_job_id = None
-        if alarm.is_active:
-            sms_job_id = schedule_alarm(
-                alarm,
-                user.phone_number
-            )
+# Create many alarms and their alarm jobs in a single transaction, then schedule them in one batch
+# If scheduling fails the alarms stay created, the reconciler schedules them later.
+# Args:
+#   alarm_creates: Alarms to create.
+#   users: Users of the alarms keyed by username, alarms of unknown users are reported as not found.
+# Returns one result per alarm, in the same order.
+def create_alarms_bulk(
+        db: Session,
+        alarm_creates: List[alarm_schemas.AlarmCreate],
+        users: Dict[str, user_schemas.User]
+    ) -> List[alarm_schemas.AlarmBulkResult]:
+    results, alarms = insert_alarms_bulk(db, alarm_creates, users)
+    schedule_created_alarms(alarms, users)
+    return results
 
-        # Creating alarm job in DB
-        create_alarm_job_func(db, alarm_job_schemas.AlarmJobCreate(
-            alarm_id=alarm.id,
-            sms_job_id=sms_job_id
-        ))
+# Insert the alarms of known users, returns the results and the created alarms
+def insert_alarms_bulk(
+        db: Session,
+        alarm_creates: List[alarm_schemas.AlarmCreate],
+        users: Dict[str, user_schemas.User]
+    ) -> Tuple[List[alarm_schemas.AlarmBulkResult], List[alarm_schemas.Alarm]]:
+    results = []
+    rows = []
+    for index, alarm_create in enumerate(alarm_creates):
+        user = users.get(alarm_create.username)
+        if user is None:
+            results.append(alarm_schemas.AlarmBulkResult(index=index, status_code=404, detail="User not found"))
+            continue
+        results.append(alarm_schemas.AlarmBulkResult(index=index, status_code=201))
+        rows.append({
+            'user_id': user.id,
+            'message': alarm_create.message,
+            'time': alarm_create.time,
+            'days_of_week': alarm_create.days_of_week,
+            'is_active': alarm_create.is_active
+        })
 
-        return alarm
+    try:
+        # Insert alarms with multi-row inserts, returned in the order they were given
+        alarms = []
+        for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+            db_alarms = db.scalars(
+                insert(models.Alarm).returning(models.Alarm, sort_by_parameter_order=True),
+                rows[start:start + BULK_INSERT_CHUNK_SIZE]
+            ).all()
+            alarms.extend(alarm_schemas.Alarm.from_db(db_alarm) for db_alarm in db_alarms)
+
+        # Job ids are derived from the alarm id, so alarm jobs go in the same transaction
+        job_rows = [
+            {'alarm_id': alarm.id, 'sms_job_id': get_job_id(alarm.id) if alarm.is_active else None}
+            for alarm in alarms
+        ]
+        for start in range(0, len(job_rows), BULK_INSERT_CHUNK_SIZE):
+            db.execute(insert(models.AlarmJob), job_rows[start:start + BULK_INSERT_CHUNK_SIZE])
+        user_ids = {row['user_id'] for row in rows}
+        for statement in bump_user_versions_statements(user_ids):
+            db.execute(statement)
+        db.commit()
+        invalidate_cached_users(user_ids)
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error creating alarm for user '{user.id}': {e}")
-        raise
-    except ValueError as e:
-        logger.error(f"Validation error for alarm creation: {e}")
+        logger.error("Error creating %s alarms in bulk: %s", len(rows), e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error occurred while creating alarm for user '{user.id}': {e}")
+        logger.error("Unexpected error occurred while creating %s alarms in bulk: %s", len(rows), e)
         raise
 
+    created_results = (result for result in results if result.status_code == 201)
+    for result, alarm in zip(created_results, alarms):
+        result.alarm = alarm
+    return results, alarms
+
+# Schedule all active alarms created in bulk in one batch, once committed
+def schedule_created_alarms(alarms: List[alarm_schemas.Alarm], users: Dict[str, user_schemas.User]) -> None:
+    try:
+        phone_numbers = {user.id: user.phone_number for user in users.values()}
+        schedule_alarms([(alarm, phone_numbers[alarm.user_id]) for alarm in alarms if alarm.is_active])
+    except Exception as e:
+        logger.error("Error scheduling %s alarms created in bulk, left to the reconciler: %s", len(alarms), e)
+
+# Update an alarm and its alarm job in a single transaction, then (un)schedule it
+# The user is fetched first when the alarm gets activated, for its phone number. If (un)scheduling
+# fails the update stays committed, the reconciler fixes the job later.
 def update_alarm(
         db: Session, 
         alarm: alarm_schemas.Alarm, 
         alarm_update: alarm_schemas.AlarmUpdate, 
-        get_user_by_id_func, 
-        get_alarm_job_func
+        get_user_by_id_func
     ) -> alarm_schemas.Alarm:
-    try:
-        # Validate schema
-        alarm = alarm_schemas.Alarm.model_validate(alarm)
-
-        # Update the alarm
-        alarm.is_active = alarm_update.is_active
+    user = get_user_by_id_func(db, alarm.user_id) if alarm_update.is_active else None
+    alarm = save_alarm_update(db, alarm, alarm_update)
+    reschedule_updated_alarm(alarm, user)
+    return alarm
 
-        db.execute(
+def save_alarm_update(db: Session, alarm: alarm_schemas.Alarm, alarm_update: alarm_schemas.AlarmUpdate) -> alarm_schemas.Alarm:
+    try:
+        # Update the alarm and its alarm job
+        alarm = alarm_schemas.Alarm.from_db(db.scalars(
             update(models.Alarm)
             .where(models.Alarm.id == alarm.id)
-            .values(is_active=alarm.is_active)
-        )
+            .values(is_active=alarm_update.is_active)
+            .returning(models.Alarm)
+        ).one())
+        db.execute(upsert_alarm_job_statement(alarm))
+        for statement in bump_user_versions_statements([alarm.user_id]):
+            db.execute(statement)
         db.commit()
-        
-        # Schedule alarms if active
-        sms_job_id = None
-        if alarm.is_active:
-            # Get user information
-            user = get_user_by_id_func(db, alarm.user_id)
-            sms_job_id = schedule_alarm(
-                alarm,
-                user.phone_number
-            )
-        else:
-            # Unschedule alarms if inactive
-            alarm_job = get_alarm_job_func(db, alarm.id)
-            if alarm_job:
-                if alarm_job.sms_job_id:
-                    unschedule_alarm(alarm_job.sms_job_id)
-            sms_job_id = None
-
-        # Update alarm job in DB
-        db.execute(
-            update(models.AlarmJob)
-            .where(models.AlarmJob.alarm_id == alarm.id)
-            .values(sms_job_id=sms_job_id)
-        )
-        db.commit()
-
-        return alarm_schemas.Alarm.model_validate(alarm)
+        invalidate_cached_users([alarm.user_id])
+        return alarm
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error updating alarm with ID '{alarm.id}': {e}")
+        logger.error("Error updating alarm with ID '%s': %s", alarm.id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error occurred while updating alarm with ID '{alarm.id}': {e}")
+        logger.error("Unexpected error occurred while updating alarm with ID '%s': %s", alarm.id, e)
         raise
 
-def delete_alarm_by_id(db: Session, alarm_id: int, get_alarm_job_func, delete_alarm_job_func) -> None:
+# Schedule the alarm if active, unschedule it if inactive, once committed
+def reschedule_updated_alarm(alarm: alarm_schemas.Alarm, user: Optional[user_schemas.User]) -> None:
     try:
-        # Fetch the alarm job first
-        alarm_job = get_alarm_job_func(db, alarm_id)
+        if alarm.is_active:
+            schedule_alarm(
+                alarm,
+                user.phone_number
+            )
+        else:
+            unschedule_alarm(get_job_id(alarm.id))
+    except Exception as e:
+        logger.error("Error (un)scheduling updated alarm with ID '%s', left to the reconciler: %s", alarm.id, e)
+
+# Unschedule an alarm, then delete it and its alarm job
+def delete_alarm_by_id(db: Session, alarm_id: int, get_alarm_job_func, delete_alarm_job_func) -> None:
+    alarm_job = get_alarm_job_func(db, alarm_id)
+    unschedule_deleted_alarm(alarm_id, alarm_job)
+    delete_alarm_rows(db, alarm_id, delete_alarm_job_func)
 
-        # Unschedule before deleting from the database
+# Unschedule before deleting from the database
+def unschedule_deleted_alarm(alarm_id: int, alarm_job) -> None:
+    try:
         if alarm_job:
             if alarm_job.sms_job_id:
                 unschedule_alarm(alarm_job.sms_job_id)
+    except Exception as e:
+        logger.error("Unexpected error when deleting alarm with ID '%s': %s", alarm_id, e)
+        raise
 
-        # Delete the alarm and alarm job from the database
-        db.execute(delete(models.Alarm).filter(models.Alarm.id == alarm_id))
+def delete_alarm_rows(db: Session, alarm_id: int, delete_alarm_job_func) -> None:
+    try:
+        # Delete the alarm and alarm job from the database, bumping the version of its user
+        # before delete_alarm_job_func commits
+        user_ids = db.scalars(
+            delete(models.Alarm).filter(models.Alarm.id == alarm_id).returning(models.Alarm.user_id)
+        ).all()
+        for statement in bump_user_versions_statements(user_ids):
+            db.execute(statement)
         delete_alarm_job_func(db, alarm_id)
         db.commit()
+        invalidate_cached_users(user_ids)
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error deleting alarm with ID '{alarm_id}': {e}")
+        logger.error("Error deleting alarm with ID '%s': %s", alarm_id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error when deleting alarm with ID '{alarm_id}': {e}")
+        logger.error("Unexpected error when deleting alarm with ID '%s': %s", alarm_id, e)
         raise
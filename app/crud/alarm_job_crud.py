@@ -1,3 +1,4 @@
+from typing import List
 from sqlalchemy.orm import Session
 from sqlalchemy import select, delete
 from sqlalchemy.exc import SQLAlchemyError
@@ -11,10 +12,10 @@ def get_alarm_job_by_alarm_id(db: Session, alarm_id: int) -> alarm_job_schemas.A
         result = db.execute(select(models.AlarmJob).filter(models.AlarmJob.alarm_id == alarm_id))
         return result.scalars().first()
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching alarm job for alarm ID '{alarm_id}': {e}")
+        logger.error("Error fetching alarm job for alarm ID '%s': %s", alarm_id, e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching alarm job for alarm ID '{alarm_id}': {e}")
+        logger.error("Unexpected error fetching alarm job for alarm ID '%s': %s", alarm_id, e)
         raise
 
 def create_alarm_job(db: Session, alarm_job: alarm_job_schemas.AlarmJobCreate) -> alarm_job_schemas.AlarmJob:
@@ -29,14 +30,32 @@ def create_alarm_job(db: Session, alarm_job: alarm_job_schemas.AlarmJobCreate) -
         return alarm_job_schemas.AlarmJob.model_validate(db_alarm_job)
     except SQLAlchemyError as e:
         db.rollback()  # Rollback in case of an error
-        logger.error(f"Error creating alarm job for alarm '{alarm_job.alarm_id}': {e}")
+        logger.error("Error creating alarm job for alarm '%s': %s", alarm_job.alarm_id, e)
         raise
     except ValueError as e:
-        logger.error(f"Validation error for alarm job creation: {e}")
+        logger.error("Validation error for alarm job creation: %s", e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error creating alarm job for alarm '{alarm_job.alarm_id}': {e}")
+        logger.error("Unexpected error creating alarm job for alarm '%s': %s", alarm_job.alarm_id, e)
+        raise
+
+# Delete the alarm jobs of all alarms of a user in one statement, within the caller's transaction
+# Returns the scheduler job ids of the deleted rows, to unschedule them in one batch.
+def delete_alarm_jobs_by_user_id(db: Session, user_id: int) -> List[str]:
+    try:
+        result = db.execute(
+            delete(models.AlarmJob)
+            .where(models.AlarmJob.alarm_id.in_(select(models.Alarm.id).where(models.Alarm.user_id == user_id)))
+            .returning(models.AlarmJob.sms_job_id)
+            .execution_options(synchronize_session=False)
+        )
+        return [job_id for job_id in result.scalars() if job_id]
+    except SQLAlchemyError as e:
+        logger.error("Error deleting alarm jobs of user ID '%s': %s", user_id, e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error deleting alarm jobs of user ID '%s': %s", user_id, e)
         raise
 
 def delete_alarm_job_by_alarm_id(db: Session, alarm_id: int) -> None:
@@ -45,9 +64,9 @@ def delete_alarm_job_by_alarm_id(db: Session, alarm_id: int) -> None:
         db.commit()
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error deleting alarm job with alarm ID '{alarm_id}': {e}")
+        logger.error("Error deleting alarm job with alarm ID '%s': %s", alarm_id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error deleting alarm job with alarm ID '{alarm_id}': {e}")
+        logger.error("Unexpected error deleting alarm job with alarm ID '%s': %s", alarm_id, e)
         raise
\ No newline at end of file
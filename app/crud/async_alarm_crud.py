@@ -0,0 +1,69 @@
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import alarm_crud
+from app.crud.alarm_crud import alarm_rows_by_user_query, alarm_row_to_ndjson, STREAM_CHUNK_SIZE
+from app.db.database import AsyncSessionLocal
+from app.schemas import user_schemas, alarm_schemas
+from app.utils.logger import logger
+
+# Async Alarm CRUD operations, used when DATABASE_ASYNC is enabled
+# Thin wrappers of alarm_crud: database steps run on the async session through run_sync, and the
+# blocking scheduler steps run in the threadpool. The alarm job functions passed in are the sync
+# ones of alarm_job_crud, they run inside the database steps.
+async def get_alarm_by_id(db: AsyncSession, alarm_id: int) -> alarm_schemas.Alarm:
+    return await db.run_sync(alarm_crud.get_alarm_by_id, alarm_id)
+
+async def get_alarms_by_user_id(db: AsyncSession, user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
+    return await db.run_sync(alarm_crud.get_alarms_by_user_id, user_id, after_id, limit)
+
+# Stream the alarms of a user as NDJSON chunks, with a server-side cursor
+async def stream_alarms_by_user_id(user_id: int, after_id: Optional[int] = None, limit: Optional[int] = None) -> AsyncIterator[str]:
+    async with AsyncSessionLocal() as db:
+        try:
+            result = await db.stream(
+                alarm_rows_by_user_query(user_id, after_id, limit).execution_options(yield_per=STREAM_CHUNK_SIZE)
+            )
+            async for rows in result.partitions():
+                yield ''.join(alarm_row_to_ndjson(row) for row in rows)
+        except Exception as e:
+            logger.error("Error streaming alarms for user ID '%s': %s", user_id, e)
+            raise
+
+# Create an alarm and its alarm job in a single transaction, then schedule it, see alarm_crud.create_alarm
+async def create_alarm(
+        db: AsyncSession,
+        alarm_create: alarm_schemas.AlarmCreate,
+        user: user_schemas.User
+    ) -> alarm_schemas.Alarm:
+    alarm = await db.run_sync(alarm_crud.insert_alarm, alarm_create, user)
+    await run_in_threadpool(alarm_crud.schedule_created_alarm, alarm, user)
+    return alarm
+
+# Create many alarms in a single transaction, then schedule them in one batch, see alarm_crud.create_alarms_bulk
+async def create_alarms_bulk(
+        db: AsyncSession,
+        alarm_creates: List[alarm_schemas.AlarmCreate],
+        users: Dict[str, user_schemas.User]
+    ) -> List[alarm_schemas.AlarmBulkResult]:
+    results, alarms = await db.run_sync(alarm_crud.insert_alarms_bulk, alarm_creates, users)
+    await run_in_threadpool(alarm_crud.schedule_created_alarms, alarms, users)
+    return results
+
+# Update an alarm and its alarm job in a single transaction, then (un)schedule it, see alarm_crud.update_alarm
+async def update_alarm(
+        db: AsyncSession,
+        alarm: alarm_schemas.Alarm,
+        alarm_update: alarm_schemas.AlarmUpdate,
+        get_user_by_id_func
+    ) -> alarm_schemas.Alarm:
+    user = await get_user_by_id_func(db, alarm.user_id) if alarm_update.is_active else None
+    alarm = await db.run_sync(alarm_crud.save_alarm_update, alarm, alarm_update)
+    await run_in_threadpool(alarm_crud.reschedule_updated_alarm, alarm, user)
+    return alarm
+
+# Unschedule an alarm, then delete it and its alarm job, see alarm_crud.delete_alarm_by_id
+async def delete_alarm_by_id(db: AsyncSession, alarm_id: int, get_alarm_job_func, delete_alarm_job_func) -> None:
+    alarm_job = await db.run_sync(get_alarm_job_func, alarm_id)
+    await run_in_threadpool(alarm_crud.unschedule_deleted_alarm, alarm_id, alarm_job)
+    await db.run_sync(alarm_crud.delete_alarm_rows, alarm_id, delete_alarm_job_func)
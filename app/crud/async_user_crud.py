@@ -0,0 +1,41 @@
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.crud import user_crud
+from app.schemas import user_schemas
+
+# Async User CRUD operations, used when DATABASE_ASYNC is enabled
+# Thin wrappers of user_crud: database steps run on the async session through run_sync, which
+# drives the sync code over the async connection, and the blocking Pinpoint and scheduler steps
+# run in the threadpool.
+async def get_user_by_id(db: AsyncSession, id: int) -> user_schemas.User:
+    return await db.run_sync(user_crud.get_user_by_id, id)
+
+async def get_user_by_username(db: AsyncSession, username: str, min_version: Optional[int] = None) -> user_schemas.User:
+    return await db.run_sync(user_crud.get_user_by_username, username, min_version)
+
+async def get_user_by_phone_number(db: AsyncSession, phone_number: str) -> user_schemas.User:
+    return await db.run_sync(user_crud.get_user_by_phone_number, phone_number)
+
+async def get_user_version_by_username(db: AsyncSession, username: str) -> Optional[Tuple[int, int]]:
+    return await db.run_sync(user_crud.get_user_version_by_username, username)
+
+async def get_users_by_usernames(db: AsyncSession, usernames: Iterable[str]) -> Dict[str, user_schemas.User]:
+    return await db.run_sync(user_crud.get_users_by_usernames, usernames)
+
+async def create_user(db: AsyncSession, user: user_schemas.UserCreate) -> user_schemas.User:
+    aws_phone_number_id = await run_in_threadpool(user_crud.register_user_phone_number, user)
+    return await db.run_sync(user_crud.insert_user, user, aws_phone_number_id)
+
+async def update_user(db: AsyncSession, user: user_schemas.User, user_update: user_schemas.UserUpdate) -> user_schemas.User:
+    await run_in_threadpool(user_crud.apply_user_update, user, user_update)
+    return await db.run_sync(user_crud.save_user_update, user, user_update)
+
+# Delete the user, its alarms and their alarm jobs in a single transaction, see user_crud.delete_user_by_id
+async def delete_user_by_id(db: AsyncSession, user: user_schemas.User, delete_alarm_jobs_by_user_func) -> None:
+    await run_in_threadpool(user_crud.unregister_user_phone_number, user)
+    job_ids = await db.run_sync(user_crud.delete_user_rows, user, delete_alarm_jobs_by_user_func)
+    await run_in_threadpool(user_crud.unschedule_user_jobs, user, job_ids)
+
+async def verify_phone_number(aws_phone_number_id: str, verification_code: str) -> None:
+    await run_in_threadpool(user_crud.verify_phone_number, aws_phone_number_id, verification_code)
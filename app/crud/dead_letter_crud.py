@@ -0,0 +1,83 @@
+from typing import Callable, List
+from sqlalchemy.orm import Session
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from app.db import models
+from app.schemas import dead_letter_schemas
+from app.utils.logger import logger
+
+def count_pending_dead_letters(db: Session) -> int:
+    return db.execute(
+        select(func.count()).select_from(models.SmsDeadLetter).where(models.SmsDeadLetter.replayed_at.is_(None))
+    ).scalar()
+
+# Resubmit up to `limit` dead letters not replayed yet, oldest first, and mark them replayed
+# Rows are locked with SKIP LOCKED so concurrent replays never pick the same ones, and marked
+# replayed and committed before they are resubmitted, so a failed commit never leaves sends already
+# queued: replay is at most once. Events `resubmit_func` has no room for are marked pending again.
+# Events are sent to the current phone number of the alarm's user, events whose alarm is gone are
+# skipped. Replayed events start over with a fresh attempt count and without their scheduled time.
+def replay_dead_letters(db: Session, limit: int, resubmit_func: Callable[[dict], bool]) -> dead_letter_schemas.DeadLetterReplayReport:
+    try:
+        rows = db.execute(
+            select(models.SmsDeadLetter.id, models.SmsDeadLetter.alarm_id, models.SmsDeadLetter.event)
+            .where(models.SmsDeadLetter.replayed_at.is_(None))
+            .order_by(models.SmsDeadLetter.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ).all()
+        alarm_ids = {row.alarm_id for row in rows if row.alarm_id is not None}
+        phone_numbers = dict(db.execute(
+            select(models.Alarm.id, models.User.phone_number)
+            .join(models.User, models.User.id == models.Alarm.user_id)
+            .where(models.Alarm.id.in_(alarm_ids))
+        ).all()) if alarm_ids else {}
+
+        if rows:
+            db.execute(
+                update(models.SmsDeadLetter)
+                .where(models.SmsDeadLetter.id.in_([row.id for row in rows]))
+                .values(replayed_at=func.now())
+            )
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error("Error replaying dead letters: %s", e)
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.error("Unexpected error replaying dead letters: %s", e)
+        raise
+
+    replayed = skipped = 0
+    not_resubmitted = []
+    for index, row in enumerate(rows):
+        phone_number = phone_numbers.get(row.alarm_id)
+        if phone_number is None:
+            skipped += 1
+            continue
+        event = {key: value for key, value in row.event.items() if key not in ('attempts', 'scheduled_time')}
+        if not resubmit_func({**event, 'phone_number': phone_number}):
+            not_resubmitted = [row.id for row in rows[index:] if phone_numbers.get(row.alarm_id) is not None]
+            break
+        replayed += 1
+    if skipped:
+        logger.warning("Skipped %s dead letters whose alarm no longer exists", skipped)
+    if not_resubmitted:
+        release_dead_letters(db, not_resubmitted)
+
+    return dead_letter_schemas.DeadLetterReplayReport(replayed=replayed, skipped=skipped, pending=count_pending_dead_letters(db))
+
+# Mark dead letters that could not be resubmitted as pending again
+# If this fails they stay marked replayed and are not sent, replay is at most once.
+def release_dead_letters(db: Session, ids: List[int]) -> None:
+    try:
+        db.execute(
+            update(models.SmsDeadLetter)
+            .where(models.SmsDeadLetter.id.in_(ids))
+            .values(replayed_at=None)
+        )
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logger.error("Error marking %s dead letters pending again, they are not replayed: %s", len(ids), e)
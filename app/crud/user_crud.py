@@ -1,57 +1,159 @@
-from app.utils.aws_utils import add_pinpoint_phone_number, get_pinpoint_verified_phone_numbers, remove_pinpoint_phone_number, send_pinpoint_verification_code, verify_pinpoint_phone_number
+from app.utils.aws_utils import add_pinpoint_phone_number, remove_pinpoint_phone_number, send_pinpoint_verification_code, verify_pinpoint_phone_number, verified_numbers_index
+from typing import Dict, Iterable, List, Optional, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy import select, update, delete
 from sqlalchemy.exc import SQLAlchemyError
+from app.config import settings
 from app.db import models
 from app.schemas import user_schemas
+from app.utils.pg_listener import notify_statement
+from app.utils.alarm_payloads import alarm_payload_cache, invalidate_alarm_payloads_statement
+from app.utils.scheduler import unschedule_alarms
+from app.utils.user_cache import user_cache, USER_CACHE_CHANNEL
 from app.utils.logger import logger
 
-# User CRUD operations
+# Pinpoint phone number helpers, shared with the async CRUD operations
+# Lookups go through the cached verified numbers index instead of listing Pinpoint every time.
+def add_user_phone_number(phone_number: str) -> str:
+    # Check that you're below the maximum number of verified phone numbers
+    if verified_numbers_index.count() >= settings.pinpoint_max_verified_numbers:
+        raise ValueError("You have reached the maximum number of verified phone numbers")
+
+    # Add phone number to Pinpoint
+    aws_phone_number_id = add_pinpoint_phone_number(phone_number)
+    send_pinpoint_verification_code(aws_phone_number_id)
+    return aws_phone_number_id
+
+def remove_user_phone_number(user: user_schemas.User) -> None:
+    # Delete verified number from Pinpoint if it exists
+    if verified_numbers_index.get_by_phone_number(user.phone_number) is not None:
+        remove_pinpoint_phone_number(user.aws_phone_number_id)
+
+# User cache helpers, shared with the async CRUD operations
+# Validate a user loaded from the db and add it to the cache
+def cache_user(db_user: Optional[models.User]) -> Optional[user_schemas.User]:
+    if db_user is None:
+        return None
+    user = user_schemas.User.from_db(db_user)
+    user_cache.put(user)
+    return user
+
+def user_version_by_username_query(username: str):
+    return select(models.User.id, models.User.version).filter(models.User.username == username)
+
+# Statement invalidating a changed user in the other workers' caches once the transaction commits
+def invalidate_user_statement(user_id: int):
+    if not settings.user_cache_notify:
+        return None
+    return notify_statement(USER_CACHE_CHANNEL, str(user_id))
+
+# Statements bumping the version of users whose alarms changed, run in the alarms' transaction
+# The version is the ETag of the user and alarm reads, so cached copies of the users are stale
+# once committed: they are invalidated in the other workers with the transaction, and in this
+# one by `invalidate_cached_users` after the commit.
+def bump_user_versions_statements(user_ids: Iterable[int]) -> list:
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return []
+    statements = [update(models.User).where(models.User.id.in_(user_ids)).values(version=models.User.version + 1)]
+    statements.extend(invalidate_alarm_payloads_statement(user_id) for user_id in user_ids)
+    if settings.user_cache_notify:
+        statements.extend(invalidate_user_statement(user_id) for user_id in user_ids)
+    return statements
+
+def invalidate_cached_users(user_ids: Iterable[int]) -> None:
+    for user_id in set(user_ids):
+        user_cache.invalidate(user_id)
+
+# User CRUD operations, reads go through the user cache
 def get_user_by_id(db: Session, id: int) -> user_schemas.User:
+    user = user_cache.get_by_id(id)
+    if user is not None:
+        return user
     try:
         result = db.execute(select(models.User).filter(models.User.id == id))
-        return result.scalars().first()
+        return cache_user(result.scalars().first())
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching user by id '{id}': {e}")
+        logger.error("Error fetching user by id '%s': %s", id, e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching user by id '{id}': {e}")
+        logger.error("Unexpected error fetching user by id '%s': %s", id, e)
         raise
 
-def get_user_by_username(db: Session, username: str) -> user_schemas.User:
+# With `min_version`, a cached user older than it is loaded again
+def get_user_by_username(db: Session, username: str, min_version: Optional[int] = None) -> user_schemas.User:
+    user = user_cache.get_by_username(username)
+    if user is not None and (min_version is None or user.version >= min_version):
+        return user
     try:
         result = db.execute(select(models.User).filter(models.User.username == username))
-        return result.scalars().first()
+        return cache_user(result.scalars().first())
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching user by username '{username}': {e}")
+        logger.error("Error fetching user by username '%s': %s", username, e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching user by username '{username}': {e}")
+        logger.error("Unexpected error fetching user by username '%s': %s", username, e)
         raise
 
 def get_user_by_phone_number(db: Session, phone_number: str) -> user_schemas.User:
+    user = user_cache.get_by_phone_number(phone_number)
+    if user is not None:
+        return user
     try:
         result = db.execute(select(models.User).filter(models.User.phone_number == phone_number))
-        return result.scalars().first()
+        return cache_user(result.scalars().first())
     except SQLAlchemyError as e:
-        logger.error(f"Error fetching user by id '{phone_number}': {e}")
+        logger.error("Error fetching user by id '%s': %s", phone_number, e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching user by id '{phone_number}': {e}")
+        logger.error("Unexpected error fetching user by id '%s': %s", phone_number, e)
         raise
 
+# Id and version of a user, for conditional requests, or None if there's no such user
+# Always read with a single lookup on the username index, without loading the user: the cache can
+# hold an older version for a while, even with USER_CACHE_NOTIFY, and a 304 must never be stale.
+def get_user_version_by_username(db: Session, username: str) -> Optional[Tuple[int, int]]:
+    try:
+        return db.execute(user_version_by_username_query(username)).first()
+    except SQLAlchemyError as e:
+        logger.error("Error fetching version of user '%s': %s", username, e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error fetching version of user '%s': %s", username, e)
+        raise
+
+def get_users_by_usernames(db: Session, usernames: Iterable[str]) -> Dict[str, user_schemas.User]:
+    usernames = list(set(usernames))
+    try:
+        result = db.execute(select(models.User).filter(models.User.username.in_(usernames)))
+        return {user.username: user for user in map(cache_user, result.scalars())}
+    except SQLAlchemyError as e:
+        logger.error("Error fetching %s users by username: %s", len(usernames), e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error fetching %s users by username: %s", len(usernames), e)
+        raise
+
+# User write operations are made of steps shared with the async CRUD operations, which run the
+# database steps through AsyncSession.run_sync and the blocking Pinpoint and scheduler steps in
+# the threadpool.
 def create_user(db: Session, user: user_schemas.UserCreate) -> user_schemas.User:
+    aws_phone_number_id = register_user_phone_number(user)
+    return insert_user(db, user, aws_phone_number_id)
+
+# Add the phone number of a new user to Pinpoint, returns its Pinpoint id
+def register_user_phone_number(user: user_schemas.UserCreate) -> str:
+    try:
+        return add_user_phone_number(user.phone_number)
+    except ValueError as e:
+        logger.error("Validation error for user creation: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error creating user '%s': %s", user.username, e)
+        raise
+
+def insert_user(db: Session, user: user_schemas.UserCreate, aws_phone_number_id: str) -> user_schemas.User:
     try:
-        # Check that you're below 10 verified phone numbers
-        aws_verified_phone_numbers = get_pinpoint_verified_phone_numbers()
-        if len(aws_verified_phone_numbers) >= 10:
-            raise ValueError("You have reached the maximum number of verified phone numbers")
-        
-        # Add phone number to Pinpoint
-        aws_phone_number_id = add_pinpoint_phone_number(user.phone_number)
-        send_pinpoint_verification_code(aws_phone_number_id)
-
-        # Add user to db
         db_user = models.User(
             username=user.username,
             phone_number=user.phone_number,
@@ -60,93 +162,118 @@ def create_user(db: Session, user: user_schemas.UserCreate) -> user_schemas.User
         db.add(db_user)
         db.commit()
         db.refresh(db_user)
-        return user_schemas.User.model_validate(db_user)
+        return cache_user(db_user)
     except SQLAlchemyError as e:
         db.rollback()  # Rollback in case of an error
-        logger.error(f"Error creating user '{user.username}': {e}")
-        raise
-    except ValueError as e:
-        db.rollback()
-        logger.error(f"Validation error for user creation: {e}")
+        logger.error("Error creating user '%s': %s", user.username, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error creating user '{user.username}': {e}")
+        logger.error("Unexpected error creating user '%s': %s", user.username, e)
         raise
 
 def update_user(db: Session, user: user_schemas.User, user_update: user_schemas.UserUpdate) -> user_schemas.User:
-    try:
-        # Validate schema
-        user = user_schemas.User.model_validate(user)
+    apply_user_update(user, user_update)
+    return save_user_update(db, user, user_update)
 
-        # Update user
+# Apply the update to the user, swapping its phone number in Pinpoint if it changes
+def apply_user_update(user: user_schemas.User, user_update: user_schemas.UserUpdate) -> None:
+    try:
         if user_update.username:
             user.username = user_update.username
         if user_update.phone_number:
-            # Delete old number from Pinpoint if it exists
-            aws_verified_phone_numbers = get_pinpoint_verified_phone_numbers()
-            for phone_number in aws_verified_phone_numbers:
-                if phone_number['DestinationPhoneNumber'] == user.phone_number:
-                    remove_pinpoint_phone_number(user.aws_phone_number_id)
-
-            # Check that you're below 10 verified phone numbers
-            if len(aws_verified_phone_numbers) >= 10:
-                raise ValueError("You have reached the maximum number of verified phone numbers")
-
-            # Add new phone number to Pinpoint
-            aws_phone_number_id = add_pinpoint_phone_number(user_update.phone_number)
-            send_pinpoint_verification_code(aws_phone_number_id)
+            # Delete old number from Pinpoint if it exists, then add the new one
+            remove_user_phone_number(user)
+            aws_phone_number_id = add_user_phone_number(user_update.phone_number)
             user.phone_number = user_update.phone_number
             user.aws_phone_number_id = aws_phone_number_id
-        db.execute(
+    except ValueError as e:
+        logger.error("Validation error for user update: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Unexpected error updating user with ID '%s': %s", user.id, e)
+        raise
+
+# Write the updated user, bumping its version, and update the caches once committed
+def save_user_update(db: Session, user: user_schemas.User, user_update: user_schemas.UserUpdate) -> user_schemas.User:
+    try:
+        user.version = db.execute(
             update(models.User)
             .where(models.User.id == user.id)
-            .values(username=user.username, phone_number=user.phone_number, aws_phone_number_id=user.aws_phone_number_id)
-        )
+            .values(
+                username=user.username,
+                phone_number=user.phone_number,
+                aws_phone_number_id=user.aws_phone_number_id,
+                version=models.User.version + 1
+            )
+            .returning(models.User.version)
+        ).scalar_one()
+        if (statement := invalidate_user_statement(user.id)) is not None:
+            db.execute(statement)
+        if user_update.phone_number:
+            db.execute(invalidate_alarm_payloads_statement(user.id))
         db.commit()
+        user_cache.put(user)
+        if user_update.phone_number:
+            alarm_payload_cache.update_phone_number(user.id, user.phone_number)
 
         return user
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error updating user with ID '{user.id}': {e}")
-        raise
-    except ValueError as e:
-        logger.error(f"Validation error for user update: {e}")
+        logger.error("Error updating user with ID '%s': %s", user.id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error updating user with ID '{user.id}': {e}")
+        logger.error("Unexpected error updating user with ID '%s': %s", user.id, e)
         raise
 
-def delete_user_by_id(db: Session, user: user_schemas.User, get_alarms_by_user_func, delete_alarm_func) -> None:
+# Delete the user, its alarms and their alarm jobs in a single transaction
+# Alarm jobs are deleted in one statement returning their job ids, and the alarms go with the
+# user through the ON DELETE CASCADE foreign key. The jobs are unscheduled in one batch once
+# committed, if that fails the reconciler removes them as orphans.
+def delete_user_by_id(db: Session, user: user_schemas.User, delete_alarm_jobs_by_user_func) -> None:
+    unregister_user_phone_number(user)
+    job_ids = delete_user_rows(db, user, delete_alarm_jobs_by_user_func)
+    unschedule_user_jobs(user, job_ids)
+
+# Delete the verified number of the user from Pinpoint if it exists
+def unregister_user_phone_number(user: user_schemas.User) -> None:
     try:
-        # Delete verified number from Pinpoint if it exists
-        verified_phone_numbers = get_pinpoint_verified_phone_numbers()
-        for phone_number in verified_phone_numbers:
-            if phone_number['DestinationPhoneNumber'] == user.phone_number:
-                remove_pinpoint_phone_number(user.aws_phone_number_id)
-
-        # Delete all related alarms
-        alarms = get_alarms_by_user_func(db, user.id)
-        for alarm in alarms:
-            delete_alarm_func(db, alarm.id)
-
-        # Delete the user
+        remove_user_phone_number(user)
+    except Exception as e:
+        logger.error("Unexpected error deleting user with ID '%s': %s", user.id, e)
+        raise
+
+# Delete the alarm jobs, then the user with all its alarms, returns the deleted job ids
+def delete_user_rows(db: Session, user: user_schemas.User, delete_alarm_jobs_by_user_func) -> List[str]:
+    try:
+        job_ids = delete_alarm_jobs_by_user_func(db, user.id)
         db.execute(delete(models.User).filter(models.User.id == user.id))
+        if (statement := invalidate_user_statement(user.id)) is not None:
+            db.execute(statement)
         db.commit()
+        user_cache.invalidate(user.id)
+        alarm_payload_cache.invalidate_user(user.id)
+        return job_ids
     except SQLAlchemyError as e:
         db.rollback()
-        logger.error(f"Error deleting user with ID '{user.id}': {e}")
+        logger.error("Error deleting user with ID '%s': %s", user.id, e)
         raise
     except Exception as e:
         db.rollback()
-        logger.error(f"Unexpected error deleting user with ID '{user.id}': {e}")
+        logger.error("Unexpected error deleting user with ID '%s': %s", user.id, e)
         raise
 
+def unschedule_user_jobs(user: user_schemas.User, job_ids: List[str]) -> None:
+    try:
+        unschedule_alarms(job_ids)
+    except Exception as e:
+        logger.error("Error unscheduling %s jobs of deleted user with ID '%s': %s", len(job_ids), user.id, e)
+
 def verify_phone_number(aws_phone_number_id: str, verification_code: str) -> None:
     try:
         # Verify phone number
         verify_pinpoint_phone_number(aws_phone_number_id, verification_code)
     except Exception as e:
-        logger.error(f"Error verifying phone number: {e}")
+        logger.error("Error verifying phone number: %s", e)
         raise
\ No newline at end of file
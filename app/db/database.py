@@ -1,10 +1,25 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from app.config import settings
+from app.utils.metrics import instrument_engine, timed_pool_class
+
+# Engine profile shared by the sync and async engines
+def engine_options() -> dict:
+    return {
+        'echo': settings.database_echo,
+        'pool_size': settings.database_pool_size,
+        'max_overflow': settings.database_max_overflow,
+        'pool_timeout': settings.database_pool_timeout,
+        'pool_recycle': settings.database_pool_recycle_seconds,
+        'pool_pre_ping': settings.database_pool_pre_ping,
+    }
 
 # Synchronous engine setup
-engine = create_engine(settings.database_url, echo=True)
+engine = create_engine(settings.database_url, poolclass=timed_pool_class(QueuePool, 'sync'), **engine_options())
+instrument_engine(engine, 'sync', settings.database_slow_query_ms / 1000)
 
 # Synchronous sessionmaker setup
 SessionLocal = sessionmaker(
@@ -14,3 +29,17 @@ SessionLocal = sessionmaker(
 )
 
 Base = declarative_base()
+
+# Asynchronous engine setup, only created when DATABASE_ASYNC is enabled
+async_engine = None
+AsyncSessionLocal = None
+if settings.database_async:
+    async_engine = create_async_engine(
+        settings.async_database_url, poolclass=timed_pool_class(AsyncAdaptedQueuePool, 'async'), **engine_options()
+    )
+    instrument_engine(async_engine.sync_engine, 'async', settings.database_slow_query_ms / 1000)
+    AsyncSessionLocal = async_sessionmaker(
+        autoflush=False,
+        expire_on_commit=False,
+        bind=async_engine
+    )
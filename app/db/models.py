@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Time, Boolean, ForeignKey, ARRAY, TIMESTAMP, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Time, Boolean, ForeignKey, ARRAY, JSON, TIMESTAMP, UniqueConstraint, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import Mapped
@@ -15,6 +15,8 @@ class User(Base):
     phone_number = Column(String(20), nullable=False, unique=True)
     aws_phone_number_id = Column(String(255), nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), default=func.now())
+    # Bumped on every change of the user or its alarms, the ETag of their reads
+    version = Column(BigInteger, nullable=False, server_default=text('1'), default=1)
     
     # Relationship to alarms
     alarms: Mapped[List["Alarm"]] = relationship(back_populates="user")
@@ -30,6 +32,7 @@ class Alarm(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(TIMESTAMP(timezone=True), default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), default=func.now(), onupdate=func.now())
+    next_fire_at = Column(TIMESTAMP(timezone=True), nullable=True)  # Next scheduled fire, kept by the database scheduler backend
     
     # Relationship to user
     user: Mapped["User"] = relationship(back_populates="alarms")
@@ -37,6 +40,13 @@ class Alarm(Base):
     # One-to-one relationship with AlarmJob
     alarm_job: Mapped[Optional["AlarmJob"]] = relationship("AlarmJob", back_populates="alarm", uselist=False)
 
+    __table_args__ = (
+        # Listing a user's alarms in id order (keyset pages) and cascading user deletes
+        Index('ix_alarms_user_id_id', 'user_id', 'id'),
+        # Due alarms claimed by the database scheduler
+        Index('ix_alarms_next_fire_at', 'next_fire_at'),
+    )
+
 class AlarmJob(Base):
     __tablename__ = 'alarm_jobs'
     
@@ -47,3 +57,35 @@ class AlarmJob(Base):
     
     # Relationship to alarm
     alarm: Mapped["Alarm"] = relationship("Alarm", back_populates="alarm_job")
+
+class SchedulerShardLease(Base):
+    __tablename__ = 'scheduler_shard_leases'
+
+    shard_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(255), nullable=True)  # Worker id holding the lease, NULL when released
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    fired_through = Column(BigInteger, nullable=True)  # Last epoch second fired by the previous owner
+
+class SchedulerWorker(Base):
+    __tablename__ = 'scheduler_workers'
+
+    worker_id = Column(String(255), primary_key=True)
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
+
+class SmsDeadLetter(Base):
+    __tablename__ = 'sms_dead_letters'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    alarm_id = Column(Integer, nullable=True)  # No foreign key, dead letters outlive deleted alarms
+    event = Column(JSON, nullable=False)  # Event as it was given to the dispatcher
+    error_code = Column(String(255), nullable=False)
+    error_message = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False)
+    scheduled_time = Column(TIMESTAMP(timezone=True), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), default=func.now())
+    replayed_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Dead letters not replayed yet, oldest first
+        Index('ix_sms_dead_letters_pending', 'id', postgresql_where=text('replayed_at IS NULL')),
+    )
@@ -1,13 +1,29 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.concurrency import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Request
+from fastapi.concurrency import asynccontextmanager, run_in_threadpool
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from typing import List
-from app.crud import user_crud, alarm_crud, alarm_job_crud
-from app.schemas import user_schemas, alarm_schemas
-from app.db.database import SessionLocal
-from app.utils.scheduler import start_scheduler
+from typing import List, Optional
+from app.config import settings
+from app.crud import user_crud, alarm_crud, alarm_job_crud, dead_letter_crud
+from app.schemas import user_schemas, alarm_schemas, reconcile_schemas, fire_lag_schemas, dead_letter_schemas
+from app.db.database import SessionLocal, async_engine
+from app import async_api
+from app.utils.scheduler import start_scheduler, shutdown_scheduler, shard_leases, db_scheduler
+from app.utils.sms_dispatcher import sms_dispatcher, dead_letter_buffer
+from app.utils.notification_transport import notification_transport
+from app.utils.aws_utils import notification_log_buffer
+from app.utils.pg_listener import pg_listener
+from app.utils.reconciler import reconcile, reconcile_on_startup, ReconcileInProgressError
+from app.utils.user_cache import user_cache
+from app.utils.alarm_payloads import alarm_payload_cache
+from app.utils.bulk_utils import accepts_ndjson, parse_bulk_alarms, merge_bulk_results
+from app.utils.metrics import registry, MetricsMiddleware
+from app.utils.fire_tracker import fire_tracker
+from app.utils.responses import (
+    schema_response, user_adapter, alarm_adapter, alarm_bulk_results_adapter,
+    user_etag, etag_matches, etag_headers, not_modified_response
+)
 from app.utils.logger import logger
 
 # Dependency to get the synchronous DB session
@@ -21,15 +37,26 @@ def get_db():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     start_scheduler()  # Start the scheduler as usual
+    if settings.reconcile_on_startup:
+        await run_in_threadpool(reconcile_on_startup)
+    pg_listener.start()
     yield
+    pg_listener.shutdown()
+    shutdown_scheduler()
+    if async_engine is not None:
+        await async_engine.dispose()
 
-app = FastAPI(lifespan=lifespan)
+# Responses FastAPI serializes itself (stats, reports, messages) are rendered with orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Per-route latency histograms, exposed at /metrics
+app.add_middleware(MetricsMiddleware)
 
 # Create a custom exception handler for RequestValidationError to throw BAD REQUEST
 # When specifying req or res as a schema, it runs schema validation and throws RequestValidationError if failed
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    logger.error(f"Validation error occurred: {exc.errors()}")
+    logger.error("Validation error occurred: %s", exc.errors())
     return JSONResponse(
         status_code=422,
         content={
@@ -41,146 +68,202 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 def read_root():
     return {"message": "Welcome to the Alarm Notification System!"}
 
+# Synchronous versions of the user and alarm endpoints, registered when DATABASE_ASYNC is disabled
+# Only one set is registered, see the end of the endpoints below.
+sync_router = APIRouter()
+
 # Get user by username
-@app.get("/users/{username}", response_model=user_schemas.User)
-def get_user(username: str, db: Session = Depends(get_db)):
-    db_user = user_crud.get_user_by_username(db, username)
+# Answered with 304 Not Modified when If-None-Match has the ETag of the user's current version
+@sync_router.get("/users/{username}", response_model=user_schemas.User)
+def get_user(username: str, request: Request, db: Session = Depends(get_db)):
+    # Conditional requests check the version in the database, the cached user can be older
+    min_version = None
+    if request.headers.get('if-none-match'):
+        user_version = user_crud.get_user_version_by_username(db, username)
+        if user_version is not None:
+            etag = user_etag('user', *user_version)
+            if etag_matches(request, etag):
+                return not_modified_response(etag)
+            min_version = user_version[1]
+
+    db_user = user_crud.get_user_by_username(db, username, min_version)
     if db_user is None:
-        logger.warning(f"User with username '{username}' not found")
+        logger.warning("User with username '%s' not found", username)
         raise HTTPException(status_code=404, detail="User not found")
     
-    logger.info(f"User with username '{username}' fetched successfully")
-    return db_user
+    etag = user_etag('user', db_user.id, db_user.version)
+    logger.info("User with username '%s' fetched successfully", username)
+    return schema_response(user_adapter, db_user, headers=etag_headers(etag))
 
 # Create user
-@app.post("/users/", response_model=user_schemas.User)
+@sync_router.post("/users/", response_model=user_schemas.User)
 def create_user(user_create: user_schemas.UserCreate, db: Session = Depends(get_db)):
     db_user = user_crud.get_user_by_username(db, user_create.username)
     if db_user:
-        logger.warning(f"Username '{user_create.username}' already registered")
+        logger.warning("Username '%s' already registered", user_create.username)
         raise HTTPException(status_code=400, detail="Username already registered")
     
     db_user = user_crud.get_user_by_phone_number(db, user_create.phone_number)
     if db_user:
-        logger.warning(f"Phone number '{user_create.phone_number}' already registered")
+        logger.warning("Phone number '%s' already registered", user_create.phone_number)
         raise HTTPException(status_code=400, detail="Phone number already registered")
     
     created_user = user_crud.create_user(db, user_create)
-    logger.info(f"User '{user_create.username}' created successfully")
-    return created_user
+    logger.info("User '%s' created successfully", user_create.username)
+    return schema_response(user_adapter, created_user)
 
 # Update user by id
-@app.put("/users/{user_id}", response_model=user_schemas.User)
+@sync_router.put("/users/{user_id}", response_model=user_schemas.User)
 def update_user(user_id: int, user_update: user_schemas.UserUpdate, db: Session = Depends(get_db)):
     db_user = user_crud.get_user_by_id(db, user_id)
     if db_user is None:
-        logger.warning(f"User with ID '{user_id}' not found")
+        logger.warning("User with ID '%s' not found", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     
     if db_user.phone_number == user_update.phone_number and db_user.username == user_update.username:
-        return db_user
+        return schema_response(user_adapter, db_user)
     
     if user_update.username:
         user_with_new_username = user_crud.get_user_by_username(db, user_update.username)
         if user_with_new_username:
-            logger.warning(f"Username '{user_update.username}' already registered")
+            logger.warning("Username '%s' already registered", user_update.username)
             raise HTTPException(status_code=400, detail="Username already registered")
     
     if user_update.phone_number:
         user_with_new_phone = user_crud.get_user_by_phone_number(db, user_update.phone_number)
         if user_with_new_phone:
-            logger.warning(f"Phone number '{user_update.phone_number}' already registered")
+            logger.warning("Phone number '%s' already registered", user_update.phone_number)
             raise HTTPException(status_code=400, detail="Phone number already registered")
     
     updated_user = user_crud.update_user(db, db_user, user_update)
-    logger.info(f"User with ID '{user_id}' updated successfully")
-    return updated_user
+    logger.info("User with ID '%s' updated successfully", user_id)
+    return schema_response(user_adapter, updated_user)
 
 # Delete user by id
-@app.delete("/users/{user_id}")
+@sync_router.delete("/users/{user_id}")
 def delete_user(user_id: int, db: Session = Depends(get_db)):
     db_user = user_crud.get_user_by_id(db, user_id)
     if db_user is None:
-        logger.warning(f"User with ID '{user_id}' not found")
+        logger.warning("User with ID '%s' not found", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     
     user_crud.delete_user_by_id(
         db=db, 
         user=db_user, 
-        get_alarms_by_user_func=alarm_crud.get_alarms_by_user_id, 
-        delete_alarm_func=alarm_crud.delete_alarm_by_id
+        delete_alarm_jobs_by_user_func=alarm_job_crud.delete_alarm_jobs_by_user_id
     )
-    logger.info(f"User with ID '{user_id}' deleted successfully")
+    logger.info("User with ID '%s' deleted successfully", user_id)
     return {"message": "User deleted successfully"}
 
 # Verify user's phone number
-@app.post("/users/{username}/verify")
+@sync_router.post("/users/{username}/verify")
 def verify_phone_number(username: str, verification_code: str, db: Session = Depends(get_db)):
     db_user = user_crud.get_user_by_username(db, username)
     if db_user is None:
-        logger.warning(f"User with username '{username}' not found")
+        logger.warning("User with username '%s' not found", username)
         raise HTTPException(status_code=404, detail="User not found")
     
     user_crud.verify_phone_number(db_user.aws_phone_number_id, verification_code)
-    logger.info(f"Phone number verified successfully for user '{username}'")
+    logger.info("Phone number verified successfully for user '%s'", username)
     return {"message": "Phone number verified successfully"}
 
 # Get alarms by username
-@app.get("/alarms/user/{username}", response_model=List[alarm_schemas.Alarm])
-def get_alarms_by_username(username: str, db: Session = Depends(get_db)):
-    db_user = user_crud.get_user_by_username(db, username)
-    if not db_user:
-        logger.warning(f"User with username '{username}' not found")
+# Paginate with `limit` and `after_id` (the X-Next-After-Id header of the previous page),
+# or send `Accept: application/x-ndjson` to stream them one JSON object per line.
+# Answered with 304 Not Modified when If-None-Match has the ETag of the user's current version.
+@sync_router.get("/alarms/user/{username}", response_model=List[alarm_schemas.Alarm])
+def get_alarms_by_username(
+    username: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=settings.alarm_page_max_limit),
+    after_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    user_version = user_crud.get_user_version_by_username(db, username)
+    if user_version is None:
+        logger.warning("User with username '%s' not found", username)
         raise HTTPException(status_code=404, detail="User not found")
-    
-    alarms = alarm_crud.get_alarms_by_user_id(db, db_user.id)
-    logger.info(f"Fetched {len(alarms)} alarms for user '{username}'")
-    return alarms
+
+    # The version is read before the alarms, so a change committed in between can only make
+    # the next request get a 200 again, never a 304 for alarms it hasn't seen
+    user_id, version = user_version
+    ndjson = accepts_ndjson(request)
+    etag = user_etag('alarms', user_id, version, after_id, limit, 'ndjson' if ndjson else 'json')
+    if etag_matches(request, etag):
+        return not_modified_response(etag)
+
+    if ndjson:
+        logger.info("Streaming alarms for user '%s'", username)
+        return StreamingResponse(
+            alarm_crud.stream_alarms_by_user_id(user_id, after_id, limit),
+            media_type="application/x-ndjson",
+            headers=etag_headers(etag, {"Vary": "Accept"})
+        )
+
+    alarms = alarm_crud.get_alarms_by_user_id(db, user_id, after_id, limit)
+    headers = {"Vary": "Accept"}
+    if limit is not None and len(alarms) == limit:
+        headers["X-Next-After-Id"] = str(alarms[-1]['id'])
+    logger.info("Fetched %s alarms for user '%s'", len(alarms), username)
+    return ORJSONResponse(alarms, headers=etag_headers(etag, headers))
 
 # Create alarm
-@app.post("/alarms/", response_model=alarm_schemas.Alarm)
+@sync_router.post("/alarms/", response_model=alarm_schemas.Alarm)
 def create_alarm(alarm_create: alarm_schemas.AlarmCreate, db: Session = Depends(get_db)):
     db_user = user_crud.get_user_by_username(db, alarm_create.username)
     if not db_user:
-        logger.warning(f"User with username '{alarm_create.username}' not found")
+        logger.warning("User with username '%s' not found", alarm_create.username)
         raise HTTPException(status_code=404, detail="User not found")
     
     created_alarm = alarm_crud.create_alarm(
         db=db, 
         alarm_create=alarm_create, 
-        user=db_user, 
-        create_alarm_job_func=alarm_job_crud.create_alarm_job
+        user=db_user
     )
-    logger.info(f"Alarm with ID '{created_alarm.id}' created successfully for user '{alarm_create.username}'")
-    return created_alarm
+    logger.info("Alarm with ID '%s' created successfully for user '%s'", created_alarm.id, alarm_create.username)
+    return schema_response(alarm_adapter, created_alarm)
+
+# Create alarms in bulk
+# Alarms are validated one by one and the response has one result per item, in request order
+@sync_router.post("/alarms/bulk", response_model=List[alarm_schemas.AlarmBulkResult])
+async def create_alarms_bulk(request: Request, db: Session = Depends(get_db)):
+    results, alarm_creates, alarm_indexes = await parse_bulk_alarms(request)
+
+    # Resolve all usernames in one query, then insert everything in one transaction
+    users = await run_in_threadpool(user_crud.get_users_by_usernames, db, (alarm.username for alarm in alarm_creates))
+    created_results = await run_in_threadpool(alarm_crud.create_alarms_bulk, db, alarm_creates, users)
+    results = merge_bulk_results(results, created_results, alarm_indexes)
+
+    created_count = sum(1 for result in results if result.status_code == 201)
+    logger.info("Created %s of %s alarms in bulk", created_count, len(results))
+    return schema_response(alarm_bulk_results_adapter, results)
 
 # Update alarm (activate/deactivate)
-@app.put("/alarms/{alarm_id}", response_model=alarm_schemas.Alarm)
+@sync_router.put("/alarms/{alarm_id}", response_model=alarm_schemas.Alarm)
 def update_alarm(alarm_id: int, alarm_update: alarm_schemas.AlarmUpdate, db: Session = Depends(get_db)):
     db_alarm = alarm_crud.get_alarm_by_id(db, alarm_id)
     if not db_alarm:
-        logger.warning(f"Alarm with ID '{alarm_id}' not found")
+        logger.warning("Alarm with ID '%s' not found", alarm_id)
         raise HTTPException(status_code=404, detail="Alarm not found")
     
     if db_alarm.is_active == alarm_update.is_active:
-        return db_alarm
+        return schema_response(alarm_adapter, alarm_schemas.Alarm.from_db(db_alarm))
     
     updated_alarm = alarm_crud.update_alarm(
         db=db,
         alarm=db_alarm,
         alarm_update=alarm_update,
-        get_user_by_id_func=user_crud.get_user_by_id,
-        get_alarm_job_func=alarm_job_crud.get_alarm_job_by_alarm_id
+        get_user_by_id_func=user_crud.get_user_by_id
     )
-    logger.info(f"Alarm with ID '{alarm_id}' updated successfully")
-    return updated_alarm
+    logger.info("Alarm with ID '%s' updated successfully", alarm_id)
+    return schema_response(alarm_adapter, updated_alarm)
 
 # Delete alarm
-@app.delete("/alarms/{alarm_id}")
+@sync_router.delete("/alarms/{alarm_id}")
 def delete_alarm(alarm_id: int, db: Session = Depends(get_db)):
     db_alarm = alarm_crud.get_alarm_by_id(db, alarm_id)
     if not db_alarm:
-        logger.warning(f"Alarm with ID '{alarm_id}' not found")
+        logger.warning("Alarm with ID '%s' not found", alarm_id)
         raise HTTPException(status_code=404, detail="Alarm not found")
     
     alarm_crud.delete_alarm_by_id(
@@ -189,5 +272,77 @@ def delete_alarm(alarm_id: int, db: Session = Depends(get_db)):
         get_alarm_job_func=alarm_job_crud.get_alarm_job_by_alarm_id,
         delete_alarm_job_func=alarm_job_crud.delete_alarm_job_by_alarm_id
     )
-    logger.info(f"Alarm with ID '{alarm_id}' deleted successfully")
+    logger.info("Alarm with ID '%s' deleted successfully", alarm_id)
     return {"message": "Alarm deleted successfully"}
+
+# Register the user and alarm endpoints of the database mode, async_api has the async versions
+app.include_router(async_api.router if settings.database_async else sync_router)
+
+# Get SMS dispatch queue depth and send throughput
+@app.get("/stats/sms-dispatch")
+def get_sms_dispatch_stats():
+    return sms_dispatcher.stats()
+
+# Get the notification transport and what it sent
+@app.get("/stats/notification-transport")
+def get_notification_transport_stats():
+    return notification_transport.stats()
+
+# Get notification log buffer stats
+@app.get("/stats/notification-log")
+def get_notification_log_stats():
+    return notification_log_buffer.stats()
+
+# Get dead-letter buffer stats and the number of dead letters not replayed yet
+@app.get("/stats/dead-letters")
+def get_dead_letter_stats(db: Session = Depends(get_db)):
+    return {**dead_letter_buffer.stats(), 'pending': dead_letter_crud.count_pending_dead_letters(db)}
+
+# Resubmit dead-lettered sends to the SMS dispatcher in bulk, oldest first
+@app.post("/admin/dead-letters/replay", response_model=dead_letter_schemas.DeadLetterReplayReport)
+def replay_dead_letters(limit: int = Query(settings.dead_letter_replay_max_items, ge=1, le=settings.dead_letter_replay_max_items), db: Session = Depends(get_db)):
+    report = dead_letter_crud.replay_dead_letters(db=db, limit=limit, resubmit_func=sms_dispatcher.resubmit)
+    logger.info("Replayed %s dead letters, %s still pending", report.replayed, report.pending)
+    return report
+
+# Prometheus metrics of the API, database, scheduler, SMS dispatch and AWS calls
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+# Get per-minute fire lag percentiles and the slowest fires, by scheduled minute
+@app.get("/stats/fire-lag", response_model=fire_lag_schemas.FireLagReport)
+def get_fire_lag_report(minutes: int = 60, worst: int = 20):
+    return fire_tracker.report(minutes=minutes, worst=worst)
+
+# Get user cache hit/miss stats
+@app.get("/stats/user-cache")
+def get_user_cache_stats():
+    return user_cache.stats()
+
+# Get alarm payload cache stats
+@app.get("/stats/alarm-payloads")
+def get_alarm_payload_stats():
+    return alarm_payload_cache.stats()
+
+# Get the shards owned by this worker, only with the sharded scheduler
+@app.get("/stats/scheduler-shards")
+def get_scheduler_shard_stats():
+    if shard_leases is None:
+        raise HTTPException(status_code=404, detail="Sharded scheduler is not enabled")
+    return shard_leases.stats()
+
+# Get the polls and claims of this worker, only with the database scheduler
+@app.get("/stats/db-scheduler")
+def get_db_scheduler_stats():
+    if db_scheduler is None:
+        raise HTTPException(status_code=404, detail="Database scheduler is not enabled")
+    return db_scheduler.stats()
+
+# Reconcile alarms, alarm jobs and the scheduler jobstore, only reports the differences in a dry run
+@app.post("/admin/reconcile", response_model=reconcile_schemas.ReconcileReport)
+def reconcile_scheduler(dry_run: bool = True):
+    try:
+        return reconcile(dry_run=dry_run)
+    except ReconcileInProgressError:
+        raise HTTPException(status_code=409, detail="Another process is reconciling")
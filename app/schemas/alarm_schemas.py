@@ -34,4 +34,24 @@ class Alarm(AlarmBase):
     user_id: int
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+    # Build from an ORM object or row of the alarms table without validating it again,
+    # its values were validated when they were written
+    @classmethod
+    def from_db(cls, row) -> Self:
+        return cls.model_construct(
+            message=row.message,
+            time=row.time,
+            days_of_week=row.days_of_week,
+            is_active=row.is_active,
+            id=row.id,
+            user_id=row.user_id
+        )
+
+# Result of one item of a bulk alarm creation, alarm is set if it was created
+class AlarmBulkResult(BaseModel):
+    index: int
+    status_code: int
+    alarm: Optional[Alarm] = None
+    detail: Optional[str] = None
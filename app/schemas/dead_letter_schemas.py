@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+
+# Result of a dead-letter replay, `pending` is what is left to replay afterwards
+# `skipped` dead letters belonged to deleted alarms and are marked replayed without being sent.
+class DeadLetterReplayReport(BaseModel):
+    replayed: int
+    skipped: int = 0
+    pending: int
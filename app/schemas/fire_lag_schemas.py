@@ -0,0 +1,31 @@
+from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
+
+# Lag of the fires scheduled within one minute, from the scheduled time to the completed send
+# Percentiles are estimated from log-scale buckets, within 10% of the exact value.
+class FireLagMinute(BaseModel):
+    minute: datetime
+    fires: int
+    sent: int
+    failed: int
+    dropped: int
+    within_sla: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+# A single fire, times are relative to its scheduled time
+class FireLagRecord(BaseModel):
+    alarm_id: int
+    scheduled_time: datetime
+    outcome: str
+    lag_ms: float
+    dequeue_ms: Optional[float] = None
+    send_ms: Optional[float] = None
+
+class FireLagReport(BaseModel):
+    sla_seconds: float
+    minutes: List[FireLagMinute]
+    worst: List[FireLagRecord]
@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+from typing import Dict, List
+
+# Report of a reconciliation between alarms, alarm_jobs and the scheduler
+class ReconcileReport(BaseModel):
+    dry_run: bool
+    active_alarms: int
+    scheduled_jobs: int
+    missing_jobs: int
+    orphan_jobs: int
+    legacy_jobs: int = 0
+    alarm_jobs_created: int
+    alarm_jobs_updated: int
+    sample_missing_job_ids: List[str] = []
+    sample_orphan_job_ids: List[str] = []
+    timings_ms: Dict[str, float] = {}
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, constr, model_validator
+from pydantic import BaseModel, Field, constr, model_validator
 from pydantic_extra_types.phone_numbers import PhoneNumber
 from typing import Optional
 from typing_extensions import Self
@@ -29,9 +29,23 @@ class UserUpdate(BaseModel):
         return self
 
 # The User schema will include all UserBase fields + id + aws_phone_number_id
+# The version is only used for ETags, it isn't part of the response.
 class User(UserBase):
     id: int
     aws_phone_number_id: str
+    version: int = Field(0, exclude=True)
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+    # Build from an ORM object or row of the users table without validating it again,
+    # its values were validated when they were written
+    @classmethod
+    def from_db(cls, row) -> Self:
+        return cls.model_construct(
+            username=row.username,
+            phone_number=row.phone_number,
+            id=row.id,
+            aws_phone_number_id=row.aws_phone_number_id,
+            version=row.version
+        )
\ No newline at end of file
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Set
+from sqlalchemy import select
+from app.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+from app.schemas import alarm_schemas
+from app.utils.pg_listener import pg_listener, notify_statement
+from app.utils.logger import logger
+
+# Create the event dictionary sent when the alarm fires
+def build_event(alarm: alarm_schemas.Alarm, phone_number: str) -> dict:
+    return {
+        'phone_number': phone_number,
+        **alarm.model_dump()
+    }
+
+# Load the events of the given active alarms from the database, keyed by alarm id
+def load_alarm_payloads(alarm_ids: List[int]) -> Dict[int, dict]:
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(models.Alarm, models.User.phone_number)
+            .join(models.User, models.User.id == models.Alarm.user_id)
+            .filter(models.Alarm.id.in_(alarm_ids), models.Alarm.is_active.is_(True))
+        )
+        return {
+            db_alarm.id: build_event(alarm_schemas.Alarm.from_db(db_alarm), phone_number)
+            for db_alarm, phone_number in result
+        }
+    except Exception as e:
+        logger.error("Error loading payloads for %s alarms: %s", len(alarm_ids), e)
+        raise
+    finally:
+        db.close()
+
+# Bounded LRU cache of the events sent when alarms fire
+# Scheduler jobs only carry the alarm id, the message and phone number are looked up here at
+# fire time, so they stay current and aren't pickled into every jobstore row. Events are kept
+# until evicted or invalidated: changes made by this worker update the cache directly, and phone
+# number and alarm changes made by other workers drop the user's events through ALARM_PAYLOAD_CHANNEL.
+# Args:
+#   loader: Loads the events of alarms missing from the cache.
+#   max_size: Maximum number of events kept, least recently used events are evicted first.
+class AlarmPayloadCache:
+    def __init__(self, loader: Callable[[List[int]], Dict[int, dict]], max_size: int = 100000):
+        self._loader = loader
+        self._max_size = max_size
+        self._events: "OrderedDict[int, dict]" = OrderedDict()
+        self._alarm_ids_by_user: Dict[int, Set[int]] = {}
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def get(self, alarm_id: int) -> Optional[dict]:
+        return self.get_many([alarm_id]).get(alarm_id)
+
+    # Get the events of many alarms, loading every missing one in a single query
+    def get_many(self, alarm_ids: Iterable[int]) -> Dict[int, dict]:
+        events = {}
+        missing = []
+        with self._lock:
+            for alarm_id in alarm_ids:
+                event = self._events.get(alarm_id)
+                if event is None:
+                    missing.append(alarm_id)
+                    continue
+                self._events.move_to_end(alarm_id)
+                events[alarm_id] = event
+            self.hits += len(events)
+            self.misses += len(missing)
+
+        if missing:
+            loaded = self._loader(missing)
+            for event in loaded.values():
+                self.put(event)
+            events.update(loaded)
+        return events
+
+    def put(self, event: dict) -> None:
+        with self._lock:
+            self._remove(event['id'])
+            self._events[event['id']] = event
+            self._alarm_ids_by_user.setdefault(event['user_id'], set()).add(event['id'])
+            while len(self._events) > self._max_size:
+                self._remove(next(iter(self._events)))
+
+    def remove(self, alarm_id: int) -> None:
+        with self._lock:
+            self._remove(alarm_id)
+
+    # Keep the cached events of a user current after a phone number change
+    def update_phone_number(self, user_id: int, phone_number: str) -> None:
+        with self._lock:
+            for alarm_id in self._alarm_ids_by_user.get(user_id, ()):
+                self._events[alarm_id] = {**self._events[alarm_id], 'phone_number': phone_number}
+
+    # Drop the cached events of a user, they are reloaded on the next fire
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            for alarm_id in list(self._alarm_ids_by_user.get(user_id, ())):
+                self._remove(alarm_id)
+
+    # Fill the cache with the active alarms from the database, up to its size
+    def warm(self) -> None:
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                select(models.Alarm, models.User.phone_number)
+                .join(models.User, models.User.id == models.Alarm.user_id)
+                .filter(models.Alarm.is_active.is_(True))
+                .limit(self._max_size)
+                .execution_options(yield_per=1000)
+            )
+            for db_alarm, phone_number in result:
+                self.put(build_event(alarm_schemas.Alarm.from_db(db_alarm), phone_number))
+            logger.info("Warmed alarm payload cache with %s alarms", len(self._events))
+        except Exception as e:
+            logger.error("Error warming alarm payload cache: %s", e)
+            raise
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._events),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _remove(self, alarm_id: int) -> None:
+        event = self._events.pop(alarm_id, None)
+        if event is None:
+            return
+        user_alarm_ids = self._alarm_ids_by_user.get(event['user_id'])
+        if user_alarm_ids is not None:
+            user_alarm_ids.discard(alarm_id)
+            if not user_alarm_ids:
+                del self._alarm_ids_by_user[event['user_id']]
+
+alarm_payload_cache = AlarmPayloadCache(loader=load_alarm_payloads, max_size=settings.alarm_payload_cache_size)
+
+# Channel used to drop the cached payloads of a user in every worker
+# Published with every phone number and alarm change, whatever USER_CACHE_NOTIFY is, since
+# events are cached until invalidated.
+ALARM_PAYLOAD_CHANNEL = 'alarm_payload_invalidation'
+
+# Statement dropping the cached payloads of a user in every worker once the transaction commits
+def invalidate_alarm_payloads_statement(user_id: int):
+    return notify_statement(ALARM_PAYLOAD_CHANNEL, str(user_id))
+
+pg_listener.subscribe(ALARM_PAYLOAD_CHANNEL, lambda payload: alarm_payload_cache.invalidate_user(int(payload)))
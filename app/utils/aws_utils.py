@@ -1,40 +1,124 @@
+import threading
 from datetime import datetime
-from typing import List
-import boto3
+from typing import Callable, List
 from app.utils.logger import logger
 from app.config import settings
+from app.utils.notification_log import NotificationLogBuffer
+from app.utils.verified_numbers import VerifiedNumbersIndex
+from app.utils.metrics import InstrumentedClient
+from app.utils.rate_limiter import is_throttling_error
 
-# Initialize AWS services
-pinpoint_sms = boto3.client('pinpoint-sms-voice-v2')
-dynamodb = boto3.resource('dynamodb')
-notification_log_table = dynamodb.Table('AlarmNotificationSystemNotifications')
+# Shared connection pool for all threads sending through the AWS clients
+# Built by the client factories, so botocore is only imported once a client is created.
+def aws_client_config(max_attempts: int = 3):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=settings.aws_max_pool_connections,
+        connect_timeout=settings.aws_connect_timeout,
+        read_timeout=settings.aws_read_timeout,
+        tcp_keepalive=True,
+        retries={'max_attempts': max_attempts, 'mode': 'standard'}
+    )
 
+# AWS client created on first use and then shared by every thread
+# Building boto3 clients loads the service models, which is most of the cost of importing the
+# app, and needs the AWS settings, so it is left until something is actually sent or logged.
+class LazyClient:
+    def __init__(self, factory: Callable[[], object]):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+# boto3 and botocore are only imported here, so importing the app doesn't pay for them
+def create_pinpoint_client(max_attempts: int = 3):
+    if settings.pinpoint_backend == 'fake':
+        from app.utils.fake_pinpoint import FakePinpointSmsClient
+        return FakePinpointSmsClient(latency_ms=settings.fake_pinpoint_latency_ms, max_tps=settings.fake_pinpoint_max_tps)
+    import boto3
+    return boto3.client('pinpoint-sms-voice-v2', config=aws_client_config(max_attempts))
+
+# Client sending notifications, without botocore retries
+# Throttling must reach the dispatcher's rate limiter right away, and failed sends are retried by
+# the dispatcher's own backoff, so botocore retrying them too would hide and stack on top of both.
+def create_pinpoint_send_client():
+    return create_pinpoint_client(max_attempts=1)
+
+def create_notification_log_table():
+    import boto3
+    return boto3.resource('dynamodb', config=aws_client_config()).Table('AlarmNotificationSystemNotifications')
+
+# AWS services, Pinpoint calls are timed for the metrics endpoint
+pinpoint_sms = InstrumentedClient(LazyClient(create_pinpoint_client), 'pinpoint')
+pinpoint_sms_send = InstrumentedClient(LazyClient(create_pinpoint_send_client), 'pinpoint')
+notification_log_table = LazyClient(create_notification_log_table)
+
+# Notification logs are written in batches in the background, off the send path
+notification_log_buffer = NotificationLogBuffer(
+    table=notification_log_table,
+    batch_size=settings.notification_log_batch_size,
+    flush_interval_ms=settings.notification_log_flush_interval_ms,
+    max_buffered=settings.notification_log_max_buffered,
+    spill_path=settings.notification_log_spill_path,
+    max_spill_bytes=settings.notification_log_max_spill_bytes
+)
+
+# Get every verified phone number, paging through all results
 def get_pinpoint_verified_phone_numbers() -> List[dict]:
     logger.info("Getting verified phone numbers from Pinpoint")
     try:
-        response = pinpoint_sms.describe_verified_destination_numbers(
-            MaxResults=10
-        )
-        logger.info(f"Succcessfully retrieved {len(response['VerifiedDestinationNumbers'])} verified phone numbers from Pinpoint!")
-        return response['VerifiedDestinationNumbers']
+        verified_phone_numbers = []
+        request = {'MaxResults': 100}
+        while True:
+            response = pinpoint_sms.describe_verified_destination_numbers(**request)
+            verified_phone_numbers.extend(response['VerifiedDestinationNumbers'])
+            if not response.get('NextToken'):
+                break
+            request['NextToken'] = response['NextToken']
+        logger.info("Succcessfully retrieved %s verified phone numbers from Pinpoint!", len(verified_phone_numbers))
+        return verified_phone_numbers
     except Exception as e:
-        logger.error(f"Error getting verified phone numbers from Pinpoint: {e}")
+        logger.error("Error getting verified phone numbers from Pinpoint: %s", e)
         raise
 
+# Verified phone numbers index, kept current by the functions below
+verified_numbers_index = VerifiedNumbersIndex(
+    loader=get_pinpoint_verified_phone_numbers,
+    ttl_seconds=settings.pinpoint_verified_numbers_ttl_seconds
+)
+
 def add_pinpoint_phone_number(phone_number: str) -> str:
-    logger.info(f"Adding phone number to Pinpoint: {phone_number}")
+    logger.info("Adding phone number to Pinpoint: %s", phone_number)
     try:
         response = pinpoint_sms.create_verified_destination_number(
             DestinationPhoneNumber=phone_number
         )
-        logger.info(f"Phone number added to Pinpoint: {response['VerifiedDestinationNumberId']}")
+        verified_numbers_index.add({
+            'VerifiedDestinationNumberId': response['VerifiedDestinationNumberId'],
+            'DestinationPhoneNumber': response.get('DestinationPhoneNumber', phone_number),
+            'Status': response.get('Status', 'PENDING')
+        })
+        logger.info("Phone number added to Pinpoint: %s", response['VerifiedDestinationNumberId'])
         return response['VerifiedDestinationNumberId']
     except Exception as e:
-        logger.error(f"Error adding phone number to Pinpoint: {e}")
+        logger.error("Error adding phone number to Pinpoint: %s", e)
         raise
 
 def send_pinpoint_verification_code(aws_phone_number_id: str) -> None:
-    logger.info(f"Sending verification code to verified destination: {aws_phone_number_id}")
+    logger.info("Sending verification code to verified destination: %s", aws_phone_number_id)
     try:
         response = pinpoint_sms.send_destination_number_verification_code(
             VerifiedDestinationNumberId=aws_phone_number_id,
@@ -42,63 +126,66 @@ def send_pinpoint_verification_code(aws_phone_number_id: str) -> None:
             LanguageCode='EN_US',
             OriginationIdentity=settings.end_user_messaging_sender_id_arn
         )
-        logger.info(f"Verification code sent successfully: {response}")
+        logger.info("Verification code sent successfully to verified destination %s: message %s", aws_phone_number_id, response.get('MessageId'))
     except Exception as e:
-        logger.error(f"Error sending verification code: {e}")
+        logger.error("Error sending verification code: %s", e)
         raise
 
 def verify_pinpoint_phone_number(aws_phone_number_id: str, verification_code: str) -> None:
-    logger.info(f"Verifying phone number: {aws_phone_number_id}")
+    logger.info("Verifying phone number: %s", aws_phone_number_id)
     try:
         response = pinpoint_sms.verify_destination_number(
             VerifiedDestinationNumberId=aws_phone_number_id,
             VerificationCode=verification_code
         )
-        logger.info(f"Phone number verified successfully: {response}")
+        verified_numbers_index.set_status(aws_phone_number_id, response.get('Status', 'VERIFIED'))
+        logger.info("Phone number %s verified successfully with status %s", aws_phone_number_id, response.get('Status'))
     except Exception as e:
-        logger.error(f"Error verifying phone number: {e}")
+        logger.error("Error verifying phone number: %s", e)
         raise
 
 def remove_pinpoint_phone_number(aws_phone_number_id: str) -> None:
-    logger.info(f"Removing phone number from Pinpoint: {aws_phone_number_id}")
+    logger.info("Removing phone number from Pinpoint: %s", aws_phone_number_id)
     try:
-        response = pinpoint_sms.delete_verified_destination_number(
+        pinpoint_sms.delete_verified_destination_number(
             VerifiedDestinationNumberId=aws_phone_number_id
         )
-        logger.info(f"Phone number removed from Pinpoint: {response}")
+        verified_numbers_index.remove(aws_phone_number_id)
+        logger.info("Phone number removed from Pinpoint: %s", aws_phone_number_id)
     except Exception as e:
-        logger.error(f"Error removing phone number from Pinpoint: {e}")
+        logger.error("Error removing phone number from Pinpoint: %s", e)
         raise
 
+# Send outcomes are summarized once per second by the dispatcher, only failures are logged here
+# Throttling is left to the dispatcher, which retries at a lower rate.
 def send_pinpoint_sms_notification(event: dict) -> None:
-    logger.info("Send SMS Notification: %s", event)
     try:
-        response = pinpoint_sms.send_text_message(
+        response = pinpoint_sms_send.send_text_message(
             DestinationPhoneNumber=event['phone_number'],
             OriginationIdentity=settings.end_user_messaging_sender_id_arn,
             MessageBody=event['message'],
             MessageType='TRANSACTIONAL'
         )
         log_notification_to_dynamodb(event)
-        logger.info(f"SMS notification sent successfully: {response}")
+        logger.debug("SMS notification for alarm with ID %s sent: %s", event['id'], response.get('MessageId'))
     except Exception as e:
-        logger.error(f"Error sending SMS notification: {e}")
+        if not is_throttling_error(e):
+            logger.error("Error sending SMS notification for alarm with ID %s: %s", event.get('id'), e)
         raise
 
+# Buffer the notification log, it is written to DynamoDB by the background flusher
 def log_notification_to_dynamodb(event):
     try:
-        notification_log_table.put_item(
-            Item={
-                'id': event['id'],
-                'user_id': event['user_id'],
-                'phone_number': event['phone_number'],
-                'time': str(event['time']),
-                'days_of_week': event['days_of_week'],
-                'is_active': event['is_active'],
-                'message': event['message'],
-                'timestamp': datetime.now().isoformat(),
-            }
-        )
+        notification_log_buffer.enqueue({
+            'id': event['id'],
+            'user_id': event['user_id'],
+            'phone_number': event['phone_number'],
+            'time': str(event['time']),
+            'days_of_week': event['days_of_week'],
+            'is_active': event['is_active'],
+            'message': event['message'],
+            'timestamp': datetime.now().isoformat(),
+        })
     except Exception as e:
-        logger.error(f"Error logging notification to DynamoDB: {e}")
-        raise
\ No newline at end of file
+        # The SMS has already been sent at this point, so never fail the send
+        logger.error("Error logging notification to DynamoDB: %s", e)
@@ -0,0 +1,70 @@
+from typing import AsyncIterator, List, Optional, Tuple, Union
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from app.config import settings
+from app.schemas import alarm_schemas
+
+# Whether the client asked for an NDJSON response
+def accepts_ndjson(request: Request) -> bool:
+    return "application/x-ndjson" in request.headers.get("accept", "")
+
+# Read the items of a bulk request, either a JSON list or an NDJSON stream read line by line
+async def read_bulk_items(request: Request) -> AsyncIterator[Union[bytes, dict]]:
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+        return
+
+    try:
+        items = await request.json()
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        raise HTTPException(status_code=422, detail="Expected a JSON list or an NDJSON stream of alarms")
+    for item in items:
+        yield item
+
+# Validate the alarms of a bulk request one by one
+# Returns the results list with an entry filled in for every invalid item (None for valid ones),
+# the valid alarms, and the request index of each valid alarm.
+async def parse_bulk_alarms(
+        request: Request
+    ) -> Tuple[List[Optional[alarm_schemas.AlarmBulkResult]], List[alarm_schemas.AlarmCreate], List[int]]:
+    results = []
+    alarm_creates = []
+    alarm_indexes = []
+    async for item in read_bulk_items(request):
+        index = len(results)
+        if index >= settings.alarm_bulk_max_items:
+            raise HTTPException(status_code=413, detail=f"At most {settings.alarm_bulk_max_items} alarms can be created at once")
+        try:
+            if isinstance(item, bytes):
+                alarm_create = alarm_schemas.AlarmCreate.model_validate_json(item)
+            else:
+                alarm_create = alarm_schemas.AlarmCreate.model_validate(item)
+        except ValidationError as e:
+            detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+            results.append(alarm_schemas.AlarmBulkResult(index=index, status_code=422, detail=detail))
+            continue
+        results.append(None)
+        alarm_creates.append(alarm_create)
+        alarm_indexes.append(index)
+    return results, alarm_creates, alarm_indexes
+
+# Place the results of the created alarms at their request index
+def merge_bulk_results(
+        results: List[Optional[alarm_schemas.AlarmBulkResult]],
+        created_results: List[alarm_schemas.AlarmBulkResult],
+        alarm_indexes: List[int]
+    ) -> List[alarm_schemas.AlarmBulkResult]:
+    for result, index in zip(created_results, alarm_indexes):
+        result.index = index
+        results[index] = result
+    return results
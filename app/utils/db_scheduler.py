@@ -0,0 +1,199 @@
+import threading
+from datetime import datetime, time as dt_time, timedelta
+from typing import Callable, List, Optional, Tuple
+import pytz
+from sqlalchemy import bindparam, select
+from app.db import models
+from app.db.database import SessionLocal, engine
+from app.schemas import alarm_schemas
+from app.utils.logger import logger
+from app.utils.metrics import scheduler_missed
+
+alarms_t = models.Alarm.__table__
+
+# Sets next_fire_at of one alarm per parameter set, leaving updated_at as it is
+set_next_fire_at = (
+    alarms_t.update()
+    .where(alarms_t.c.id == bindparam('alarm_id'))
+    .values(next_fire_at=bindparam('fire_at'), updated_at=alarms_t.c.updated_at)
+)
+
+# Claim up to `limit` active alarms due by `now` with their users' phone numbers, oldest first,
+# served by the index on next_fire_at
+def claim_due_alarms_query(now: datetime, limit: int):
+    return (
+        select(models.Alarm, models.User.phone_number)
+        .join(models.User, models.User.id == models.Alarm.user_id)
+        .where(models.Alarm.next_fire_at <= now, models.Alarm.is_active.is_(True))
+        .order_by(models.Alarm.next_fire_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True, of=models.Alarm)
+    )
+
+# First fire of an alarm strictly after `after`, in UTC, or None when it has no days
+def next_fire_time(alarm_time: dt_time, days_of_week: List[int], after: datetime, timezone: str) -> Optional[datetime]:
+    tz = pytz.timezone(timezone)
+    local_after = after.astimezone(tz)
+    for days_ahead in range(8):
+        day = local_after.date() + timedelta(days=days_ahead)
+        if day.weekday() not in days_of_week:
+            continue
+        fire_at = tz.localize(datetime.combine(day, alarm_time))
+        if fire_at > after:
+            return fire_at.astimezone(pytz.utc)
+    return None
+
+# Scheduler working directly on the alarms table through its next_fire_at column
+# Every poll claims up to `batch_size` due alarms with FOR UPDATE SKIP LOCKED and advances their
+# next_fire_at in the same transaction, so any number of workers can poll together and each fire
+# is claimed by exactly one of them. The claimed fires are handed to `fire_batch` only once the
+# transaction is committed, so no row locks are held while the dispatcher queue is full, and
+# delivery is at most once: fires of a failed commit are claimed again on the next poll and never
+# sent twice, fires `fire_batch` fails to hand over are lost (and logged).
+# Args:
+#   fire_batch: Called with (alarm, phone number, scheduled time) tuples of the claimed alarms.
+#   timezone: Timezone the alarm times are expressed in.
+#   batch_size: Alarms claimed per transaction.
+#   poll_interval_seconds: Wait between polls once no due alarms are left.
+#   misfire_grace_seconds: Fires later than this are skipped (and counted as missed) rather than sent.
+class DatabaseScheduler:
+    def __init__(
+        self,
+        fire_batch: Callable[[List[Tuple[alarm_schemas.Alarm, str, datetime]]], None],
+        timezone: str,
+        batch_size: int = 500,
+        poll_interval_seconds: float = 1.0,
+        misfire_grace_seconds: float = 60
+    ):
+        self._fire_batch = fire_batch
+        self._timezone = timezone
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval_seconds
+        self._misfire_grace = timedelta(seconds=misfire_grace_seconds)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Metrics
+        self.polls = 0
+        self.claimed = 0
+        self.missed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='db-scheduler', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Set next_fire_at of the given alarms from their days and time, in one statement
+    def schedule(self, alarms: List[alarm_schemas.Alarm]) -> None:
+        now = datetime.now(pytz.utc)
+        with engine.begin() as connection:
+            connection.execute(set_next_fire_at, [
+                {'alarm_id': alarm.id, 'fire_at': next_fire_time(alarm.time, alarm.days_of_week, now, self._timezone)}
+                for alarm in alarms
+            ])
+
+    # Clear next_fire_at of the given alarms, returns how many were scheduled
+    def unschedule(self, alarm_ids: List[int]) -> int:
+        with engine.begin() as connection:
+            return connection.execute(
+                alarms_t.update()
+                .where(alarms_t.c.id.in_(alarm_ids), alarms_t.c.next_fire_at.is_not(None))
+                .values(next_fire_at=None, updated_at=alarms_t.c.updated_at)
+            ).rowcount
+
+    # Set next_fire_at of the active alarms that have none, e.g. created before this backend was enabled
+    def backfill(self) -> int:
+        backfilled = 0
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(
+                    select(alarms_t.c.id, alarms_t.c.time, alarms_t.c.days_of_week)
+                    .where(alarms_t.c.is_active.is_(True), alarms_t.c.next_fire_at.is_(None))
+                    .limit(self._batch_size)
+                    .with_for_update(skip_locked=True)
+                ).all()
+                now = datetime.now(pytz.utc)
+                params = [
+                    {'alarm_id': row.id, 'fire_at': next_fire_time(row.time, row.days_of_week, now, self._timezone)}
+                    for row in rows
+                ]
+                # Alarms without any day never fire, they are left out so the loop ends
+                params = [param for param in params if param['fire_at'] is not None]
+                if params:
+                    connection.execute(set_next_fire_at, params)
+            backfilled += len(params)
+            if len(rows) < self._batch_size or not params:
+                break
+        if backfilled:
+            logger.info("Set next fire time of %s alarms", backfilled)
+        return backfilled
+
+    # Claim and advance one batch of due alarms, then fire them, returns how many were claimed
+    def poll(self) -> int:
+        now = datetime.now(pytz.utc)
+        db = SessionLocal()
+        try:
+            rows = db.execute(claim_due_alarms_query(now, self._batch_size)).all()
+            self.polls += 1
+            if not rows:
+                db.rollback()
+                return 0
+
+            due = []
+            params = []
+            for db_alarm, phone_number in rows:
+                alarm = alarm_schemas.Alarm.from_db(db_alarm)
+                scheduled_time = db_alarm.next_fire_at
+                if now - scheduled_time <= self._misfire_grace:
+                    due.append((alarm, phone_number, scheduled_time))
+                else:
+                    self.missed += 1
+                    scheduler_missed.inc('database')
+                    logger.warning("Skipped fire of alarm with ID %s scheduled at %s, past the misfire grace time", alarm.id, scheduled_time)
+                # Missed fires are coalesced, the next one is the first after now
+                params.append({'alarm_id': alarm.id, 'fire_at': next_fire_time(alarm.time, alarm.days_of_week, now, self._timezone)})
+
+            db.execute(set_next_fire_at, params)
+            db.commit()
+            self.claimed += len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        if due:
+            try:
+                self._fire_batch(due)
+            except Exception as e:
+                logger.error("Error firing %s claimed alarms, they are not sent: %s", len(due), e)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            'polls': self.polls,
+            'claimed': self.claimed,
+            'missed': self.missed,
+        }
+
+    # Poll back to back while full batches are claimed, then wait for the next interval
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                if self.poll() == self._batch_size:
+                    continue
+            except Exception as e:
+                logger.error("Error polling due alarms: %s", e)
+            self._stop_event.wait(self._poll_interval)
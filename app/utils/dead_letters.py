@@ -0,0 +1,120 @@
+import json
+import threading
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+import pytz
+from sqlalchemy import insert
+from app.db import models
+from app.db.database import engine
+from app.utils.logger import logger
+
+# Row of the dead-letter table for a given up send, the event is stored as plain JSON
+def dead_letter_row(event: dict, error_code: str, error_message: str, attempts: int) -> dict:
+    scheduled_time = event.get('scheduled_time')
+    return {
+        'alarm_id': event.get('id'),
+        'event': json.loads(json.dumps(event, default=str)),
+        'error_code': error_code,
+        'error_message': error_message,
+        'attempts': attempts,
+        'scheduled_time': datetime.fromtimestamp(scheduled_time, pytz.utc) if scheduled_time is not None else None,
+    }
+
+# Buffers given up sends and inserts them into the dead-letter table in batches from a background flusher
+# Batches that can't be written go back to the buffer for the next flush, rows beyond
+# `max_buffered` are dropped (and counted).
+# Args:
+#   batch_size: Flush as soon as this many rows are buffered, and rows per INSERT.
+#   flush_interval_ms: Flush at least this often while rows are buffered.
+#   max_buffered: Rows kept in memory while the database can't be written.
+class DeadLetterBuffer:
+    def __init__(self, batch_size: int = 100, flush_interval_ms: int = 1000, max_buffered: int = 10000):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval_ms / 1000
+        self._max_buffered = max_buffered
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Add a given up send, same signature as SendRetrier's dead_letter_func
+    def enqueue(self, event: dict, error_code: str, error_message: str, attempts: int) -> None:
+        row = dead_letter_row(event, error_code, error_message, attempts)
+        with self._lock:
+            if len(self._buffer) >= self._max_buffered:
+                self.dropped += 1
+                logger.error("Dead-letter buffer is full, dropping SMS notification for alarm with ID %s", event.get('id'))
+                return
+            self._buffer.append(row)
+            if len(self._buffer) >= self._batch_size:
+                self._wakeup.set()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='dead-letter-flusher', daemon=True)
+        self._thread.start()
+
+    # Stop the flusher and write out everything still buffered
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    # Write the buffered rows, stops at the first batch that can't be written
+    def flush(self) -> None:
+        while True:
+            batch = self._take(self._batch_size)
+            if not batch:
+                return
+            if not self._write(batch):
+                with self._lock:
+                    self._buffer.extendleft(reversed(batch))
+                return
+
+    def stats(self) -> dict:
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes,
+        }
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Unexpected error flushing dead letters: %s", e)
+
+    def _take(self, count: int) -> List[dict]:
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(count, len(self._buffer)))]
+
+    def _write(self, batch: List[dict]) -> bool:
+        try:
+            with engine.begin() as connection:
+                connection.execute(insert(models.SmsDeadLetter), batch)
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error("Error writing %s dead letters: %s", len(batch), e)
+            return False
@@ -0,0 +1,88 @@
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Deque
+
+# Local stand-in for the pinpoint-sms-voice-v2 client, used to benchmark sends offline
+# Every call sleeps for the configured latency to mimic the network round trip.
+# Args:
+#   latency_ms: Simulated latency of each API call in milliseconds.
+#   max_verified_numbers: Number of verified destination numbers the sandbox allows.
+#   max_tps: Sends accepted per second, more are rejected with a ThrottlingException, 0 for no limit.
+#   max_recent_messages: Number of the latest sent messages kept, so long benchmark runs don't grow memory.
+class FakePinpointSmsClient:
+    def __init__(self, latency_ms: float = 50, max_verified_numbers: int = 10, max_tps: float = 0, max_recent_messages: int = 1000):
+        self.latency = latency_ms / 1000
+        self.max_verified_numbers = max_verified_numbers
+        self.max_tps = max_tps
+        self.throttled = 0
+        self._second = [0, 0]  # [epoch second, sends]
+        self.sent = 0
+        self.sent_messages: Deque[dict] = deque(maxlen=max_recent_messages)
+        self.verified_numbers = {}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _throttle(self):
+        if self.max_tps <= 0:
+            return
+        now = int(time.time())
+        with self._lock:
+            if self._second[0] != now:
+                self._second = [now, 0]
+            if self._second[1] >= self.max_tps:
+                from botocore.exceptions import ClientError
+                self.throttled += 1
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'SendTextMessage')
+            self._second[1] += 1
+
+    def send_text_message(self, **kwargs) -> dict:
+        self._call()
+        self._throttle()
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self.sent += 1
+            self.sent_messages.append({'MessageId': message_id, **kwargs})
+        return {'MessageId': message_id}
+
+    def describe_verified_destination_numbers(self, MaxResults: int = 10, NextToken: str = None) -> dict:
+        self._call()
+        with self._lock:
+            numbers = list(self.verified_numbers.values())
+        start = int(NextToken or 0)
+        response = {'VerifiedDestinationNumbers': numbers[start:start + MaxResults]}
+        if start + MaxResults < len(numbers):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def create_verified_destination_number(self, DestinationPhoneNumber: str, **kwargs) -> dict:
+        self._call()
+        number_id = f"verified-{uuid.uuid4().hex}"
+        with self._lock:
+            self.verified_numbers[number_id] = {
+                'VerifiedDestinationNumberId': number_id,
+                'DestinationPhoneNumber': DestinationPhoneNumber,
+                'Status': 'PENDING'
+            }
+        return {'VerifiedDestinationNumberId': number_id, 'DestinationPhoneNumber': DestinationPhoneNumber, 'Status': 'PENDING'}
+
+    def send_destination_number_verification_code(self, VerifiedDestinationNumberId: str, **kwargs) -> dict:
+        self._call()
+        return {'MessageId': str(uuid.uuid4())}
+
+    def verify_destination_number(self, VerifiedDestinationNumberId: str, VerificationCode: str) -> dict:
+        self._call()
+        with self._lock:
+            number = self.verified_numbers[VerifiedDestinationNumberId]
+            number['Status'] = 'VERIFIED'
+        return dict(number)
+
+    def delete_verified_destination_number(self, VerifiedDestinationNumberId: str) -> dict:
+        self._call()
+        with self._lock:
+            number = self.verified_numbers.pop(VerifiedDestinationNumberId)
+        return dict(number)
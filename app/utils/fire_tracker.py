@@ -0,0 +1,179 @@
+import heapq
+import math
+import threading
+import time
+from array import array
+from datetime import datetime, time as dt_time, timedelta
+from typing import Dict, List, Optional, Tuple
+import pytz
+from app.config import settings
+from app.schemas.fire_lag_schemas import FireLagMinute, FireLagRecord, FireLagReport
+
+OUTCOMES = ('sent', 'failed', 'dropped')
+
+# Log-scale lag buckets from 1 ms growing 10% each, up to about an hour
+LAG_BUCKET_BASE_SECONDS = 0.001
+LAG_BUCKET_GROWTH = 1.1
+LAG_BUCKET_COUNT = 160
+
+def lag_bucket(lag: float) -> int:
+    if lag <= LAG_BUCKET_BASE_SECONDS:
+        return 0
+    return min(LAG_BUCKET_COUNT - 1, int(math.log(lag / LAG_BUCKET_BASE_SECONDS) / math.log(LAG_BUCKET_GROWTH)) + 1)
+
+def lag_bucket_bound(index: int) -> float:
+    return LAG_BUCKET_BASE_SECONDS * LAG_BUCKET_GROWTH ** index
+
+# Epoch second of the latest fire of an alarm at or before `now`
+# Used for fires whose scheduler doesn't pass the scheduled time along (APScheduler jobs).
+def last_scheduled_time(alarm_time: dt_time, days_of_week: List[int], now: Optional[float] = None, timezone: str = settings.timezone) -> int:
+    tz = pytz.timezone(timezone)
+    now = time.time() if now is None else now
+    local_now = datetime.fromtimestamp(now, tz)
+    for days_back in range(8):
+        day = local_now.date() - timedelta(days=days_back)
+        if day.weekday() not in days_of_week:
+            continue
+        scheduled = tz.localize(datetime.combine(day, alarm_time)).timestamp()
+        if scheduled <= now + 1:
+            return int(scheduled)
+    return int(now)
+
+# Lag stats of the fires scheduled within one minute
+class MinuteLag:
+    __slots__ = ('counts', 'outcomes', 'within_sla', 'max_lag', 'worst')
+
+    def __init__(self):
+        self.counts = array('l', bytes(LAG_BUCKET_COUNT * array('l').itemsize))
+        self.outcomes = [0] * len(OUTCOMES)
+        self.within_sla = 0
+        self.max_lag = 0.0
+        self.worst: List[Tuple[float, int, float, float, float, int]] = []  # Min-heap of the slowest fires
+
+    @property
+    def fires(self) -> int:
+        return sum(self.outcomes)
+
+    def percentile(self, p: float) -> float:
+        rank = max(1, math.ceil(self.fires * p))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(lag_bucket_bound(index), self.max_lag)
+        return self.max_lag
+
+# Records the scheduled, dequeue and send-complete time and outcome of every fire
+# The latest fires are kept in a fixed-size ring buffer of flat arrays, and each minute of
+# scheduled time is aggregated into a rolling store of lag histograms and slowest fires.
+# Args:
+#   ring_size: Number of fires kept in the ring buffer.
+#   retention_minutes: Minutes kept in the rolling store.
+#   sla_seconds: Lag counted as within the SLA.
+#   worst_per_minute: Slowest fires kept per minute.
+class FireTracker:
+    def __init__(self, ring_size: int = 100000, retention_minutes: int = 1440, sla_seconds: float = 60, worst_per_minute: int = 10):
+        self._ring_size = ring_size
+        self._retention_minutes = retention_minutes
+        self.sla_seconds = sla_seconds
+        self._worst_per_minute = worst_per_minute
+        self._alarm_ids = array('q', bytes(ring_size * 8))
+        self._scheduled = array('d', bytes(ring_size * 8))
+        self._dequeued = array('d', bytes(ring_size * 8))
+        self._completed = array('d', bytes(ring_size * 8))
+        self._outcomes = array('b', bytes(ring_size))
+        self._next = 0
+        self._count = 0
+        self._minutes: Dict[int, MinuteLag] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    # Record a fire, `dequeued_at` is None for fires dropped before reaching a worker
+    def record(self, alarm_id: int, scheduled_time: float, outcome: str, dequeued_at: Optional[float], completed_at: float) -> None:
+        outcome_index = OUTCOMES.index(outcome)
+        lag = max(0.0, completed_at - scheduled_time)
+        minute_key = int(scheduled_time // 60)
+        with self._lock:
+            index = self._next
+            self._alarm_ids[index] = alarm_id
+            self._scheduled[index] = scheduled_time
+            self._dequeued[index] = dequeued_at if dequeued_at is not None else math.nan
+            self._completed[index] = completed_at
+            self._outcomes[index] = outcome_index
+            self._next = (index + 1) % self._ring_size
+            self._count = min(self._count + 1, self._ring_size)
+
+            minute = self._minutes.get(minute_key)
+            if minute is None:
+                minute = self._minutes[minute_key] = MinuteLag()
+                self._expire(minute_key)
+            minute.counts[lag_bucket(lag)] += 1
+            minute.outcomes[outcome_index] += 1
+            minute.max_lag = max(minute.max_lag, lag)
+            if lag <= self.sla_seconds and outcome == 'sent':
+                minute.within_sla += 1
+            entry = (lag, alarm_id, scheduled_time, dequeued_at if dequeued_at is not None else math.nan, completed_at, outcome_index)
+            if len(minute.worst) < self._worst_per_minute:
+                heapq.heappush(minute.worst, entry)
+            elif lag > minute.worst[0][0]:
+                heapq.heapreplace(minute.worst, entry)
+
+    # The latest `limit` fires from the ring buffer, newest first
+    def recent(self, limit: int = 100) -> List[FireLagRecord]:
+        with self._lock:
+            indexes = [(self._next - 1 - i) % self._ring_size for i in range(min(limit, self._count))]
+            entries = [
+                (self._completed[i] - self._scheduled[i], self._alarm_ids[i], self._scheduled[i], self._dequeued[i], self._completed[i], self._outcomes[i])
+                for i in indexes
+            ]
+        return [self._to_record(entry) for entry in entries]
+
+    # Per-minute lag percentiles and the slowest fires of the last `minutes` minutes
+    def report(self, minutes: int = 60, worst: int = 20, now: Optional[float] = None) -> FireLagReport:
+        now = time.time() if now is None else now
+        first_minute = int(now // 60) - minutes + 1
+        with self._lock:
+            selected = sorted((key, minute) for key, minute in self._minutes.items() if key >= first_minute)
+            rows = [
+                FireLagMinute(
+                    minute=datetime.fromtimestamp(key * 60, pytz.utc),
+                    fires=minute.fires,
+                    sent=minute.outcomes[0],
+                    failed=minute.outcomes[1],
+                    dropped=minute.outcomes[2],
+                    within_sla=minute.within_sla,
+                    p50_ms=round(minute.percentile(0.50) * 1000, 1),
+                    p95_ms=round(minute.percentile(0.95) * 1000, 1),
+                    p99_ms=round(minute.percentile(0.99) * 1000, 1),
+                    max_ms=round(minute.max_lag * 1000, 1)
+                )
+                for key, minute in selected
+            ]
+            slowest = heapq.nlargest(worst, (entry for _, minute in selected for entry in minute.worst))
+        return FireLagReport(sla_seconds=self.sla_seconds, minutes=rows, worst=[self._to_record(entry) for entry in slowest])
+
+    def _expire(self, newest_minute: int) -> None:
+        oldest = newest_minute - self._retention_minutes
+        for key in [key for key in self._minutes if key <= oldest]:
+            del self._minutes[key]
+
+    @staticmethod
+    def _to_record(entry: Tuple[float, int, float, float, float, int]) -> FireLagRecord:
+        lag, alarm_id, scheduled, dequeued, completed, outcome_index = entry
+        dequeued = None if math.isnan(dequeued) else dequeued
+        return FireLagRecord(
+            alarm_id=alarm_id,
+            scheduled_time=datetime.fromtimestamp(scheduled, pytz.utc),
+            outcome=OUTCOMES[outcome_index],
+            lag_ms=round(max(0.0, lag) * 1000, 1),
+            dequeue_ms=round((dequeued - scheduled) * 1000, 1) if dequeued is not None else None,
+            send_ms=round((completed - dequeued) * 1000, 1) if dequeued is not None else None
+        )
+
+fire_tracker = FireTracker(
+    ring_size=settings.fire_tracker_ring_size,
+    retention_minutes=settings.fire_tracker_retention_minutes,
+    sla_seconds=settings.fire_lag_sla_seconds
+)
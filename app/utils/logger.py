@@ -1,10 +1,134 @@
-
+import atexit
+import json
 import logging
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Tuple
+from app.config import settings
+
+# Attributes every LogRecord has, anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+# One JSON object per line, with the `extra` fields of the record as top-level keys
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'site': f"{record.module}:{record.lineno}",
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Lets through at most `per_second` records per call site and second at `level` and below
+# The number of records dropped at a call site is added as `suppressed` to its next record.
+class CallSiteSampler(logging.Filter):
+    def __init__(self, per_second: int, level: int = logging.INFO):
+        super().__init__()
+        self._per_second = per_second
+        self._level = level
+        self._sites: Dict[Tuple[str, int], List[int]] = {}  # [second, emitted, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self._per_second <= 0 or record.levelno > self._level:
+            return True
+        second = int(record.created)
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None:
+                site = self._sites[(record.pathname, record.lineno)] = [second, 0, 0]
+            if site[0] != second:
+                if site[2]:
+                    record.suppressed = site[2]
+                site[0], site[1], site[2] = second, 0, 0
+            if site[1] >= self._per_second:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+# Queue handler that never blocks the logging thread
+# Records are queued as they are, so messages are only formatted by the listener thread,
+# and records are dropped (and counted) when the queue is full.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-# Set up logging
+# Counts events by outcome and logs one summary line per interval, instead of a line per event
+class OutcomeSummary:
+    def __init__(self, name: str, interval_seconds: float = 1.0):
+        self._name = name
+        self._interval = interval_seconds
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add(self, outcome: str, count: int = 1) -> None:
+        with self._lock:
+            self._counts[outcome] = self._counts.get(outcome, 0) + count
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='outcome-summary', daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        if counts:
+            logger.info(
+                "%s in the last %ss: %s", self._name, self._interval, ' '.join(f"{outcome}={count}" for outcome, count in sorted(counts.items())),
+                extra={'outcomes': counts, 'interval_seconds': self._interval}
+            )
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            self.flush()
+
+# Set up logging, records go through a bounded queue to a listener thread writing to stderr
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(settings.log_level.upper())
 handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+if settings.log_format == 'json':
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
-logger.addHandler(handler)
\ No newline at end of file
+
+log_queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=settings.log_queue_size))
+log_queue_handler.addFilter(CallSiteSampler(settings.log_sample_per_second))
+logger.addHandler(log_queue_handler)
+
+log_listener = QueueListener(log_queue_handler.queue, handler)
+log_listener.start()
+atexit.register(log_listener.stop)
@@ -0,0 +1,355 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from app.utils.logger import logger, log_queue_handler
+
+# Minimal Prometheus metrics, rendered in the text exposition format
+# Recording is a dict lookup plus a short critical section, cheap enough for every request and send.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 250)
+
+# Statements executed by the current request, set by MetricsMiddleware
+# Holds a one-item list so threadpool and greenlet code, which run in a copy of the context, add to the same count.
+request_statements: ContextVar[Optional[List[int]]] = ContextVar('request_statements', default=None)
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{escape_label_value(str(value))}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        pass
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+            for labelvalues, value in values
+        ]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # Per label values: non-cumulative bucket counts (the last one is +Inf) and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    # Observe `value`, `count` times at once for values shared by a batch
+    def observe(self, value: float, *labelvalues: str, count: int = 1) -> None:
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = ([0] * (len(self._buckets) + 1), [0.0])
+            entry[0][index] += count
+            entry[1][0] += value * count
+
+    # Time the block and observe its duration in seconds
+    @contextmanager
+    def time(self, *labelvalues: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(labelvalues, list(counts), total[0]) for labelvalues, (counts, total) in self._values.items()]
+        lines = self.header()
+        for labelvalues, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, ('le', format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+# Metric whose value is read when scraped, for values other components already keep
+# The callback returns a number, or a dict from label values tuple to number.
+class CallbackMetric(Metric):
+    def __init__(self, name: str, documentation: str, callback: Callable[[], object], type: str = 'gauge', labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self._callback = callback
+
+    def render(self) -> List[str]:
+        value = self._callback()
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        return self.header() + [
+            f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(sample)}"
+            for labelvalues, sample in values
+        ]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self._scrape = 0
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable[[], object], type: str = 'gauge', labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, type, labelnames))
+
+    # Wrap `func` so it runs at most once per scrape, for callbacks reading fields of one stats snapshot
+    def per_scrape(self, func: Callable[[], object]) -> Callable[[], object]:
+        lock = threading.Lock()
+        cached = [-1, None]  # (scrape, value)
+
+        def wrapper():
+            with lock:
+                if cached[0] != self._scrape:
+                    cached[1] = func()
+                    cached[0] = self._scrape
+                return cached[1]
+        return wrapper
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            self._scrape += 1
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # A failing callback must not break the whole scrape
+                continue
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+
+# Wrap `func` so it runs at most once every `seconds`, for callbacks too expensive for every scrape
+def cached_for(seconds: float, func: Callable[[], object]) -> Callable[[], object]:
+    lock = threading.Lock()
+    cached = [float('-inf'), None]  # (expiry time, value)
+
+    def wrapper():
+        with lock:
+            now = time.monotonic()
+            if now >= cached[0]:
+                cached[1] = func()
+                cached[0] = now + seconds
+            return cached[1]
+    return wrapper
+
+# HTTP
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route', 'status')
+)
+http_request_db_statements = registry.histogram(
+    'http_request_db_statements', 'SQL statements executed per HTTP request by route', ('method', 'route'), COUNT_BUCKETS
+)
+
+# Database
+db_query_duration = registry.histogram(
+    'db_query_duration_seconds', 'SQL statement execution time', ('engine',)
+)
+db_query_errors = registry.counter(
+    'db_query_errors_total', 'SQL statements that raised an error', ('engine',)
+)
+db_slow_queries = registry.counter(
+    'db_slow_queries_total', 'SQL statements slower than the slow query threshold', ('engine',)
+)
+db_pool_checkout_wait = registry.histogram(
+    'db_pool_checkout_wait_seconds', 'Time to check a connection out of the pool, including opening new ones', ('engine',)
+)
+db_pool_timeouts = registry.counter(
+    'db_pool_timeouts_total', 'Pool checkouts that timed out waiting for a connection', ('engine',)
+)
+
+# AWS
+aws_call_duration = registry.histogram(
+    'aws_call_duration_seconds', 'AWS API call latency', ('service', 'operation')
+)
+aws_call_errors = registry.counter(
+    'aws_call_errors_total', 'AWS API calls that raised an error', ('service', 'operation')
+)
+
+# Scheduler
+scheduler_fired = registry.counter(
+    'scheduler_fired_total', 'Alarms fired by the scheduler', ('backend',)
+)
+scheduler_missed = registry.counter(
+    'scheduler_missed_total', 'Alarm fires missed past the misfire grace time', ('backend',)
+)
+scheduler_fire_lag = registry.histogram(
+    'scheduler_fire_lag_seconds', 'Delay between the scheduled fire time and the alarm being fired', ('backend',), LAG_BUCKETS
+)
+
+# Engines by name, their pools are read when scraped
+instrumented_engines: Dict[str, object] = {}
+
+def pool_connections() -> dict:
+    values = {}
+    for name, engine in instrumented_engines.items():
+        pool = engine.pool
+        if not hasattr(pool, 'checkedout'):
+            continue
+        values[(name, 'checked_out')] = pool.checkedout()
+        values[(name, 'idle')] = pool.checkedin()
+        values[(name, 'overflow')] = max(0, pool.overflow())
+    return values
+
+registry.callback('db_pool_connections', 'Pooled connections by engine and state', pool_connections, labelnames=('engine', 'state'))
+
+# Logging
+registry.callback(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full', lambda: log_queue_handler.dropped, type='counter'
+)
+
+# Time an AWS call, counting the calls that raise
+@contextmanager
+def aws_call(service: str, operation: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        aws_call_errors.inc(service, operation)
+        raise
+    finally:
+        aws_call_duration.observe(time.perf_counter() - start, service, operation)
+
+# Wraps a boto3 client (or fake), timing every API call made through it
+class InstrumentedClient:
+    def __init__(self, client, service: str):
+        self._client = client
+        self._service = service
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with aws_call(self._service, name):
+                return attribute(*args, **kwargs)
+        return call
+
+# Pool class timing every checkout, so pool exhaustion shows up as wait time and timeouts
+def timed_pool_class(pool_class, name: str):
+    class TimedPool(pool_class):
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            except PoolTimeoutError:
+                db_pool_timeouts.inc(name)
+                raise
+            finally:
+                db_pool_checkout_wait.observe(time.perf_counter() - start, name)
+
+    TimedPool.__name__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+# Record the count and duration of every statement executed by the engine
+# Statements slower than `slow_query_seconds` are logged, 0 disables the slow query log.
+def instrument_engine(engine, name: str, slow_query_seconds: float = 0) -> None:
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+        statements = request_statements.get()
+        if statements is not None:
+            statements[0] += 1
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+        db_query_duration.observe(duration, name)
+        if slow_query_seconds and duration >= slow_query_seconds:
+            db_slow_queries.inc(name)
+            logger.warning("Slow query on %s engine (%.1f ms): %s", name, duration * 1000, ' '.join(statement.split())[:1000])
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        db_query_errors.inc(name)
+        starts = context.connection.info.get('query_start') if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    instrumented_engines[name] = engine
+
+# ASGI middleware recording the latency and SQL statement count of every HTTP request by route template
+# Pure ASGI rather than BaseHTTPMiddleware, so it adds no extra task per request.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = ['500']
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        start = time.perf_counter()
+        statements = [0]
+        token = request_statements.set(statements)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_statements.reset(token)
+            route = scope.get('route')
+            route_path = route.path if route is not None else 'unmatched'
+            http_request_duration.observe(time.perf_counter() - start, scope['method'], route_path, status[0])
+            http_request_db_statements.observe(statements[0], scope['method'], route_path)
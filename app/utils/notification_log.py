@@ -0,0 +1,211 @@
+import json
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+from app.utils.logger import logger
+from app.utils.metrics import aws_call
+
+# Buffers notification log records and writes them to DynamoDB in batches from a background flusher
+# The send path only appends to memory; batches that can't be written are spilled to a bounded
+# JSON lines file on disk and replayed once DynamoDB is reachable again. The spill file is moved
+# aside before it is replayed, so spilling never waits on DynamoDB, and lines that can't be parsed
+# (e.g. cut short by a crash) are skipped.
+# Args:
+#   table: DynamoDB Table the records are written to.
+#   batch_size: Flush as soon as this many records are buffered.
+#   flush_interval_ms: Flush at least this often while records are buffered.
+#   max_buffered: Records kept in memory before new ones go straight to the spill file.
+#   spill_path: File used to hold records during outages.
+#   max_spill_bytes: Size limit of the spill file, records beyond it are dropped.
+class NotificationLogBuffer:
+    def __init__(
+        self,
+        table,
+        batch_size: int = 100,
+        flush_interval_ms: int = 1000,
+        max_buffered: int = 10000,
+        spill_path: str = 'notification_log_spill.jsonl',
+        max_spill_bytes: int = 50 * 1024 * 1024
+    ):
+        self._table = table
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval_ms / 1000
+        self._max_buffered = max_buffered
+        self._spill_path = spill_path
+        self._replay_path = spill_path + '.replay'
+        self._max_spill_bytes = max_spill_bytes
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # Metrics
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self.corrupt_lines = 0
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Add a record without waiting on DynamoDB
+    def enqueue(self, item: dict) -> None:
+        with self._lock:
+            if len(self._buffer) < self._max_buffered:
+                self._buffer.append(item)
+                if len(self._buffer) >= self._batch_size:
+                    self._wakeup.set()
+                return
+        self._spill([item])
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='notification-log-flusher', daemon=True)
+        self._thread.start()
+
+    # Stop the flusher and write out everything still buffered
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    # Write everything buffered in memory, then replay the spill file if it succeeded
+    def flush(self) -> None:
+        while True:
+            batch = self._take(self._batch_size)
+            if not batch:
+                break
+            if not self._write(batch):
+                self._spill(batch + self._take(len(self._buffer)))
+                return
+        self._replay_spill()
+
+    def stats(self) -> dict:
+        return {
+            'buffered': len(self._buffer),
+            'written': self.written,
+            'spilled': self.spilled,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes,
+            'corrupt_lines': self.corrupt_lines,
+            'spill_bytes': self._spill_size() + self._file_size(self._replay_path),
+        }
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Unexpected error flushing notification logs: %s", e)
+
+    def _take(self, count: int) -> List[dict]:
+        with self._lock:
+            return [self._buffer.popleft() for _ in range(min(count, len(self._buffer)))]
+
+    def _write(self, batch: List[dict]) -> bool:
+        try:
+            with aws_call('dynamodb', 'batch_write_item'), self._table.batch_writer() as writer:
+                for item in batch:
+                    writer.put_item(Item=item)
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error("Error writing %s notification logs to DynamoDB: %s", len(batch), e)
+            return False
+
+    def _spill_size(self) -> int:
+        return self._file_size(self._spill_path)
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _spill(self, batch: List[dict]) -> None:
+        with self._spill_lock:
+            size = self._spill_size()
+            try:
+                with open(self._spill_path, 'a') as spill_file:
+                    for item in batch:
+                        line = json.dumps(item) + '\n'
+                        if size + len(line) > self._max_spill_bytes:
+                            self.dropped += 1
+                            continue
+                        spill_file.write(line)
+                        size += len(line)
+                        self.spilled += 1
+            except OSError as e:
+                self.dropped += len(batch)
+                logger.error("Error spilling %s notification logs to '%s': %s", len(batch), self._spill_path, e)
+
+    # Replay the spill file, only called from the flusher
+    # Under the spill lock the file is only renamed to the replay file, which is then read line by
+    # line and written in batches without the lock. If a batch fails, the lines from that batch on
+    # are kept in the replay file, which is replayed first on the next attempt.
+    def _replay_spill(self) -> None:
+        if not os.path.exists(self._replay_path):
+            with self._spill_lock:
+                if self._spill_size() == 0:
+                    return
+                try:
+                    os.replace(self._spill_path, self._replay_path)
+                except OSError as e:
+                    logger.error("Error moving notification log spill file '%s' aside: %s", self._spill_path, e)
+                    return
+
+        replayed = 0
+        try:
+            with open(self._replay_path, 'rb') as replay_file:
+                batch, batch_offset, offset = [], 0, 0
+                for line in replay_file:
+                    offset += len(line)
+                    if line.strip():
+                        try:
+                            batch.append(json.loads(line))
+                        except ValueError:
+                            self.corrupt_lines += 1
+                            logger.warning("Skipped corrupt line in notification log spill file '%s'", self._replay_path)
+                    if len(batch) >= self._batch_size:
+                        if not self._write(batch):
+                            self._keep_replay_tail(replay_file, batch_offset)
+                            return
+                        replayed += len(batch)
+                        batch, batch_offset = [], offset
+                if batch and not self._write(batch):
+                    self._keep_replay_tail(replay_file, batch_offset)
+                    return
+                replayed += len(batch)
+            os.remove(self._replay_path)
+        except OSError as e:
+            logger.error("Error replaying notification log spill file '%s': %s", self._replay_path, e)
+            return
+        logger.info("Replayed %s spilled notification logs to DynamoDB", replayed)
+
+    # Cut the replay file down to the lines from `offset` on, the ones not written yet
+    def _keep_replay_tail(self, replay_file, offset: int) -> None:
+        temp_path = self._replay_path + '.tmp'
+        replay_file.seek(offset)
+        with open(temp_path, 'wb') as temp_file:
+            shutil.copyfileobj(replay_file, temp_file)
+        os.replace(temp_path, self._replay_path)
@@ -0,0 +1,89 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+from app.config import settings
+from app.utils.aws_utils import send_pinpoint_sms_notification
+
+# How fired notifications leave the process, the dispatch workers call `send` once per fire
+# `send` raises on failure, so the dispatcher can retry it. Implementations are shared by every
+# dispatch worker and must be thread-safe.
+class NotificationTransport(ABC):
+    name = 'base'
+
+    @abstractmethod
+    def send(self, event: dict) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {'transport': self.name}
+
+# Sends through Pinpoint and logs the notification to DynamoDB
+class PinpointTransport(NotificationTransport):
+    name = 'pinpoint'
+
+    def send(self, event: dict) -> None:
+        send_pinpoint_sms_notification(event)
+
+# Keeps the latest sent notifications in memory, for local runs and offline tests
+# Args:
+#   max_messages: Notifications kept in memory, the oldest are discarded first.
+#   path: JSON lines file every notification is also appended to, if set.
+class LocalTransport(NotificationTransport):
+    name = 'local'
+
+    def __init__(self, max_messages: int = 1000, path: Optional[str] = None):
+        self._messages = deque(maxlen=max_messages)
+        self._path = path
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def send(self, event: dict) -> None:
+        message = {
+            'id': event.get('id'),
+            'phone_number': event.get('phone_number'),
+            'message': event.get('message'),
+            'sent_at': datetime.now().isoformat(),
+        }
+        with self._lock:
+            self._messages.append(message)
+            self.sent += 1
+            if self._path:
+                with open(self._path, 'a') as sink:
+                    sink.write(json.dumps(message) + '\n')
+
+    # The latest `limit` sent notifications, newest first
+    def messages(self, limit: int = 100) -> List[dict]:
+        with self._lock:
+            return list(self._messages)[::-1][:limit]
+
+    def stats(self) -> dict:
+        return {'transport': self.name, 'sent': self.sent, 'kept': len(self._messages)}
+
+# Discards every notification, to benchmark the scheduling and dispatch path without a network
+class NoopTransport(NotificationTransport):
+    name = 'noop'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def send(self, event: dict) -> None:
+        with self._lock:
+            self.sent += 1
+
+    def stats(self) -> dict:
+        return {'transport': self.name, 'sent': self.sent}
+
+def create_transport(name: str) -> NotificationTransport:
+    if name == 'pinpoint':
+        return PinpointTransport()
+    if name == 'local':
+        return LocalTransport(max_messages=settings.local_transport_max_messages, path=settings.local_transport_path)
+    if name == 'noop':
+        return NoopTransport()
+    raise ValueError(f"Unknown notification transport '{name}'")
+
+notification_transport = create_transport(settings.notification_transport)
@@ -0,0 +1,79 @@
+import select
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+import psycopg2
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from app.config import settings
+from app.utils.logger import logger
+
+# Statement sending a Postgres notification, delivered to listeners when the transaction commits
+def notify_statement(channel: str, payload: str):
+    return text("SELECT pg_notify(:channel, :payload)").bindparams(channel=channel, payload=payload)
+
+# Background listener for Postgres LISTEN/NOTIFY, used to share events between workers
+# Args:
+#   database_url: SQLAlchemy url of the database to listen on.
+#   reconnect_delay: Seconds to wait before reconnecting after the connection drops.
+class PgNotificationListener:
+    def __init__(self, database_url: str, reconnect_delay: float = 5.0):
+        self._dsn = make_url(database_url).set(drivername='postgresql').render_as_string(hide_password=False)
+        self._reconnect_delay = reconnect_delay
+        self._callbacks: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Call `callback` with the payload of every notification on `channel`
+    def subscribe(self, channel: str, callback: Callable[[str], None]) -> None:
+        self._callbacks[channel].append(callback)
+
+    def start(self) -> None:
+        if self.running or not self._callbacks:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='pg-listener', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error("Postgres notification listener disconnected: %s", e)
+                self._stop_event.wait(self._reconnect_delay)
+
+    def _listen(self) -> None:
+        connection = psycopg2.connect(self._dsn)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                for channel in self._callbacks:
+                    cursor.execute(f'LISTEN "{channel}"')
+            logger.info("Listening for Postgres notifications on %s", ', '.join(self._callbacks))
+
+            while not self._stop_event.is_set():
+                if select.select([connection], [], [], 1.0) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    for callback in self._callbacks.get(notification.channel, []):
+                        try:
+                            callback(notification.payload)
+                        except Exception as e:
+                            logger.error("Error handling notification on channel '%s': %s", notification.channel, e)
+        finally:
+            connection.close()
+
+pg_listener = PgNotificationListener(settings.database_url)
@@ -0,0 +1,82 @@
+import threading
+import time
+
+# Error codes AWS returns when a request is rejected for going over a rate limit
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling', 'RequestLimitExceeded'}
+
+# Whether an error raised by a boto3 client call is a throttling response
+def is_throttling_error(error: Exception) -> bool:
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+# Token bucket whose rate adapts to throttling responses
+# The rate is cut by `decrease_factor` on throttling (at most once per `cooldown_seconds`, so a
+# burst of throttled calls in flight counts once) and grows back by `recovery_per_second` every
+# second without throttling, up to the configured rate. Tokens are reserved under the lock and
+# waited for outside of it, so callers are served in the order they asked.
+# Args:
+#   rate_per_second: Maximum rate, 0 or less disables the limit.
+#   burst: Tokens that can be taken at once after an idle period.
+#   min_rate_per_second: Floor of the rate when it's cut on throttling.
+#   decrease_factor: Factor the rate is multiplied by on throttling.
+#   recovery_per_second: Rate regained per second without throttling.
+#   cooldown_seconds: Minimum time between two rate cuts.
+class AdaptiveTokenBucket:
+    def __init__(
+        self,
+        rate_per_second: float,
+        burst: int = 1,
+        min_rate_per_second: float = 1.0,
+        decrease_factor: float = 0.5,
+        recovery_per_second: float = 1.0,
+        cooldown_seconds: float = 1.0
+    ):
+        self.max_rate = rate_per_second
+        self.rate = rate_per_second
+        self._burst = max(1, burst)
+        self._min_rate = min(min_rate_per_second, rate_per_second)
+        self._decrease_factor = decrease_factor
+        self._recovery = recovery_per_second
+        self._cooldown = cooldown_seconds
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+        self._last_cut = float('-inf')
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+    # Take a token, waiting until one is available, returns the seconds waited
+    def acquire(self) -> float:
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    # Report a throttling response, cuts the rate and drains the bucket
+    def throttled(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now - self._last_cut < self._cooldown:
+                return
+            self._last_cut = now
+            self.rate = max(self._min_rate, self.rate * self._decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rate < self.max_rate and now - self._last_cut >= self._cooldown:
+            self.rate = min(self.max_rate, self.rate + self._recovery * elapsed)
+        self._tokens = min(float(self._burst), self._tokens + elapsed * self.rate)
@@ -0,0 +1,232 @@
+import pickle
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Set, Tuple
+from apscheduler.util import obj_to_ref
+from sqlalchemy import String, and_, case, cast, func, insert, literal, select, update
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.db import models
+from app.db.database import SessionLocal, engine
+from app.schemas import alarm_schemas
+from app.schemas.reconcile_schemas import ReconcileReport
+from app.utils import scheduler as alarm_scheduler
+from app.utils.logger import logger
+
+SAMPLE_SIZE = 20
+
+# Key of the Postgres advisory lock held while reconciling, so only one process reconciles at a time
+RECONCILE_LOCK_KEY = 7300421
+
+# Raised when another process holds the reconcile lock
+class ReconcileInProgressError(Exception):
+    pass
+
+# Job id each alarm should have, computed in SQL
+expected_job_id = literal(alarm_scheduler.JOB_ID_PREFIX, String) + cast(models.Alarm.id, String)
+expected_sms_job_id = case((models.Alarm.is_active.is_(True), expected_job_id), else_=None)
+
+@contextmanager
+def timed(timings: Dict[str, float], name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 2)
+
+# Diff active alarms against the APScheduler jobstore table with set-based SQL
+# Returns the alarm ids missing a job, the orphan job ids and the number of scheduled jobs.
+def diff_jobstore(db: Session) -> Tuple[List[int], List[str], int]:
+    jobs_t = alarm_scheduler.jobstores['default'].jobs_t
+    missing_alarm_ids = db.execute(
+        select(models.Alarm.id)
+        .outerjoin(jobs_t, jobs_t.c.id == expected_job_id)
+        .where(models.Alarm.is_active.is_(True), jobs_t.c.id.is_(None))
+    ).scalars().all()
+    orphan_job_ids = db.execute(
+        select(jobs_t.c.id)
+        .outerjoin(models.Alarm, and_(expected_job_id == jobs_t.c.id, models.Alarm.is_active.is_(True)))
+        .where(jobs_t.c.id.like(f"{alarm_scheduler.JOB_ID_PREFIX}%"), models.Alarm.id.is_(None))
+    ).scalars().all()
+    scheduled_jobs = db.execute(select(func.count()).select_from(jobs_t)).scalar()
+    return missing_alarm_ids, orphan_job_ids, scheduled_jobs
+
+# Active alarms whose jobstore job calls another function than scheduler.fire_alarm
+# Jobs created before jobs only carried the alarm id call aws_utils.send_pinpoint_sms_notification
+# with a pickled event, bypassing the dispatcher, and are rescheduled as fire_alarm(alarm_id).
+# The job function is only stored in the pickled job state, so each job is unpickled.
+def diff_legacy_jobs(db: Session) -> List[int]:
+    jobs_t = alarm_scheduler.jobstores['default'].jobs_t
+    fire_alarm_ref = obj_to_ref(alarm_scheduler.fire_alarm)
+    result = db.execute(
+        select(models.Alarm.id, jobs_t.c.job_state)
+        .join(jobs_t, jobs_t.c.id == expected_job_id)
+        .where(models.Alarm.is_active.is_(True))
+        .execution_options(yield_per=1000)
+    )
+    return [alarm_id for alarm_id, job_state in result if pickle.loads(job_state).get('func') != fire_alarm_ref]
+
+# Diff active alarms against the in-memory timing wheel
+# With the sharded scheduler, only the alarms of the shards this worker owns are compared.
+def diff_timing_wheel(db: Session) -> Tuple[List[int], List[str], int]:
+    query = select(models.Alarm.id).where(models.Alarm.is_active.is_(True))
+    shard_leases = alarm_scheduler.shard_leases
+    if shard_leases is not None:
+        query = query.where((models.Alarm.id % shard_leases.shard_count).in_(sorted(shard_leases.owned_shards)))
+    active_alarm_ids: Set[int] = set(db.execute(query).scalars())
+    scheduled_alarm_ids = set(alarm_scheduler.timing_wheel.alarm_ids())
+    missing_alarm_ids = sorted(active_alarm_ids - scheduled_alarm_ids)
+    orphan_job_ids = [alarm_scheduler.get_job_id(alarm_id) for alarm_id in sorted(scheduled_alarm_ids - active_alarm_ids)]
+    return missing_alarm_ids, orphan_job_ids, len(scheduled_alarm_ids)
+
+# Diff active alarms against the next_fire_at column of the database scheduler
+# Active alarms without a next fire time are missing, inactive alarms with one are orphans.
+def diff_next_fire_at(db: Session) -> Tuple[List[int], List[str], int]:
+    scheduled = models.Alarm.next_fire_at.is_not(None)
+    missing_alarm_ids = db.execute(
+        select(models.Alarm.id).where(models.Alarm.is_active.is_(True), models.Alarm.next_fire_at.is_(None))
+    ).scalars().all()
+    orphan_alarm_ids = db.execute(
+        select(models.Alarm.id).where(models.Alarm.is_active.is_not(True), scheduled)
+    ).scalars().all()
+    scheduled_jobs = db.execute(select(func.count()).select_from(models.Alarm).where(scheduled)).scalar()
+    return missing_alarm_ids, [alarm_scheduler.get_job_id(alarm_id) for alarm_id in orphan_alarm_ids], scheduled_jobs
+
+# Create missing alarm_jobs rows and fix sms_job_id values that don't match the alarm
+# Returns the number of created and updated rows (the number that would be, in a dry run).
+def fix_alarm_jobs(db: Session, dry_run: bool) -> Tuple[int, int]:
+    missing_rows = (
+        select(models.Alarm.id, expected_sms_job_id)
+        .outerjoin(models.AlarmJob, models.AlarmJob.alarm_id == models.Alarm.id)
+        .where(models.AlarmJob.id.is_(None))
+    )
+    mismatch = and_(
+        models.AlarmJob.alarm_id == models.Alarm.id,
+        models.AlarmJob.sms_job_id.is_distinct_from(expected_sms_job_id)
+    )
+
+    if dry_run:
+        created = db.execute(select(func.count()).select_from(missing_rows.subquery())).scalar()
+        updated = db.execute(select(func.count()).select_from(models.AlarmJob).join(models.Alarm, mismatch)).scalar()
+        return created, updated
+
+    created = db.execute(
+        insert(models.AlarmJob).from_select(['alarm_id', 'sms_job_id'], missing_rows)
+    ).rowcount
+    updated = db.execute(
+        update(models.AlarmJob)
+        .where(mismatch)
+        .values(sms_job_id=expected_sms_job_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return created, updated
+
+# Schedule the alarms missing a job, in batches
+def schedule_missing(db: Session, alarm_ids: List[int], batch_size: int) -> None:
+    for start in range(0, len(alarm_ids), batch_size):
+        result = db.execute(
+            select(models.Alarm, models.User.phone_number)
+            .join(models.User, models.User.id == models.Alarm.user_id)
+            .where(models.Alarm.id.in_(alarm_ids[start:start + batch_size]))
+        )
+        alarm_scheduler.schedule_alarms([
+            (alarm_schemas.Alarm.from_db(db_alarm), phone_number)
+            for db_alarm, phone_number in result
+        ])
+
+# Hold the reconcile advisory lock, if no other process holds it
+# The lock is taken on a dedicated connection, since the session returns its connection to the
+# pool on commit, and is released before the connection goes back to the pool. Yields whether it
+# was acquired.
+@contextmanager
+def reconcile_lock() -> Iterator[bool]:
+    with engine.connect() as conn:
+        acquired = conn.execute(select(func.pg_try_advisory_lock(RECONCILE_LOCK_KEY))).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                conn.execute(select(func.pg_advisory_unlock(RECONCILE_LOCK_KEY)))
+                conn.commit()
+
+# Reconcile on startup, in only one process
+# Processes starting while another one reconciles skip it, the alarms, alarm_jobs and scheduler
+# state they share is fixed by that process. Timing wheels are rebuilt from the database on startup.
+def reconcile_on_startup() -> None:
+    try:
+        reconcile()
+    except ReconcileInProgressError:
+        logger.info("Skipping startup reconciliation, another process is reconciling")
+
+# Reconcile alarms, alarm_jobs and the scheduler
+# Raises ReconcileInProgressError when another process is reconciling, see reconcile_lock.
+# Adds the jobs of active alarms that aren't scheduled, removes jobs whose alarm is gone or
+# inactive and fixes alarm_jobs rows, all in batches. A dry run only reports what would change.
+def reconcile(dry_run: bool = False, batch_size: int = None) -> ReconcileReport:
+    batch_size = batch_size or settings.reconcile_batch_size
+    if dry_run:
+        return run_reconcile(dry_run, batch_size)
+    with reconcile_lock() as acquired:
+        if not acquired:
+            raise ReconcileInProgressError()
+        return run_reconcile(dry_run, batch_size)
+
+# Reconcile without the lock, see reconcile
+def run_reconcile(dry_run: bool, batch_size: int) -> ReconcileReport:
+    timings: Dict[str, float] = {}
+    legacy_alarm_ids: List[int] = []
+    db = SessionLocal()
+    try:
+        with timed(timings, 'total'):
+            with timed(timings, 'diff'):
+                if alarm_scheduler.timing_wheel is not None:
+                    missing_alarm_ids, orphan_job_ids, scheduled_jobs = diff_timing_wheel(db)
+                elif alarm_scheduler.db_scheduler is not None:
+                    missing_alarm_ids, orphan_job_ids, scheduled_jobs = diff_next_fire_at(db)
+                else:
+                    missing_alarm_ids, orphan_job_ids, scheduled_jobs = diff_jobstore(db)
+                    legacy_alarm_ids = diff_legacy_jobs(db)
+                active_alarms = db.execute(
+                    select(func.count()).select_from(models.Alarm).where(models.Alarm.is_active.is_(True))
+                ).scalar()
+
+            with timed(timings, 'alarm_jobs'):
+                alarm_jobs_created, alarm_jobs_updated = fix_alarm_jobs(db, dry_run)
+                if not dry_run:
+                    db.commit()
+
+            if not dry_run:
+                with timed(timings, 'schedule_missing'):
+                    schedule_missing(db, missing_alarm_ids, batch_size)
+                with timed(timings, 'reschedule_legacy'):
+                    schedule_missing(db, legacy_alarm_ids, batch_size)
+                with timed(timings, 'remove_orphans'):
+                    for start in range(0, len(orphan_job_ids), batch_size):
+                        alarm_scheduler.unschedule_alarms(orphan_job_ids[start:start + batch_size])
+
+        report = ReconcileReport(
+            dry_run=dry_run,
+            active_alarms=active_alarms,
+            scheduled_jobs=scheduled_jobs,
+            missing_jobs=len(missing_alarm_ids),
+            orphan_jobs=len(orphan_job_ids),
+            legacy_jobs=len(legacy_alarm_ids),
+            alarm_jobs_created=alarm_jobs_created,
+            alarm_jobs_updated=alarm_jobs_updated,
+            sample_missing_job_ids=[alarm_scheduler.get_job_id(alarm_id) for alarm_id in missing_alarm_ids[:SAMPLE_SIZE]],
+            sample_orphan_job_ids=orphan_job_ids[:SAMPLE_SIZE],
+            timings_ms=timings
+        )
+        logger.info(
+            "Reconciliation %sfinished in %s ms: %s missing jobs, %s orphan jobs, %s legacy jobs, "
+            "%s alarm jobs created, %s alarm jobs updated",
+            'dry run ' if dry_run else '', timings['total'], report.missing_jobs, report.orphan_jobs,
+            report.legacy_jobs, alarm_jobs_created, alarm_jobs_updated
+        )
+        return report
+    except Exception as e:
+        db.rollback()
+        logger.error("Error reconciling alarms with the scheduler: %s", e)
+        raise
+    finally:
+        db.close()
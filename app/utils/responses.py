@@ -0,0 +1,41 @@
+from typing import Dict, List, Optional
+from fastapi import Request
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+from app.schemas import alarm_schemas, user_schemas
+
+# Serializers of the response models of the user and alarm routes, built once
+user_adapter = TypeAdapter(user_schemas.User)
+alarm_adapter = TypeAdapter(alarm_schemas.Alarm)
+alarm_bulk_results_adapter = TypeAdapter(List[alarm_schemas.AlarmBulkResult])
+
+# JSON response of schema objects a route already built, serialized once by pydantic-core
+# FastAPI validates whatever a route returns against its response_model again before serializing
+# it, a Response is sent as it is and the response_model only documents the route.
+def schema_response(adapter: TypeAdapter, content, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(content=adapter.dump_json(content), status_code=status_code, headers=headers, media_type='application/json')
+
+# Clients may keep responses carrying an ETag, but have to revalidate them on every use
+ETAG_CACHE_CONTROL = 'no-cache'
+
+# Weak ETag of a read of a user or its alarms, from the user's version and what selects the
+# representation (pagination, format). The version changes with every change of the user or its
+# alarms, so the ETag can be checked without loading them.
+def user_etag(kind: str, user_id: int, version: int, *variant) -> str:
+    return 'W/"' + '-'.join('' if part is None else str(part) for part in (kind, user_id, version, *variant)) + '"'
+
+# Whether the If-None-Match header of the request matches the ETag, with the weak comparison
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque_tag = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == opaque_tag for tag in if_none_match.split(','))
+
+def etag_headers(etag: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    return {**(headers or {}), 'ETag': etag, 'Cache-Control': ETAG_CACHE_CONTROL}
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers=etag_headers(etag))
@@ -1,17 +1,223 @@
+import json
+import pickle
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+import pytz
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.job import Job
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.util import datetime_to_utc_timestamp
+from sqlalchemy import func, select
 from app.schemas import alarm_schemas
 from app.config import settings
+from app.db import models
+from app.db.database import SessionLocal, engine
 from app.utils.constants import DAY_OF_WEEK_MAP
 from app.utils.logger import logger
-from app.utils.aws_utils import send_pinpoint_sms_notification
+from app.utils.aws_utils import notification_log_buffer
+from app.utils.sms_dispatcher import sms_dispatcher, dead_letter_buffer
+from app.utils.alarm_payloads import alarm_payload_cache, build_event
+from app.utils.timing_wheel import TimingWheel
+from app.utils.shard_leases import ShardLeaseManager
+from app.utils.db_scheduler import DatabaseScheduler
+from app.utils.pg_listener import pg_listener, notify_statement
+from app.utils.metrics import registry, cached_for, scheduler_fired, scheduler_missed, scheduler_fire_lag
+from app.utils.fire_tracker import last_scheduled_time
 
-# APScheduler setup
-jobstores = {
-    'default': SQLAlchemyJobStore(url=settings.database_url)
+JOB_ID_PREFIX = 'alarm_sms_'
+
+# Channel used to hand alarm changes to the worker owning the alarm's shard
+ALARM_CHANGES_CHANNEL = 'scheduler_alarm_changes'
+
+# Alarm ids per notification, keeps payloads under the Postgres 8000 byte limit
+ALARM_CHANGES_BATCH_SIZE = 500
+
+# APScheduler defaults, also used for jobs written to the jobstore in batches
+JOB_DEFAULTS = {
+    'misfire_grace_time': 1,
+    'coalesce': True,
+    'max_instances': 1
 }
-scheduler = BackgroundScheduler(jobstores=jobstores)
+
+# APScheduler job function, jobs only carry the alarm id and the event is looked up when it fires
+# APScheduler doesn't pass the scheduled time, so it is derived from the alarm's days and time.
+def fire_alarm(alarm_id: int):
+    event = alarm_payload_cache.get(alarm_id)
+    if event is None:
+        logger.warning("No event found for alarm with ID %s", alarm_id)
+        return
+    sms_dispatcher.submit({**event, 'scheduled_time': last_scheduled_time(event['time'], event['days_of_week'])})
+
+# Fire all alarms of a timing wheel bucket, looking up missing events in a single query
+def fire_wheel_bucket(scheduled_time: int, alarm_ids: List[int]):
+    scheduler_fired.inc(settings.scheduler_backend, amount=len(alarm_ids))
+    scheduler_fire_lag.observe(max(0.0, time.time() - scheduled_time), settings.scheduler_backend, count=len(alarm_ids))
+    events = alarm_payload_cache.get_many(alarm_ids)
+    for alarm_id in alarm_ids:
+        event = events.get(alarm_id)
+        if event is None:
+            logger.warning("No event found for alarm with ID %s", alarm_id)
+            continue
+        sms_dispatcher.submit({**event, 'scheduled_time': scheduled_time})
+
+# Fire the alarms claimed by the database scheduler, once its claiming transaction is committed
+def fire_due_alarms(due: List[Tuple[alarm_schemas.Alarm, str, datetime]]):
+    now = time.time()
+    scheduler_fired.inc('database', amount=len(due))
+    for alarm, phone_number, scheduled_at in due:
+        scheduled_time = int(scheduled_at.timestamp())
+        scheduler_fire_lag.observe(max(0.0, now - scheduled_time), 'database')
+        sms_dispatcher.submit({**build_event(alarm, phone_number), 'scheduled_time': scheduled_time})
+
+# Load the active alarms of a shard into the timing wheel once its lease is claimed
+# Alarms the previous owner didn't fire since `fired_through` are fired on the next tick.
+def load_shard(shard_id: int, fired_through: Optional[int]):
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(models.Alarm, models.User.phone_number)
+            .join(models.User, models.User.id == models.Alarm.user_id)
+            .filter(models.Alarm.is_active.is_(True), models.Alarm.id % shard_leases.shard_count == shard_id)
+            .execution_options(yield_per=1000)
+        )
+        alarm_ids = set()
+        for db_alarm, phone_number in result:
+            alarm = alarm_schemas.Alarm.from_db(db_alarm)
+            alarm_payload_cache.put(build_event(alarm, phone_number))
+            timing_wheel.add(alarm.id, alarm.days_of_week, alarm.time)
+            alarm_ids.add(alarm.id)
+        if fired_through is not None and alarm_ids:
+            timing_wheel.catch_up(alarm_ids, fired_through + 1)
+        logger.info("Loaded %s alarms of scheduler shard %s", len(alarm_ids), shard_id)
+    finally:
+        db.close()
+
+# Remove the alarms of a shard from the timing wheel once its lease is released or lost
+def unload_shard(shard_id: int):
+    for alarm_id in timing_wheel.alarm_ids():
+        if shard_leases.shard_for(alarm_id) == shard_id:
+            timing_wheel.remove(alarm_id)
+            alarm_payload_cache.remove(alarm_id)
+
+# Tell the workers owning the alarms' shards to add (reloading from the database) or remove them
+def publish_alarm_changes(op: str, alarm_ids: List[int]):
+    with engine.begin() as connection:
+        for start in range(0, len(alarm_ids), ALARM_CHANGES_BATCH_SIZE):
+            payload = json.dumps({
+                'worker': shard_leases.worker_id,
+                'op': op,
+                'ids': alarm_ids[start:start + ALARM_CHANGES_BATCH_SIZE]
+            })
+            connection.execute(notify_statement(ALARM_CHANGES_CHANNEL, payload))
+
+# Apply alarm changes published by other workers to the owned shards
+def handle_alarm_changes(payload: str):
+    change = json.loads(payload)
+    if change['worker'] == shard_leases.worker_id:
+        return
+    alarm_ids = [alarm_id for alarm_id in change['ids'] if shard_leases.owns(alarm_id)]
+    for alarm_id in alarm_ids:
+        alarm_payload_cache.remove(alarm_id)
+    if change['op'] == 'remove':
+        for alarm_id in alarm_ids:
+            timing_wheel.remove(alarm_id)
+        return
+
+    events = alarm_payload_cache.get_many(alarm_ids) if alarm_ids else {}
+    for alarm_id in alarm_ids:
+        event = events.get(alarm_id)
+        if event is None:
+            timing_wheel.remove(alarm_id)
+        else:
+            timing_wheel.add(alarm_id, event['days_of_week'], event['time'])
+
+# Scheduler setup, APScheduler by default, the in-memory timing wheel, timing wheels
+# sharded across workers through lease rows, or polling the alarms table directly
+scheduler = None
+timing_wheel = None
+shard_leases = None
+db_scheduler = None
+if settings.scheduler_backend in ('timing_wheel', 'sharded'):
+    timing_wheel = TimingWheel(fire_bucket=fire_wheel_bucket, timezone=settings.timezone)
+    if settings.scheduler_backend == 'sharded':
+        shard_leases = ShardLeaseManager(
+            shard_count=settings.scheduler_shard_count,
+            on_acquire=load_shard,
+            on_release=unload_shard,
+            fired_through=lambda: timing_wheel.last_tick,
+            lease_ttl_seconds=settings.scheduler_lease_ttl_seconds,
+            renew_interval_seconds=settings.scheduler_lease_renew_seconds
+        )
+        pg_listener.subscribe(ALARM_CHANGES_CHANNEL, handle_alarm_changes)
+elif settings.scheduler_backend == 'database':
+    db_scheduler = DatabaseScheduler(
+        fire_batch=fire_due_alarms,
+        timezone=settings.timezone,
+        batch_size=settings.scheduler_db_batch_size,
+        poll_interval_seconds=settings.scheduler_db_poll_seconds,
+        misfire_grace_seconds=settings.scheduler_db_misfire_grace_seconds
+    )
+else:
+    jobstores = {
+        'default': SQLAlchemyJobStore(url=settings.database_url)
+    }
+    scheduler = BackgroundScheduler(jobstores=jobstores, job_defaults=JOB_DEFAULTS)
+
+# Record fires and misses of APScheduler jobs for the metrics endpoint
+def record_job_event(event):
+    if event.code == EVENT_JOB_MISSED:
+        scheduler_missed.inc('apscheduler')
+        return
+    scheduler_fired.inc('apscheduler')
+    for scheduled_run_time in event.scheduled_run_times:
+        scheduler_fire_lag.observe(max(0.0, time.time() - scheduled_run_time.timestamp()), 'apscheduler')
+
+# Number of scheduled alarms, counted in the jobstore table with APScheduler
+# Counting scans the table, so scrapes reuse the count for METRICS_SCHEDULED_JOBS_CACHE_SECONDS.
+def count_scheduled_jobs() -> dict:
+    if timing_wheel is not None:
+        return {(settings.scheduler_backend,): len(timing_wheel)}
+    if db_scheduler is not None:
+        with engine.connect() as connection:
+            return {('database',): connection.execute(
+                select(func.count()).select_from(models.Alarm).where(models.Alarm.next_fire_at.is_not(None))
+            ).scalar()}
+    jobstore = jobstores['default']
+    with jobstore.engine.connect() as connection:
+        return {('apscheduler',): connection.execute(select(func.count()).select_from(jobstore.jobs_t)).scalar()}
+
+if scheduler is not None:
+    scheduler.add_listener(record_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+registry.callback(
+    'scheduler_jobs',
+    'Alarms currently scheduled',
+    cached_for(settings.metrics_scheduled_jobs_cache_seconds, count_scheduled_jobs),
+    labelnames=('backend',)
+)
+
+def get_job_id(alarm_id: int) -> str:
+    return f"{JOB_ID_PREFIX}{alarm_id}"
+
+def get_alarm_id(job_id: str) -> int:
+    return int(job_id[len(JOB_ID_PREFIX):])
+
+# Whether this worker fires the alarm, always true unless the scheduler is sharded
+def is_local(alarm_id: int) -> bool:
+    return shard_leases is None or shard_leases.owns(alarm_id)
+
+# Create the CronTrigger with the correct day and time
+def build_trigger(alarm: alarm_schemas.Alarm) -> CronTrigger:
+    day_of_week_str = ','.join(DAY_OF_WEEK_MAP[day] for day in alarm.days_of_week)
+    return CronTrigger(
+        day_of_week=day_of_week_str,
+        hour=alarm.time.hour,
+        minute=alarm.time.minute,
+        second=alarm.time.second,
+        timezone=settings.timezone
+    )
 
 # Schedule alarm to be sent at the specified time through sms
 # Args:
@@ -21,52 +227,221 @@ def schedule_alarm(
     alarm: alarm_schemas.Alarm,
     phone_number: str
 ):
-    # Create the CronTrigger with the correct day and time
-    day_of_week_str = ','.join(DAY_OF_WEEK_MAP[day] for day in alarm.days_of_week)
-    trigger = CronTrigger(
-        day_of_week=day_of_week_str, 
-        hour=alarm.time.hour, 
-        minute=alarm.time.minute,
-        second=alarm.time.second,
-        timezone=settings.timezone
-    )
-    
-    # Create the event dictionary
-    event = {
-        'phone_number': phone_number,
-        **alarm.model_dump()
-    }
-    
+    job_id = get_job_id(alarm.id)
+    alarm_payload_cache.put(build_event(alarm, phone_number))
+
+    # Add the alarm to the timing wheel, it shares its trigger with alarms of the same pattern
+    # Alarms of shards owned by other workers are handed to them.
+    if timing_wheel is not None:
+        try:
+            if is_local(alarm.id):
+                timing_wheel.add(alarm.id, alarm.days_of_week, alarm.time)
+            else:
+                publish_alarm_changes('add', [alarm.id])
+            logger.info("Successfully scheduled job with ID %s", job_id)
+        except Exception as e:
+            logger.error("Error scheduling job with ID %s: %s", job_id, e)
+            raise
+        return job_id
+
+    # Set the alarm's next fire time, the database scheduler claims it once due
+    if db_scheduler is not None:
+        try:
+            db_scheduler.schedule([alarm])
+            logger.info("Successfully scheduled job with ID %s", job_id)
+        except Exception as e:
+            logger.error("Error scheduling job with ID %s: %s", job_id, e)
+            raise
+        return job_id
+
     # Schedule the send notification function using APScheduler
     try:
-        job_id = f"alarm_sms_{alarm.id}"
         scheduler.add_job(
-            func=send_pinpoint_sms_notification,
-            args=[event],
-            trigger=trigger,
+            func=fire_alarm,
+            args=[alarm.id],
+            trigger=build_trigger(alarm),
             id=job_id,
             replace_existing=True
         )
-        logger.info(f"Successfully scheduled job with ID {job_id}")
+        logger.info("Successfully scheduled job with ID %s", job_id)
     except Exception as e:
-        logger.error(f"Error scheduling job with ID {job_id}: {e}")
+        logger.error("Error scheduling job with ID %s: %s", job_id, e)
         raise
 
     return job_id
 
+# Schedule many alarms in one batch
+# With APScheduler, all jobs are written to the jobstore in a single transaction
+# instead of one insert and commit per job.
+# Args:
+#   alarms: Tuples of (alarm, phone number) to schedule.
+def schedule_alarms(alarms: List[Tuple[alarm_schemas.Alarm, str]]) -> List[str]:
+    job_ids = [get_job_id(alarm.id) for alarm, _ in alarms]
+    if not alarms:
+        return job_ids
+
+    try:
+        if timing_wheel is not None:
+            remote_alarm_ids = []
+            for alarm, phone_number in alarms:
+                if is_local(alarm.id):
+                    alarm_payload_cache.put(build_event(alarm, phone_number))
+                    timing_wheel.add(alarm.id, alarm.days_of_week, alarm.time)
+                else:
+                    remote_alarm_ids.append(alarm.id)
+            if remote_alarm_ids:
+                publish_alarm_changes('add', remote_alarm_ids)
+        elif db_scheduler is not None:
+            for alarm, phone_number in alarms:
+                alarm_payload_cache.put(build_event(alarm, phone_number))
+            db_scheduler.schedule([alarm for alarm, _ in alarms])
+        else:
+            now = datetime.now(pytz.timezone(settings.timezone))
+            jobstore = jobstores['default']
+            rows = []
+            for (alarm, phone_number), job_id in zip(alarms, job_ids):
+                alarm_payload_cache.put(build_event(alarm, phone_number))
+                trigger = build_trigger(alarm)
+                job = Job(
+                    scheduler,
+                    id=job_id,
+                    func=fire_alarm,
+                    args=[alarm.id],
+                    kwargs={},
+                    name=fire_alarm.__name__,
+                    trigger=trigger,
+                    executor='default',
+                    next_run_time=trigger.get_next_fire_time(None, now),
+                    **JOB_DEFAULTS
+                )
+                rows.append({
+                    'id': job_id,
+                    'next_run_time': datetime_to_utc_timestamp(job.next_run_time),
+                    'job_state': pickle.dumps(job.__getstate__(), jobstore.pickle_protocol)
+                })
+
+            with jobstore.engine.begin() as connection:
+                connection.execute(jobstore.jobs_t.delete().where(jobstore.jobs_t.c.id.in_(job_ids)))
+                connection.execute(jobstore.jobs_t.insert(), rows)
+            scheduler.wakeup()
+        logger.info("Successfully scheduled %s jobs in one batch", len(job_ids))
+    except Exception as e:
+        logger.error("Error scheduling batch of %s jobs: %s", len(job_ids), e)
+        raise
+
+    return job_ids
+
 # Function to unschedule alarm
 def unschedule_alarm(job_id: str):
     try:
-        if scheduler.get_job(job_id):
-            scheduler.remove_job(job_id)
-            logger.info(f"Successfully removed job with ID {job_id}")
+        if timing_wheel is not None:
+            alarm_id = get_alarm_id(job_id)
+            found = timing_wheel.remove(alarm_id)
+            if not is_local(alarm_id):
+                publish_alarm_changes('remove', [alarm_id])
+                found = True
+        elif db_scheduler is not None:
+            found = db_scheduler.unschedule([get_alarm_id(job_id)]) > 0
+        else:
+            found = scheduler.get_job(job_id) is not None
+            if found:
+                scheduler.remove_job(job_id)
+
+        alarm_payload_cache.remove(get_alarm_id(job_id))
+        if found:
+            logger.info("Successfully removed job with ID %s", job_id)
         else:
-            logger.warning(f"No job found with ID {job_id} to unschedule")
+            logger.warning("No job found with ID %s to unschedule", job_id)
     except Exception as e:
-        logger.error(f"Error unscheduling job with ID {job_id}: {e}")
+        logger.error("Error unscheduling job with ID %s: %s", job_id, e)
         raise
 
+# Unschedule many alarms in one batch, returns how many jobs were removed
+# With APScheduler, all jobs are deleted from the jobstore in a single statement.
+def unschedule_alarms(job_ids: List[str]) -> int:
+    if not job_ids:
+        return 0
+
+    try:
+        if timing_wheel is not None:
+            removed = 0
+            remote_alarm_ids = []
+            for job_id in job_ids:
+                alarm_id = get_alarm_id(job_id)
+                removed += timing_wheel.remove(alarm_id)
+                if not is_local(alarm_id):
+                    remote_alarm_ids.append(alarm_id)
+            if remote_alarm_ids:
+                publish_alarm_changes('remove', remote_alarm_ids)
+                removed += len(remote_alarm_ids)
+        elif db_scheduler is not None:
+            removed = db_scheduler.unschedule([get_alarm_id(job_id) for job_id in job_ids])
+        else:
+            jobstore = jobstores['default']
+            with jobstore.engine.begin() as connection:
+                removed = connection.execute(jobstore.jobs_t.delete().where(jobstore.jobs_t.c.id.in_(job_ids))).rowcount
+            scheduler.wakeup()
+        for job_id in job_ids:
+            alarm_payload_cache.remove(get_alarm_id(job_id))
+        logger.info("Successfully removed %s of %s jobs in one batch", removed, len(job_ids))
+    except Exception as e:
+        logger.error("Error unscheduling batch of %s jobs: %s", len(job_ids), e)
+        raise
+
+    return removed
+
+# Load every active alarm into the timing wheel, it does not persist between restarts
+# Events are cached as they are loaded, up to the payload cache size.
+def load_timing_wheel():
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            select(models.Alarm, models.User.phone_number)
+            .join(models.User, models.User.id == models.Alarm.user_id)
+            .filter(models.Alarm.is_active.is_(True))
+            .execution_options(yield_per=1000)
+        )
+        for db_alarm, phone_number in result:
+            alarm = alarm_schemas.Alarm.from_db(db_alarm)
+            alarm_payload_cache.put(build_event(alarm, phone_number))
+            timing_wheel.add(alarm.id, alarm.days_of_week, alarm.time)
+        logger.info("Loaded %s alarms into %s timing wheel patterns", len(timing_wheel), timing_wheel.pattern_count)
+    except Exception as e:
+        logger.error("Error loading alarms into the timing wheel: %s", e)
+        raise
+    finally:
+        db.close()
 
 # Function to start scheduler from outside the module
 def start_scheduler():
-    scheduler.start()
\ No newline at end of file
+    notification_log_buffer.start()
+    dead_letter_buffer.start()
+    sms_dispatcher.start()
+    if shard_leases is not None:
+        # Shards are loaded into the timing wheel as their leases are claimed
+        timing_wheel.start()
+        shard_leases.start()
+    elif timing_wheel is not None:
+        load_timing_wheel()
+        timing_wheel.start()
+    elif db_scheduler is not None:
+        db_scheduler.backfill()
+        db_scheduler.start()
+    else:
+        alarm_payload_cache.warm()
+        scheduler.start()
+
+# Function to stop scheduler from outside the module
+def shutdown_scheduler():
+    if timing_wheel is not None:
+        timing_wheel.shutdown()
+    elif db_scheduler is not None:
+        db_scheduler.shutdown()
+    else:
+        scheduler.shutdown()
+    # Released after the wheel stops, so the next owner catches up from the last fired second
+    if shard_leases is not None:
+        shard_leases.shutdown()
+    sms_dispatcher.shutdown()
+    dead_letter_buffer.shutdown()
+    notification_log_buffer.shutdown()
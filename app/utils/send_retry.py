@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+from app.utils.logger import logger
+from app.utils.rate_limiter import THROTTLING_ERROR_CODES
+
+# Error codes of failures that can succeed when tried again
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    'InternalServerException',
+    'InternalFailure',
+    'InternalError',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'ProvisionedThroughputExceededException',
+}
+
+# Error code of a boto3 client error, or the exception class name for anything else
+def error_code(error: Exception) -> str:
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code'):
+        return response['Error']['Code']
+    return type(error).__name__
+
+# Whether the error is a botocore connection or HTTP client error
+# botocore is only imported once an AWS client is created, if it isn't loaded the error can't be one.
+def is_botocore_network_error(error: Exception) -> bool:
+    exceptions = sys.modules.get('botocore.exceptions')
+    return exceptions is not None and isinstance(error, (exceptions.ConnectionError, exceptions.HTTPClientError))
+
+# Whether a failed send should be retried
+# Network errors, throttling and server errors are retryable, anything else (validation errors,
+# opted out or unknown numbers, bad events) fails the same way on every attempt.
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(error, (ConnectionError, TimeoutError)) or is_botocore_network_error(error):
+        return True
+    response = getattr(error, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    if response.get('Error', {}).get('Code') in RETRYABLE_ERROR_CODES:
+        return True
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+# Delay before retry number `attempt` (from 1), exponential backoff with full jitter
+def backoff_delay(attempt: int, base_seconds: float, max_seconds: float, rng: random.Random = random) -> float:
+    return rng.uniform(0, min(max_seconds, base_seconds * 2 ** (attempt - 1)))
+
+# Delayed queue of failed sends waiting for their next attempt
+# Retries wait in a heap ordered by due time and are handed back to the dispatcher by their own
+# thread, so they never hold a dispatch worker or a slot of the dispatch queue while waiting.
+# Failures that are permanent, out of attempts or over `max_pending` go to `dead_letter_func`,
+# as do the retries still waiting at shutdown and failures handled after it.
+# Args:
+#   dead_letter_func: Called with (event, error code, error message, attempts) for every given up send.
+#   max_attempts: Attempts of a send, including the first, before it is given up.
+#   base_delay_seconds: Backoff of the first retry, doubled on every further one.
+#   max_delay_seconds: Cap of the backoff.
+#   max_pending: Retries kept waiting at once.
+class SendRetrier:
+    def __init__(
+        self,
+        dead_letter_func: Callable[[dict, str, str, int], None],
+        max_attempts: int = 5,
+        base_delay_seconds: float = 1.0,
+        max_delay_seconds: float = 300,
+        max_pending: int = 10000
+    ):
+        self._dead_letter_func = dead_letter_func
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay_seconds
+        self._max_delay = max_delay_seconds
+        self._max_pending = max_pending
+        self._pending: List[Tuple[float, int, dict, str, str]] = []  # Heap of (due time, sequence, event, error code, error)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._submit_func: Optional[Callable[[dict], bool]] = None
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+        # Metrics
+        self.scheduled = 0
+        self.resubmitted = 0
+        self.dead_lettered = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Start handing due retries to `submit_func`, which returns False when it has no room right now
+    def start(self, submit_func: Callable[[dict], bool]) -> None:
+        if self.running:
+            return
+        self._submit_func = submit_func
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='sms-retry', daemon=True)
+        self._thread.start()
+
+    # Stop the thread and dead-letter the retries still waiting, so they can be replayed later
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._condition:
+            pending, self._pending = self._pending, []
+        for _, _, event, code, message in pending:
+            self.dead_letter(event, code, message)
+
+    # Handle a failed send, returns True if it was scheduled for another attempt
+    def handle(self, event: dict, error: Exception) -> bool:
+        attempts = event.get('attempts', 1)
+        code, message = error_code(error), str(error)
+        if not is_retryable_error(error) or attempts >= self._max_attempts:
+            self.dead_letter(event, code, message)
+            return False
+        due = time.monotonic() + backoff_delay(attempts, self._base_delay, self._max_delay)
+        with self._condition:
+            accepted = not self._stopping and len(self._pending) < self._max_pending
+            if accepted:
+                heapq.heappush(self._pending, (due, next(self._sequence), {**event, 'attempts': attempts + 1}, code, message))
+                self.scheduled += 1
+                self._condition.notify()
+        if not accepted:
+            self.dead_letter(event, code, f"Not retried, retry queue full or stopped: {message}")
+        return accepted
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'scheduled': self.scheduled,
+            'resubmitted': self.resubmitted,
+            'dead_lettered': self.dead_lettered,
+        }
+
+    # Hand a send that won't be retried to the dead-letter function
+    def dead_letter(self, event: dict, code: str, message: str) -> None:
+        self.dead_lettered += 1
+        try:
+            self._dead_letter_func(event, code, message, event.get('attempts', 1))
+        except Exception as e:
+            logger.error("Error dead-lettering SMS notification for alarm with ID %s: %s", event.get('id'), e)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopping and (not self._pending or self._pending[0][0] > time.monotonic()):
+                    self._condition.wait(self._pending[0][0] - time.monotonic() if self._pending else None)
+                if self._stopping:
+                    return
+                entry = heapq.heappop(self._pending)
+            if self._submit_func(entry[2]):
+                self.resubmitted += 1
+                continue
+            # The dispatch queue is full, try again after the base delay without using up an attempt
+            with self._condition:
+                heapq.heappush(self._pending, (time.monotonic() + self._base_delay, *entry[1:]))
@@ -0,0 +1,286 @@
+import math
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Callable, Optional, Set
+from sqlalchemy import case, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from app.db import models
+from app.db.database import engine
+from app.utils.logger import logger
+
+# Unique id of this scheduler process
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Claims a fair share of scheduler shards through lease rows in Postgres
+# Every sync the worker heartbeats, renews its leases, releases shards above its fair share
+# (so new workers get some) and claims expired or released ones with FOR UPDATE SKIP LOCKED.
+# Leases of a dead worker expire after `lease_ttl_seconds` and move to the remaining workers.
+# Claimed shards are loaded on a separate thread, so leases keep being renewed while a large share
+# loads. Shards are dropped (stop firing) before their release is written, and a shard that fails
+# to load is released so it can be claimed and loaded again.
+# Args:
+#   shard_count: Number of shards alarm ids are partitioned into.
+#   on_acquire: Called with (shard id, last epoch second fired by the previous owner) for every claimed shard.
+#   on_release: Called with the shard id for every shard this worker stops owning.
+#   fired_through: Returns the last epoch second this worker has fired, stored with the lease.
+#   lease_ttl_seconds: How long a lease lasts without being renewed.
+#   renew_interval_seconds: How often leases are renewed and shards rebalanced.
+class ShardLeaseManager:
+    def __init__(
+        self,
+        shard_count: int,
+        on_acquire: Callable[[int, Optional[int]], None],
+        on_release: Callable[[int], None],
+        fired_through: Callable[[], Optional[int]],
+        lease_ttl_seconds: float = 10,
+        renew_interval_seconds: float = 3,
+        worker_id: Optional[str] = None
+    ):
+        self.shard_count = shard_count
+        self.worker_id = worker_id or make_worker_id()
+        self._on_acquire = on_acquire
+        self._on_release = on_release
+        self._fired_through = fired_through
+        self._lease_ttl = timedelta(seconds=lease_ttl_seconds)
+        self._renew_interval = renew_interval_seconds
+        self._owned: Set[int] = set()
+        self._loading: Set[int] = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load_queue: queue.Queue = queue.Queue()
+        self._load_thread: Optional[threading.Thread] = None
+        self._last_renewed = time.monotonic()
+
+        # Metrics
+        self.live_workers = 1
+        self.acquired = 0
+        self.released = 0
+        self.lost = 0
+
+    @property
+    def owned_shards(self) -> Set[int]:
+        with self._lock:
+            return set(self._owned)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def shard_for(self, alarm_id: int) -> int:
+        return alarm_id % self.shard_count
+
+    def owns(self, alarm_id: int) -> bool:
+        return self.shard_for(alarm_id) in self._owned
+
+    # Create the lease rows, claim a first share of shards and start renewing
+    def start(self) -> None:
+        if self.running:
+            return
+        with engine.begin() as connection:
+            connection.execute(
+                insert(models.SchedulerShardLease)
+                .values([{'shard_id': shard_id} for shard_id in range(self.shard_count)])
+                .on_conflict_do_nothing(index_elements=['shard_id'])
+            )
+        self._stop_event.clear()
+        self._load_thread = threading.Thread(target=self._load_loop, name='shard-loader', daemon=True)
+        self._load_thread.start()
+        self.sync()
+        self._thread = threading.Thread(target=self._run, name='shard-leases', daemon=True)
+        self._thread.start()
+
+    # Stop renewing and release every lease so other workers take the shards over right away
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        for thread in (self._thread, self._load_thread):
+            if thread is not None:
+                thread.join(timeout)
+        self._thread = None
+        self._load_thread = None
+
+        # Stop firing before releasing, so the next owner catches up from what was really fired
+        owned = self.owned_shards
+        unloaded = {shard_id for shard_id in owned if not self._drop(shard_id)}
+        try:
+            with engine.begin() as connection:
+                self._release(connection, owned - unloaded)
+                self._release(connection, unloaded, loaded=False)
+                connection.execute(delete(models.SchedulerWorker).where(models.SchedulerWorker.worker_id == self.worker_id))
+        except Exception as e:
+            logger.error("Error releasing %s scheduler shard leases: %s", len(owned), e)
+
+    # Heartbeat, renew leases, then rebalance towards this worker's fair share of shards
+    def sync(self) -> None:
+        Lease = models.SchedulerShardLease
+        Worker = models.SchedulerWorker
+        expires_at = func.now() + self._lease_ttl
+        fired_through = self._fired_through()
+
+        with engine.begin() as connection:
+            connection.execute(
+                insert(Worker)
+                .values(worker_id=self.worker_id, expires_at=expires_at)
+                .on_conflict_do_update(index_elements=['worker_id'], set_={'expires_at': expires_at})
+            )
+            connection.execute(delete(Worker).where(Worker.expires_at < func.now() - self._lease_ttl))
+            self.live_workers = connection.execute(
+                select(func.count()).select_from(Worker).where(Worker.expires_at > func.now())
+            ).scalar()
+
+            # Renew, any lease whose owner changed was taken over after expiring
+            owned = self.owned_shards
+            renewed = set(connection.execute(
+                update(Lease)
+                .where(Lease.shard_id.in_(sorted(owned)), Lease.owner == self.worker_id)
+                .values(expires_at=expires_at, fired_through=self._loaded_fired_through(fired_through))
+                .returning(Lease.shard_id)
+            ).scalars())
+        self._last_renewed = time.monotonic()
+
+        for shard_id in owned - renewed:
+            logger.warning("Lost lease of scheduler shard %s", shard_id)
+            self.lost += 1
+            self._drop(shard_id)
+
+        # Extra shards stop firing before their release is written, see _release
+        fair_share = math.ceil(self.shard_count / max(self.live_workers, 1))
+        extra = sorted(renewed)[fair_share:]
+        unloaded = {shard_id for shard_id in extra if not self._drop(shard_id)}
+
+        claimed = []
+        wanted = fair_share - len(renewed) + len(extra)
+        if extra or wanted > 0:
+            with engine.begin() as connection:
+                self._release(connection, set(extra) - unloaded)
+                self._release(connection, unloaded, loaded=False)
+                if wanted > 0:
+                    claimable = (
+                        select(Lease.shard_id)
+                        .where(
+                            Lease.shard_id < self.shard_count,
+                            or_(Lease.expires_at.is_(None), Lease.expires_at < func.now())
+                        )
+                        .order_by(Lease.shard_id)
+                        .limit(wanted)
+                        .with_for_update(skip_locked=True)
+                        .scalar_subquery()
+                    )
+                    claimed = connection.execute(
+                        update(Lease)
+                        .where(Lease.shard_id.in_(claimable))
+                        .values(owner=self.worker_id, expires_at=expires_at)
+                        .returning(Lease.shard_id, Lease.fired_through)
+                    ).all()
+
+        for shard_id, previous_fired_through in claimed:
+            self._acquire(shard_id, previous_fired_through)
+
+        if claimed or extra or owned != renewed:
+            logger.info(
+                "Scheduler worker %s owns %s of %s shards with %s live workers",
+                self.worker_id, len(self._owned), self.shard_count, self.live_workers
+            )
+
+    def stats(self) -> dict:
+        return {
+            'worker_id': self.worker_id,
+            'shard_count': self.shard_count,
+            'owned_shards': sorted(self.owned_shards),
+            'live_workers': self.live_workers,
+            'acquired': self.acquired,
+            'released': self.released,
+            'lost': self.lost,
+        }
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self._renew_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("Error renewing scheduler shard leases: %s", e)
+                # Stop firing once the leases may have expired, another worker can own the shards by now
+                if time.monotonic() - self._last_renewed >= self._lease_ttl.total_seconds():
+                    for shard_id in self.owned_shards:
+                        self.lost += 1
+                        self._drop(shard_id)
+
+    # Release leases of shards already dropped, fired_through is read after they stopped firing
+    # Shards that were never loaded keep the previous owner's fired_through.
+    def _release(self, connection, shard_ids, loaded: bool = True) -> None:
+        Lease = models.SchedulerShardLease
+        if not shard_ids:
+            return
+        values = {'owner': None, 'expires_at': func.now()}
+        if loaded:
+            values['fired_through'] = self._fired_through()
+        connection.execute(
+            update(Lease)
+            .where(Lease.shard_id.in_(sorted(shard_ids)), Lease.owner == self.worker_id)
+            .values(**values)
+        )
+
+    # Leases of shards still loading keep the previous owner's fired_through, nothing was fired for them yet
+    def _loaded_fired_through(self, fired_through: Optional[int]):
+        Lease = models.SchedulerShardLease
+        with self._lock:
+            loading = sorted(self._loading)
+        if not loading:
+            return fired_through
+        return case((Lease.shard_id.in_(loading), Lease.fired_through), else_=fired_through)
+
+    # Own the shard right away, so its lease is renewed, and queue it for loading
+    def _acquire(self, shard_id: int, fired_through: Optional[int]) -> None:
+        with self._lock:
+            self._owned.add(shard_id)
+            self._loading.add(shard_id)
+        self.acquired += 1
+        self._load_queue.put((shard_id, fired_through))
+
+    # Load claimed shards one at a time, off the renew thread
+    def _load_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                shard_id, fired_through = self._load_queue.get(timeout=self._renew_interval)
+            except queue.Empty:
+                continue
+            if shard_id not in self._owned:
+                continue
+            try:
+                self._on_acquire(shard_id, fired_through)
+            except Exception as e:
+                logger.error("Error loading scheduler shard %s, releasing it: %s", shard_id, e)
+                self._drop(shard_id)
+                try:
+                    with engine.begin() as connection:
+                        self._release(connection, [shard_id], loaded=False)
+                except Exception as e:
+                    logger.error("Error releasing scheduler shard %s: %s", shard_id, e)
+                continue
+            with self._lock:
+                self._loading.discard(shard_id)
+                dropped = shard_id not in self._owned
+            # Dropped while loading, unload what was loaded after it was unloaded
+            if dropped:
+                self._on_release(shard_id)
+
+    # Stop firing the shard, returns whether it had been loaded
+    def _drop(self, shard_id: int) -> bool:
+        with self._lock:
+            if shard_id not in self._owned:
+                return False
+            loaded = shard_id not in self._loading
+            self._owned.discard(shard_id)
+            self._loading.discard(shard_id)
+        self.released += 1
+        try:
+            self._on_release(shard_id)
+        except Exception as e:
+            logger.error("Error unloading scheduler shard %s: %s", shard_id, e)
+        return loaded
@@ -0,0 +1,295 @@
+import itertools
+import math
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+from app.config import settings
+from app.utils.logger import logger, OutcomeSummary
+from app.utils.notification_transport import notification_transport
+from app.utils.metrics import registry
+from app.utils.fire_tracker import fire_tracker
+from app.utils.rate_limiter import AdaptiveTokenBucket, is_throttling_error
+from app.utils.send_retry import SendRetrier
+from app.utils.dead_letters import DeadLetterBuffer
+
+THROUGHPUT_WINDOW_SECONDS = 60
+
+# Dedicated dispatch stage for fired alarms
+# Fired events go into a bounded priority queue that a pool of worker threads drains, oldest
+# scheduled time first, so a backlog never delays earlier fires behind later ones. Retries and
+# replays are ordered by the time they are resubmitted instead, so they queue behind the fires
+# already waiting rather than ahead of all of them. Producers
+# block while the queue is full, which slows the schedulers down to the send rate. Each send
+# takes a token from the rate limiter first, and throttled sends are retried after the
+# limiter has cut its rate. Other failures go to the retrier, which sends them again later or
+# dead-letters them.
+# Args:
+#   send_func: Function sending a single event, defaults to the configured notification transport.
+#   workers: Number of worker threads.
+#   queue_size: Maximum number of events waiting to be sent.
+#   enqueue_timeout: Seconds a producer waits for room in a full queue before the event is dropped.
+#   record_func: Called with (alarm id, scheduled time, outcome, dequeue time, completion time)
+#     for every event carrying a `scheduled_time`.
+#   rate_limiter: Token bucket governing the send rate, sends aren't limited without one.
+#   max_throttle_retries: Times a throttled send is retried before it counts as failed.
+#   retrier: Delayed retry queue for failed sends, they count as failed right away without one.
+class SmsDispatcher:
+    def __init__(
+        self,
+        send_func: Callable[[dict], None] = notification_transport.send,
+        workers: int = 32,
+        queue_size: int = 10000,
+        enqueue_timeout: float = 5.0,
+        record_func: Optional[Callable[[int, float, str, Optional[float], float], None]] = None,
+        rate_limiter: Optional[AdaptiveTokenBucket] = None,
+        max_throttle_retries: int = 5,
+        retrier: Optional[SendRetrier] = None
+    ):
+        self._send_func = send_func
+        self._record_func = record_func
+        self._workers = workers
+        self._enqueue_timeout = enqueue_timeout
+        self._rate_limiter = rate_limiter
+        self._max_throttle_retries = max_throttle_retries
+        self._retrier = retrier
+        self._queue = queue.PriorityQueue(maxsize=queue_size)  # (scheduled or resubmit time, sequence, event)
+        self._sequence = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._summary = OutcomeSummary('SMS send outcomes')
+
+        # Metrics
+        self.enqueued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.deferred = 0
+        self.deferral_seconds = 0.0
+        self.backpressure = 0
+        self.max_queue_depth = 0
+        self._window = [[0, 0] for _ in range(THROUGHPUT_WINDOW_SECONDS)]  # [epoch second, sends]
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    # Add a fired event to the queue, returns False if it had to be dropped
+    # Blocks the producer while the queue is full, for up to the enqueue timeout.
+    def submit(self, event: dict, timeout: Optional[float] = None) -> bool:
+        scheduled_time = event.get('scheduled_time')
+        item = (time.time() if scheduled_time is None else scheduled_time, next(self._sequence), event)
+        try:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                with self._lock:
+                    self.backpressure += 1
+                self._queue.put(item, timeout=self._enqueue_timeout if timeout is None else timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.error("SMS dispatch queue is full, dropping notification for alarm with ID %s", event.get('id'))
+            self._summary.add('dropped')
+            if self._retrier is not None:
+                self._retrier.dead_letter(event, 'DispatchQueueFull', 'SMS dispatch queue is full')
+            self._record(event, 'dropped', None)
+            return False
+
+        with self._lock:
+            self.enqueued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return True
+
+    # Add an event to the queue only if there is room right now, for retries and replays
+    # Ordered by resubmit time, their original scheduled time would put them ahead of every fresh fire.
+    def resubmit(self, event: dict) -> bool:
+        try:
+            self._queue.put_nowait((time.time(), next(self._sequence), event))
+        except queue.Full:
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._threads = [
+            threading.Thread(target=self._work, name=f"sms-dispatch-{i}", daemon=True)
+            for i in range(self._workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        if self._retrier is not None:
+            self._retrier.start(self.resubmit)
+        self._summary.start()
+        logger.info("Started SMS dispatcher with %s workers", self._workers)
+
+    # Stop the workers once everything already queued has been sent
+    # Retries still waiting are dead-lettered rather than sent.
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        if self._retrier is not None:
+            self._retrier.shutdown(timeout)
+        for _ in self._threads:
+            self._queue.put((math.inf, next(self._sequence), None))
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._summary.shutdown()
+
+    # Block until every queued event has been processed
+    def join(self) -> None:
+        self._queue.join()
+
+    # Sends per second averaged over the last `seconds` complete seconds
+    def throughput(self, seconds: int = 10) -> float:
+        seconds = min(seconds, THROUGHPUT_WINDOW_SECONDS - 1)
+        now = int(time.time())
+        with self._lock:
+            sends = sum(count for second, count in self._window if now - seconds <= second < now)
+        return sends / seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                'workers': self._workers,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'throttled': self.throttled,
+                'deferred': self.deferred,
+                'deferral_seconds': round(self.deferral_seconds, 3),
+                'backpressure': self.backpressure,
+            }
+        stats['sends_per_second'] = self.throughput()
+        if self._retrier is not None:
+            stats['retry'] = self._retrier.stats()
+        stats['rate_limit_per_second'] = round(self._rate_limiter.rate, 2) if self._rate_limiter is not None and self._rate_limiter.enabled else None
+        return stats
+
+    def _work(self) -> None:
+        while True:
+            _, _, event = self._queue.get()
+            try:
+                if event is None:
+                    return
+                self._send(event)
+            finally:
+                self._queue.task_done()
+
+    # Send once a token is available, throttled sends are retried at the reduced rate
+    def _send(self, event: dict) -> None:
+        dequeued_at = time.time()
+        for attempt in range(self._max_throttle_retries + 1):
+            self._acquire_token()
+            try:
+                self._send_func(event)
+                break
+            except Exception as e:
+                if is_throttling_error(e) and attempt < self._max_throttle_retries:
+                    self._throttled()
+                    continue
+                if self._retrier is not None and self._retrier.handle(event, e):
+                    with self._lock:
+                        self.retried += 1
+                    self._summary.add('retried')
+                    return
+                with self._lock:
+                    self.failed += 1
+                logger.error("Error dispatching SMS notification for alarm with ID %s: %s", event.get('id'), e)
+                self._summary.add('failed')
+                self._record(event, 'failed', dequeued_at)
+                return
+        self._summary.add('sent')
+        self._record(event, 'sent', dequeued_at)
+
+        now = int(time.time())
+        with self._lock:
+            self.sent += 1
+            slot = self._window[now % THROUGHPUT_WINDOW_SECONDS]
+            if slot[0] != now:
+                slot[0], slot[1] = now, 0
+            slot[1] += 1
+
+    # Wait for a send token, counting the sends it had to defer
+    def _acquire_token(self) -> None:
+        if self._rate_limiter is None:
+            return
+        waited = self._rate_limiter.acquire()
+        if waited > 0:
+            with self._lock:
+                self.deferred += 1
+                self.deferral_seconds += waited
+
+    def _throttled(self) -> None:
+        with self._lock:
+            self.throttled += 1
+        self._summary.add('throttled')
+        if self._rate_limiter is not None:
+            self._rate_limiter.throttled()
+
+    def _record(self, event: dict, outcome: str, dequeued_at: Optional[float]) -> None:
+        if self._record_func is None or event.get('scheduled_time') is None:
+            return
+        try:
+            self._record_func(event['id'], event['scheduled_time'], outcome, dequeued_at, time.time())
+        except Exception as e:
+            logger.error("Error recording fire of alarm with ID %s: %s", event.get('id'), e)
+
+# Sends given up after their retries, written to the sms_dead_letters table in batches
+dead_letter_buffer = DeadLetterBuffer(
+    batch_size=settings.dead_letter_batch_size,
+    flush_interval_ms=settings.dead_letter_flush_interval_ms,
+    max_buffered=settings.dead_letter_max_buffered
+)
+
+sms_dispatcher = SmsDispatcher(
+    workers=settings.sms_dispatch_workers,
+    queue_size=settings.sms_dispatch_queue_size,
+    enqueue_timeout=settings.sms_dispatch_enqueue_timeout,
+    record_func=fire_tracker.record,
+    rate_limiter=AdaptiveTokenBucket(
+        rate_per_second=settings.sms_rate_limit_per_second,
+        burst=settings.sms_rate_limit_burst,
+        min_rate_per_second=settings.sms_rate_limit_min_per_second,
+        recovery_per_second=settings.sms_rate_limit_recovery_per_second
+    ),
+    max_throttle_retries=settings.sms_throttle_max_retries,
+    retrier=SendRetrier(
+        dead_letter_func=dead_letter_buffer.enqueue,
+        max_attempts=settings.sms_retry_max_attempts,
+        base_delay_seconds=settings.sms_retry_base_delay_seconds,
+        max_delay_seconds=settings.sms_retry_max_delay_seconds,
+        max_pending=settings.sms_retry_max_pending
+    )
+)
+
+# Dispatch stage metrics, read from the counters the dispatcher already keeps
+# Every gauge reads the same stats snapshot, taken once per scrape.
+dispatch_stats = registry.per_scrape(sms_dispatcher.stats)
+registry.callback('sms_dispatch_queue_depth', 'Fired alarms waiting for a dispatch worker', lambda: dispatch_stats()['queue_depth'])
+registry.callback(
+    'sms_dispatch_events_total',
+    'Fired alarms by dispatch outcome',
+    lambda: {(outcome,): dispatch_stats()[outcome] for outcome in ('enqueued', 'dropped', 'sent', 'failed', 'retried')},
+    type='counter',
+    labelnames=('outcome',)
+)
+registry.callback('sms_dispatch_throttled_total', 'Sends rejected by Pinpoint throttling', lambda: dispatch_stats()['throttled'], type='counter')
+registry.callback('sms_dispatch_backpressure_total', 'Fired alarms whose producer waited for room in the dispatch queue', lambda: dispatch_stats()['backpressure'], type='counter')
+registry.callback('sms_rate_limit_deferred_total', 'Sends that waited for a rate limit token', lambda: dispatch_stats()['deferred'], type='counter')
+registry.callback('sms_rate_limit_deferral_seconds_total', 'Time sends waited for a rate limit token', lambda: dispatch_stats()['deferral_seconds'], type='counter')
+registry.callback('sms_retry_pending', 'Failed sends waiting for their next attempt', lambda: dispatch_stats()['retry']['pending'])
+registry.callback('sms_dead_letters_total', 'Sends given up and dead-lettered', lambda: dispatch_stats()['retry']['dead_lettered'], type='counter')
+registry.callback('sms_rate_limit_per_second', 'Current send rate of the adaptive rate limiter', lambda: dispatch_stats()['rate_limit_per_second'] or 0)
@@ -0,0 +1,194 @@
+import threading
+import time
+from datetime import datetime, time as dt_time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import pytz
+from app.utils.logger import logger
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Trigger shared by every alarm with the same days_of_week/time pattern
+# Args:
+#   days_of_week: Sorted tuple of weekdays (Monday = 0, Sunday = 6).
+#   second_of_day: Seconds since local midnight the pattern fires at.
+class FirePattern:
+    __slots__ = ('days_of_week', 'second_of_day', 'alarm_ids')
+
+    def __init__(self, days_of_week: Tuple[int, ...], second_of_day: int):
+        self.days_of_week = days_of_week
+        self.second_of_day = second_of_day
+        self.alarm_ids: Set[int] = set()
+
+    @property
+    def key(self) -> Tuple[Tuple[int, ...], int]:
+        return (self.days_of_week, self.second_of_day)
+
+    @property
+    def slots(self) -> List[Tuple[int, int]]:
+        return [(day, self.second_of_day) for day in self.days_of_week]
+
+# In-memory fire index from (weekday, second-of-day) to alarm ids
+# A single driver thread ticks once per second and fires whole buckets at once.
+# Args:
+#   fire_bucket: Called with (scheduled epoch second, alarm ids) for every non-empty bucket.
+#   timezone: Timezone the alarm times are expressed in.
+#   clock: Returns the current epoch time, overridable for simulated clocks.
+#   misfire_grace_seconds: How far back the driver catches up after a stall.
+class TimingWheel:
+    def __init__(
+        self,
+        fire_bucket: Callable[[int, List[int]], None],
+        timezone: str,
+        clock: Callable[[], float] = time.time,
+        misfire_grace_seconds: int = 60
+    ):
+        self._fire_bucket = fire_bucket
+        self._timezone = pytz.timezone(timezone)
+        self._clock = clock
+        self._misfire_grace_seconds = misfire_grace_seconds
+        self._buckets: Dict[Tuple[int, int], Set[FirePattern]] = {}
+        self._patterns: Dict[Tuple[Tuple[int, ...], int], FirePattern] = {}
+        self._alarm_patterns: Dict[int, FirePattern] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_tick: Optional[int] = None
+        self._catch_ups: List[Tuple[Set[int], int]] = []
+
+    def __len__(self) -> int:
+        return len(self._alarm_patterns)
+
+    def __contains__(self, alarm_id: int) -> bool:
+        return alarm_id in self._alarm_patterns
+
+    @property
+    def pattern_count(self) -> int:
+        return len(self._patterns)
+
+    @property
+    def last_tick(self) -> Optional[int]:
+        return self._last_tick
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    # Add (or move) an alarm in the index
+    def add(self, alarm_id: int, days_of_week: List[int], alarm_time: dt_time) -> None:
+        key = (tuple(sorted(set(days_of_week))), alarm_time.hour * 3600 + alarm_time.minute * 60 + alarm_time.second)
+        with self._lock:
+            current = self._alarm_patterns.get(alarm_id)
+            if current is not None:
+                if current.key == key:
+                    return
+                self._detach(alarm_id, current)
+
+            pattern = self._patterns.get(key)
+            if pattern is None:
+                pattern = FirePattern(*key)
+                self._patterns[key] = pattern
+                for slot in pattern.slots:
+                    self._buckets.setdefault(slot, set()).add(pattern)
+            pattern.alarm_ids.add(alarm_id)
+            self._alarm_patterns[alarm_id] = pattern
+
+    # Remove an alarm from the index, returns whether it was present
+    def remove(self, alarm_id: int) -> bool:
+        with self._lock:
+            pattern = self._alarm_patterns.get(alarm_id)
+            if pattern is None:
+                return False
+            self._detach(alarm_id, pattern)
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+            self._patterns.clear()
+            self._alarm_patterns.clear()
+
+    def alarm_ids(self) -> List[int]:
+        with self._lock:
+            return list(self._alarm_patterns)
+
+    # Alarm ids due at the given weekday and second of day
+    def due(self, weekday: int, second_of_day: int) -> List[int]:
+        with self._lock:
+            alarm_ids: List[int] = []
+            for pattern in self._buckets.get((weekday, second_of_day), ()):
+                alarm_ids.extend(pattern.alarm_ids)
+            return alarm_ids
+
+    # Fire the given alarms for the seconds since `since` that the next tick has already passed
+    # Used when alarms move over from another scheduler that stopped firing them at `since`.
+    def catch_up(self, alarm_ids: Set[int], since: int) -> None:
+        with self._lock:
+            self._catch_ups.append((set(alarm_ids), since))
+
+    # Fire every bucket between the last tick and now
+    # Seconds older than the misfire grace period are skipped.
+    def tick(self, now: Optional[float] = None) -> int:
+        current = int(self._clock() if now is None else now)
+        if self._last_tick is None:
+            self._last_tick = current - 1
+        start = max(self._last_tick + 1, current - self._misfire_grace_seconds)
+        if start > self._last_tick + 1:
+            logger.warning("Timing wheel skipped %s seconds past the misfire grace period", start - self._last_tick - 1)
+
+        with self._lock:
+            catch_ups, self._catch_ups = self._catch_ups, []
+
+        fired = 0
+        for alarm_ids, since in catch_ups:
+            fired += self._fire_seconds(max(since, current - self._misfire_grace_seconds), start, alarm_ids)
+        fired += self._fire_seconds(start, current + 1)
+        self._last_tick = max(self._last_tick, current)
+        return fired
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._last_tick = None
+        self._thread = threading.Thread(target=self._run, name='timing-wheel', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self.tick()
+            # Sleep until just past the next second boundary
+            self._stop_event.wait(1.0 - (self._clock() % 1.0) + 0.001)
+
+    # Fire the buckets of seconds [start, end), optionally only for the given alarms
+    def _fire_seconds(self, start: int, end: int, only: Optional[Set[int]] = None) -> int:
+        fired = 0
+        for second in range(start, end):
+            local = datetime.fromtimestamp(second, self._timezone)
+            alarm_ids = self.due(local.weekday(), local.hour * 3600 + local.minute * 60 + local.second)
+            if only is not None:
+                alarm_ids = [alarm_id for alarm_id in alarm_ids if alarm_id in only]
+            if alarm_ids:
+                try:
+                    self._fire_bucket(second, alarm_ids)
+                except Exception as e:
+                    logger.error("Error firing timing wheel bucket at %s: %s", local.isoformat(), e)
+                fired += len(alarm_ids)
+        return fired
+
+    def _detach(self, alarm_id: int, pattern: FirePattern) -> None:
+        pattern.alarm_ids.discard(alarm_id)
+        del self._alarm_patterns[alarm_id]
+        if not pattern.alarm_ids:
+            del self._patterns[pattern.key]
+            for slot in pattern.slots:
+                bucket = self._buckets.get(slot)
+                if bucket is not None:
+                    bucket.discard(pattern)
+                    if not bucket:
+                        del self._buckets[slot]
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from app.config import settings
+from app.schemas import user_schemas
+from app.utils.pg_listener import pg_listener
+
+# In-process LRU+TTL cache of users, keyed by id, username and phone number
+# Users are stored and returned as copies, so callers can't change cached entries. A user older
+# than the cached one (a read that started before a change committed) doesn't replace it.
+# Args:
+#   max_size: Maximum number of users kept, least recently used users are evicted first.
+#   ttl_seconds: How long a cached user is trusted.
+class UserCache:
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 60):
+        self._max_size = max_size
+        self._ttl = ttl_seconds
+        self._users: "OrderedDict[int, Tuple[user_schemas.User, float]]" = OrderedDict()
+        self._ids_by_username: Dict[str, int] = {}
+        self._ids_by_phone_number: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get_by_id(self, user_id: int) -> Optional[user_schemas.User]:
+        with self._lock:
+            return self._get(user_id)
+
+    def get_by_username(self, username: str) -> Optional[user_schemas.User]:
+        with self._lock:
+            return self._get(self._ids_by_username.get(username))
+
+    def get_by_phone_number(self, phone_number: str) -> Optional[user_schemas.User]:
+        with self._lock:
+            return self._get(self._ids_by_phone_number.get(phone_number))
+
+    def put(self, user: user_schemas.User) -> None:
+        with self._lock:
+            entry = self._users.get(user.id)
+            if entry is not None and entry[0].version > user.version:
+                return
+            self._remove(user.id)
+            self._users[user.id] = (user.model_copy(), time.monotonic() + self._ttl)
+            self._ids_by_username[user.username] = user.id
+            self._ids_by_phone_number[user.phone_number] = user.id
+            while len(self._users) > self._max_size:
+                self._remove(next(iter(self._users)))
+                self.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if self._remove(user_id):
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+            self._ids_by_username.clear()
+            self._ids_by_phone_number.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._users),
+            'max_size': self._max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def _get(self, user_id: Optional[int]) -> Optional[user_schemas.User]:
+        entry = self._users.get(user_id) if user_id is not None else None
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry[0].model_copy()
+
+    def _remove(self, user_id: int) -> bool:
+        entry = self._users.pop(user_id, None)
+        if entry is None:
+            return False
+        user = entry[0]
+        if self._ids_by_username.get(user.username) == user_id:
+            del self._ids_by_username[user.username]
+        if self._ids_by_phone_number.get(user.phone_number) == user_id:
+            del self._ids_by_phone_number[user.phone_number]
+        return True
+
+# Channel used to invalidate users cached by other workers
+USER_CACHE_CHANNEL = 'user_cache_invalidation'
+
+user_cache = UserCache(max_size=settings.user_cache_max_size, ttl_seconds=settings.user_cache_ttl_seconds)
+
+# Cross-worker invalidation through Postgres LISTEN/NOTIFY
+if settings.user_cache_notify:
+    pg_listener.subscribe(USER_CACHE_CHANNEL, lambda payload: user_cache.invalidate(int(payload)))
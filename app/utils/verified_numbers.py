@@ -0,0 +1,64 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# TTL cached index of the Pinpoint verified destination numbers
+# Entries are keyed by phone number and by VerifiedDestinationNumberId for O(1) lookups.
+# The whole index is reloaded from Pinpoint once the TTL expires, and kept current in between
+# by applying every add/remove/verify made through this app.
+# Args:
+#   loader: Returns every verified destination number from Pinpoint.
+#   ttl_seconds: How long a loaded index is trusted.
+class VerifiedNumbersIndex:
+    def __init__(self, loader: Callable[[], List[dict]], ttl_seconds: float = 300):
+        self._loader = loader
+        self._ttl = ttl_seconds
+        self._by_phone_number: Dict[str, dict] = {}
+        self._by_id: Dict[str, dict] = {}
+        self._expires_at = 0.0
+        self._lock = threading.RLock()
+
+    def get_by_phone_number(self, phone_number: str) -> Optional[dict]:
+        with self._lock:
+            self._ensure_loaded()
+            return self._by_phone_number.get(phone_number)
+
+    def get_by_id(self, aws_phone_number_id: str) -> Optional[dict]:
+        with self._lock:
+            self._ensure_loaded()
+            return self._by_id.get(aws_phone_number_id)
+
+    def count(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._by_id)
+
+    def add(self, entry: dict) -> None:
+        with self._lock:
+            self._by_id[entry['VerifiedDestinationNumberId']] = entry
+            self._by_phone_number[entry['DestinationPhoneNumber']] = entry
+
+    def remove(self, aws_phone_number_id: str) -> None:
+        with self._lock:
+            entry = self._by_id.pop(aws_phone_number_id, None)
+            if entry is not None and self._by_phone_number.get(entry['DestinationPhoneNumber']) is entry:
+                del self._by_phone_number[entry['DestinationPhoneNumber']]
+
+    def set_status(self, aws_phone_number_id: str, status: str) -> None:
+        with self._lock:
+            entry = self._by_id.get(aws_phone_number_id)
+            if entry is not None:
+                entry['Status'] = status
+
+    # Force a reload from Pinpoint on the next lookup
+    def invalidate(self) -> None:
+        with self._lock:
+            self._expires_at = 0.0
+
+    def _ensure_loaded(self) -> None:
+        if time.monotonic() < self._expires_at:
+            return
+        entries = self._loader()
+        self._by_id = {entry['VerifiedDestinationNumberId']: entry for entry in entries}
+        self._by_phone_number = {entry['DestinationPhoneNumber']: entry for entry in entries}
+        self._expires_at = time.monotonic() + self._ttl
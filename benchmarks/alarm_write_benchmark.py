@@ -0,0 +1,149 @@
+"""Compare database round trips and throughput of alarm creates and updates
+
+Runs the single transaction create and update flows of alarm_crud against the
+previous flows, which committed and refreshed after every step, on a local
+Postgres. Round trips are counted from the statements and commits sent by the
+engine. Scheduler calls are left out, both flows make the same ones after
+committing.
+
+Usage:
+    python -m benchmarks.alarm_write_benchmark --alarms 2000 --concurrency 1 8
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import time as dt_time
+from sqlalchemy import delete, event, insert, select, update
+from app.crud import alarm_crud, alarm_job_crud
+from app.db import models
+from app.db.database import SessionLocal, engine
+from app.schemas import alarm_job_schemas, alarm_schemas, user_schemas
+
+BENCHMARK_USERNAME = 'write_benchmark_user'
+
+round_trips = [0]
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    round_trips[0] += 1
+
+@event.listens_for(engine, 'commit')
+def count_commit(conn):
+    round_trips[0] += 1
+
+def get_benchmark_user() -> user_schemas.User:
+    db = SessionLocal()
+    try:
+        db_user = db.execute(select(models.User).filter(models.User.username == BENCHMARK_USERNAME)).scalars().first()
+        if db_user is None:
+            db_user = db.scalars(
+                insert(models.User)
+                .values(username=BENCHMARK_USERNAME, phone_number='+15555550101', aws_phone_number_id='benchmark')
+                .returning(models.User)
+            ).one()
+            db.commit()
+        return user_schemas.User.model_validate(db_user)
+    finally:
+        db.close()
+
+def cleanup(user: user_schemas.User) -> None:
+    with engine.begin() as connection:
+        connection.execute(delete(models.Alarm).where(models.Alarm.user_id == user.id))
+
+# Previous create flow: commit and refresh the alarm, then commit and refresh its alarm job
+def legacy_create_alarm(db, alarm_create: alarm_schemas.AlarmCreate, user: user_schemas.User) -> alarm_schemas.Alarm:
+    db_alarm = models.Alarm(
+        user_id=user.id,
+        message=alarm_create.message,
+        time=alarm_create.time,
+        days_of_week=alarm_create.days_of_week,
+        is_active=alarm_create.is_active
+    )
+    db.add(db_alarm)
+    db.commit()
+    db.refresh(db_alarm)
+    alarm = alarm_schemas.Alarm.model_validate(db_alarm)
+    alarm_job_crud.create_alarm_job(db, alarm_job_schemas.AlarmJobCreate(alarm_id=alarm.id, sms_job_id=None))
+    return alarm
+
+# Previous update flow: commit the alarm, look up its alarm job, then commit the alarm job
+def legacy_update_alarm(db, alarm: alarm_schemas.Alarm, alarm_update: alarm_schemas.AlarmUpdate, get_user_by_id_func) -> alarm_schemas.Alarm:
+    alarm = alarm_schemas.Alarm.model_validate(alarm)
+    alarm.is_active = alarm_update.is_active
+    db.execute(update(models.Alarm).where(models.Alarm.id == alarm.id).values(is_active=alarm.is_active))
+    db.commit()
+    alarm_job_crud.get_alarm_job_by_alarm_id(db, alarm.id)
+    db.execute(update(models.AlarmJob).where(models.AlarmJob.alarm_id == alarm.id).values(sms_job_id=None))
+    db.commit()
+    return alarm
+
+FLOWS = {
+    'legacy': (legacy_create_alarm, legacy_update_alarm),
+    'single_transaction': (alarm_crud.create_alarm, alarm_crud.update_alarm),
+}
+
+def run(flow: str, user: user_schemas.User, alarms: int, concurrency: int) -> dict:
+    create_alarm, update_alarm = FLOWS[flow]
+    alarm_create = alarm_schemas.AlarmCreate(
+        username=BENCHMARK_USERNAME, message='Benchmark alarm', time=dt_time(7, 0), days_of_week=[0, 1, 2, 3, 4], is_active=False
+    )
+    alarm_update = alarm_schemas.AlarmUpdate(is_active=False)
+
+    def create(_):
+        db = SessionLocal()
+        try:
+            return create_alarm(db, alarm_create, user)
+        finally:
+            db.close()
+
+    def modify(alarm):
+        db = SessionLocal()
+        try:
+            return update_alarm(db, alarm, alarm_update, lambda db, user_id: user)
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        round_trips[0] = 0
+        start = time.perf_counter()
+        created = list(executor.map(create, range(alarms)))
+        create_seconds = time.perf_counter() - start
+        create_round_trips = round_trips[0]
+
+        round_trips[0] = 0
+        start = time.perf_counter()
+        list(executor.map(modify, created))
+        update_seconds = time.perf_counter() - start
+        update_round_trips = round_trips[0]
+
+    cleanup(user)
+    return {
+        'flow': flow,
+        'alarms': alarms,
+        'concurrency': concurrency,
+        'creates_per_second': round(alarms / create_seconds, 1),
+        'round_trips_per_create': round(create_round_trips / alarms, 2),
+        'updates_per_second': round(alarms / update_seconds, 1),
+        'round_trips_per_update': round(update_round_trips / alarms, 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alarms', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--flow', nargs='+', choices=list(FLOWS), default=list(FLOWS))
+    args = parser.parse_args()
+
+    # Statement logging would dominate the measurement, scheduler calls are the same for both flows
+    engine.echo = False
+    alarm_crud.schedule_alarm = lambda alarm, phone_number: None
+    alarm_crud.unschedule_alarm = lambda job_id: None
+
+    user = get_benchmark_user()
+    cleanup(user)
+    for concurrency in args.concurrency:
+        for flow in args.flow:
+            print(run(flow, user, args.alarms, concurrency))
+
+if __name__ == '__main__':
+    main()
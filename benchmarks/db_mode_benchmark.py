@@ -0,0 +1,96 @@
+"""Compare requests/sec and p99 latency of the sync and async database modes
+
+Start the API twice against the same local Postgres, once per mode:
+    DATABASE_ASYNC=false uvicorn app.main:app --port 8001
+    DATABASE_ASYNC=true uvicorn app.main:app --port 8002
+
+Then seed a user with alarms and run the benchmark against both:
+    python -m benchmarks.db_mode_benchmark --seed --alarms 50 \\
+        --target sync=http://localhost:8001 --target async=http://localhost:8002
+"""
+import argparse
+import asyncio
+import time
+from datetime import time as dt_time
+from typing import List
+import httpx
+from sqlalchemy import insert, select
+from app.db import models
+from app.db.database import SessionLocal
+
+BENCHMARK_USERNAME = 'benchmark_user'
+
+# Insert the benchmark user and its alarms directly, bypassing Pinpoint
+def seed(alarms: int) -> None:
+    db = SessionLocal()
+    try:
+        user_id = db.execute(select(models.User.id).filter(models.User.username == BENCHMARK_USERNAME)).scalar()
+        if user_id is None:
+            user_id = db.execute(
+                insert(models.User)
+                .values(username=BENCHMARK_USERNAME, phone_number='+15555550100', aws_phone_number_id='benchmark')
+                .returning(models.User.id)
+            ).scalar()
+        db.execute(insert(models.Alarm), [
+            {'user_id': user_id, 'message': f"Benchmark alarm {i}", 'time': dt_time(7, i % 60), 'days_of_week': [0, 1, 2, 3, 4], 'is_active': False}
+            for i in range(alarms)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+def percentile(latencies: List[float], p: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+async def run(base_url: str, path: str, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'path': path,
+        'requests': requests,
+        'concurrency': concurrency,
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'errors': errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', action='append', required=True, help='name=base_url, can be repeated')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--seed', action='store_true', help='Insert the benchmark user and alarms first')
+    parser.add_argument('--alarms', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.alarms)
+
+    paths = [f"/users/{BENCHMARK_USERNAME}", f"/alarms/user/{BENCHMARK_USERNAME}"]
+    for target in args.target:
+        name, base_url = target.split('=', 1)
+        for path in paths:
+            for concurrency in args.concurrency:
+                print({'mode': name, **asyncio.run(run(base_url, path, args.requests, concurrency))})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""Benchmark how late alarms fire, end to end, against in-process AWS fakes
+
+Seeds alarms with realistic time clustering (by default half of them on the
+:00 and :30 marks of an hour), runs a scheduler over them and sends every fired
+alarm through the dispatch pool and send_pinpoint_sms_notification, with fake
+Pinpoint and DynamoDB clients. Reports fire lag percentiles (from the scheduled
+second to the completed send), sends/sec and memory use.
+
+The timing wheel can run on an accelerated simulated clock, APScheduler always
+runs in real time. No database is needed.
+
+Usage:
+    # Ten minutes of real time, alarms clustered on :00 and :30 seconds
+    python -m benchmarks.fire_latency_benchmark --scheduler timing_wheel apscheduler \\
+        --alarms 20000 --duration 600 --cluster-every 30
+
+    # A full simulated week in about a minute
+    python -m benchmarks.fire_latency_benchmark --alarms 100000 --duration 604800 --speed 10080 --latency-ms 0
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List
+import pytz
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from app.config import settings
+from app.schemas import alarm_schemas
+from app.utils import aws_utils
+from app.utils.alarm_payloads import AlarmPayloadCache, build_event
+from app.utils.fake_pinpoint import FakePinpointSmsClient
+from app.utils.logger import logger
+from app.utils.notification_log import NotificationLogBuffer
+from app.utils.scheduler import JOB_DEFAULTS, build_trigger, get_job_id
+from app.utils.sms_dispatcher import SmsDispatcher
+from app.utils.timing_wheel import TimingWheel
+
+# Clock running `speed` times faster than real time from `start`
+class SimulatedClock:
+    def __init__(self, start: float, speed: float = 1.0):
+        self.start = start
+        self.speed = speed
+        self._wall_start = time.perf_counter()
+
+    def __call__(self) -> float:
+        return self.start + (time.perf_counter() - self._wall_start) * self.speed
+
+    # Restart from `start`, so time spent loading the scheduler isn't part of the run
+    def restart(self) -> None:
+        self._wall_start = time.perf_counter()
+
+    # perf_counter value at which the clock reads `simulated_time`
+    def wall_time(self, simulated_time: float) -> float:
+        return self._wall_start + (simulated_time - self.start) / self.speed
+
+# DynamoDB Table stand-in, keeps the written items in memory
+class FakeDynamoDbTable:
+    def __init__(self, latency_ms: float = 0):
+        self._latency = latency_ms / 1000
+        self.items: List[dict] = []
+
+    @contextmanager
+    def batch_writer(self):
+        yield self
+        if self._latency:
+            time.sleep(self._latency)
+
+    def put_item(self, Item: dict) -> None:
+        self.items.append(Item)
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+# Create alarms firing within [start, start + duration)
+# `cluster_fraction` of them land on multiples of `cluster_every` seconds, the rest anywhere.
+# Every alarm fires on the weekday it was drawn for, and on each other day with 50% chance.
+def seed(alarms: int, users: int, start: float, duration: int, cluster_fraction: float, cluster_every: int, timezone, rng: random.Random) -> List[alarm_schemas.Alarm]:
+    seeded = []
+    for alarm_id in range(1, alarms + 1):
+        fire_at = start + 1 + rng.randrange(max(duration - 1, 1))
+        if rng.random() < cluster_fraction:
+            fire_at = fire_at - fire_at % cluster_every + cluster_every
+        local = datetime.fromtimestamp(int(fire_at), timezone)
+        days = {local.weekday()} | {day for day in range(7) if rng.random() < 0.5}
+        seeded.append(alarm_schemas.Alarm(
+            id=alarm_id,
+            user_id=alarm_id % users + 1,
+            message=f"Benchmark alarm {alarm_id}",
+            time=local.time(),
+            days_of_week=sorted(days),
+            is_active=True
+        ))
+    return seeded
+
+# Epoch second of the latest occurrence of `alarm_time` at or before `now`
+def last_occurrence(alarm_time, now: float, timezone) -> int:
+    local_now = datetime.fromtimestamp(now, timezone)
+    occurrence = timezone.localize(datetime.combine(local_now.date(), alarm_time))
+    if occurrence.timestamp() > now + 1:
+        occurrence -= timedelta(days=1)
+    return int(occurrence.timestamp())
+
+def run(scheduler_name: str, alarms: int, users: int, duration: int, speed: float, latency_ms: float,
+        workers: int, cluster_fraction: float, cluster_every: int, lead_seconds: float, seed_value: int) -> dict:
+    if scheduler_name == 'apscheduler' and speed != 1:
+        raise ValueError('APScheduler only runs in real time, use --speed 1')
+    timezone = pytz.timezone(settings.timezone)
+
+    # Fakes behind the real send path
+    aws_utils.pinpoint_sms_send = FakePinpointSmsClient(latency_ms=latency_ms)
+    table = FakeDynamoDbTable()
+    aws_utils.notification_log_buffer = NotificationLogBuffer(
+        table=table,
+        spill_path=os.path.join(tempfile.gettempdir(), 'fire_latency_benchmark_spill.jsonl')
+    )
+
+    lags: List[float] = []
+    clock = SimulatedClock(start=time.time(), speed=speed)
+
+    def send(event: dict) -> None:
+        aws_utils.send_pinpoint_sms_notification(event)
+        lags.append((time.perf_counter() - clock.wall_time(event['scheduled_time'])) * 1000)
+
+    dispatcher = SmsDispatcher(send_func=send, workers=workers, queue_size=settings.sms_dispatch_queue_size)
+
+    # Seed and load the scheduler, memory is traced for this phase only
+    tracemalloc.start()
+    # APScheduler follows the real clock, so its window opens after a lead time covering the load
+    window_start = clock.start + (lead_seconds if scheduler_name == 'apscheduler' else 0)
+    seeded = seed(alarms, users, window_start, duration, cluster_fraction, cluster_every, timezone, random.Random(seed_value))
+    events: Dict[int, dict] = {alarm.id: build_event(alarm, f"+1555{alarm.user_id:07d}") for alarm in seeded}
+    payloads = AlarmPayloadCache(loader=lambda alarm_ids: {i: events[i] for i in alarm_ids if i in events}, max_size=alarms)
+    load_start = time.perf_counter()
+
+    if scheduler_name == 'timing_wheel':
+        def fire_bucket(scheduled_time: int, alarm_ids: List[int]):
+            bucket = payloads.get_many(alarm_ids)
+            for alarm_id in alarm_ids:
+                dispatcher.submit({**bucket[alarm_id], 'scheduled_time': scheduled_time})
+
+        scheduler = TimingWheel(
+            fire_bucket=fire_bucket,
+            timezone=settings.timezone,
+            clock=clock,
+            misfire_grace_seconds=max(60, int(speed * 2))
+        )
+        for alarm in seeded:
+            scheduler.add(alarm.id, alarm.days_of_week, alarm.time)
+    else:
+        def fire_alarm(alarm_id: int):
+            event = payloads.get(alarm_id)
+            dispatcher.submit({**event, 'scheduled_time': last_occurrence(event['time'], clock(), timezone)})
+
+        scheduler = BackgroundScheduler(jobstores={'default': MemoryJobStore()}, job_defaults=JOB_DEFAULTS, timezone=timezone)
+        for alarm in seeded:
+            scheduler.add_job(func=fire_alarm, args=[alarm.id], trigger=build_trigger(alarm), id=get_job_id(alarm.id))
+
+    load_seconds = time.perf_counter() - load_start
+    traced_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Run until the simulated window has passed
+    aws_utils.notification_log_buffer.start()
+    dispatcher.start()
+    end = window_start + duration
+    if scheduler_name == 'timing_wheel':
+        clock.restart()
+        wall_start = time.perf_counter()
+        while clock() < end:
+            scheduler.tick()
+            time.sleep(min(1.0, max(0.001, (1.0 - clock() % 1.0) / speed)))
+        scheduler.tick(end)
+    else:
+        scheduler.start()
+        time.sleep(max(0.0, window_start - clock()))
+        wall_start = time.perf_counter()
+        time.sleep(max(0.0, end - clock()))
+        scheduler.shutdown()
+    dispatcher.join()
+    wall_seconds = time.perf_counter() - wall_start
+    stats = dispatcher.stats()
+    dispatcher.shutdown()
+    aws_utils.notification_log_buffer.shutdown()
+
+    return {
+        'scheduler': scheduler_name,
+        'alarms': alarms,
+        'simulated_seconds': duration,
+        'wall_seconds': round(wall_seconds, 2),
+        'load_seconds': round(load_seconds, 2),
+        'sent': stats['sent'],
+        'dropped': stats['dropped'],
+        'failed': stats['failed'],
+        'logged': len(table.items),
+        'sends_per_second': round(stats['sent'] / wall_seconds, 1),
+        'max_queue_depth': stats['max_queue_depth'],
+        'lag_p50_ms': round(percentile(lags, 0.50), 2),
+        'lag_p95_ms': round(percentile(lags, 0.95), 2),
+        'lag_p99_ms': round(percentile(lags, 0.99), 2),
+        'lag_max_ms': round(max(lags, default=0.0), 2),
+        'loaded_mib': round(traced_bytes / 2**20, 1),
+        'max_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scheduler', nargs='+', choices=['timing_wheel', 'apscheduler'], default=['timing_wheel'])
+    parser.add_argument('--alarms', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=int, default=120, help='Simulated seconds to run for')
+    parser.add_argument('--speed', type=float, default=1.0, help='Simulated seconds per real second (timing wheel only)')
+    parser.add_argument('--latency-ms', type=float, default=settings.fake_pinpoint_latency_ms)
+    parser.add_argument('--workers', type=int, default=settings.sms_dispatch_workers)
+    parser.add_argument('--cluster-fraction', type=float, default=0.5, help='Share of alarms on the cluster marks')
+    parser.add_argument('--cluster-every', type=int, default=1800, help='Seconds between cluster marks, 1800 for :00 and :30')
+    parser.add_argument('--lead-seconds', type=float, default=5, help='Real seconds before the APScheduler window opens')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # Per-send logs would dominate the measurement
+    logger.setLevel(logging.WARNING)
+
+    for scheduler_name in args.scheduler:
+        print(run(
+            scheduler_name, args.alarms, args.users, args.duration, args.speed, args.latency_ms,
+            args.workers, args.cluster_fraction, args.cluster_every, args.lead_seconds, args.seed
+        ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Measure the import time of the API module, as paid on every cold start
+
+Imports the module in fresh interpreters with `-X importtime` and reports the
+median and minimum import time, and the top-level packages that cost the most
+in the median run. Run it with the same environment as the API (a .env file
+works), no database or AWS access is needed.
+
+Usage:
+    python -m benchmarks.import_time_benchmark --runs 10
+    NOTIFICATION_TRANSPORT=noop python -m benchmarks.import_time_benchmark --module app.main --top 15
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+# Cumulative import time in microseconds of every module imported, from `-X importtime` output
+def import_times(module: str) -> Dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def run(module: str, runs: int) -> Tuple[list, Dict[str, int]]:
+    samples = []
+    for _ in range(runs):
+        times = import_times(module)
+        samples.append((times[module], times))
+    samples.sort(key=lambda sample: sample[0])
+    return [total for total, _ in samples], samples[len(samples) // 2][1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='app.main')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='Top-level packages to list by import time')
+    args = parser.parse_args()
+
+    totals, median_times = run(args.module, args.runs)
+    print({
+        'module': args.module,
+        'runs': args.runs,
+        'median_ms': round(statistics.median(totals) / 1000, 1),
+        'min_ms': round(totals[0] / 1000, 1),
+    })
+    packages = sorted(
+        ((name, time) for name, time in median_times.items() if '.' not in name and name != args.module),
+        key=lambda item: item[1],
+        reverse=True
+    )
+    for name, time in packages[:args.top]:
+        print({'package': name, 'ms': round(time / 1000, 1)})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Check that the alarm queries are planned as index scans on a seeded local Postgres
+
+Seeds users with alarms spread over the day and week, runs ANALYZE, then
+EXPLAINs the queries behind alarm listing, user cascades, the database
+scheduler's due alarm claims and alarm job lookups. Exits with status 1 if a
+query isn't served by the index it is expected to use, so it can run as a
+regression check after schema changes.
+
+Usage:
+    alembic upgrade head
+    python -m benchmarks.query_plan_check --seed --users 2000 --alarms-per-user 50
+    python -m benchmarks.query_plan_check --cleanup
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, time as dt_time, timedelta
+import pytz
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import delete, insert, select, text
+from app.crud.alarm_crud import alarms_by_user_query
+from app.db import models
+from app.db.database import engine
+from app.utils.db_scheduler import claim_due_alarms_query
+
+USERNAME_PREFIX = 'plan_check_'
+INSERT_CHUNK_SIZE = 5000
+
+# Insert `users` users with `alarms_per_user` alarms each, 80% of them active
+# Active alarms get a next fire time within the coming week, as the database scheduler sets it.
+def seed(users: int, alarms_per_user: int, rng: random.Random) -> None:
+    now = datetime.now(pytz.utc)
+    with engine.begin() as connection:
+        user_ids = connection.execute(
+            insert(models.User).returning(models.User.id),
+            [
+                {'username': f"{USERNAME_PREFIX}{i}", 'phone_number': f"+1666{i:07d}", 'aws_phone_number_id': 'plan_check'}
+                for i in range(users)
+            ]
+        ).scalars().all()
+        rows = []
+        for user_id in user_ids:
+            for _ in range(alarms_per_user):
+                is_active = rng.random() < 0.8
+                rows.append({
+                    'user_id': user_id,
+                    'message': 'Plan check alarm',
+                    'time': dt_time(rng.randrange(24), rng.randrange(60)),
+                    'days_of_week': sorted(rng.sample(range(7), rng.randint(1, 7))),
+                    'is_active': is_active,
+                    'next_fire_at': now + timedelta(minutes=rng.randrange(1, 7 * 24 * 60)) if is_active else None
+                })
+        for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+            connection.execute(insert(models.Alarm), rows[start:start + INSERT_CHUNK_SIZE])
+        connection.execute(text('ANALYZE users'))
+        connection.execute(text('ANALYZE alarms'))
+
+def cleanup() -> None:
+    with engine.begin() as connection:
+        connection.execute(delete(models.User).where(models.User.username.like(f"{USERNAME_PREFIX}%")))
+
+# (node type, relation, index) of every node of an EXPLAIN (FORMAT JSON) plan
+def plan_nodes(plan: dict) -> Iterator[Tuple[str, str, str]]:
+    yield plan['Node Type'], plan.get('Relation Name', ''), plan.get('Index Name', '')
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+def explain(connection, query) -> List[Tuple[str, str, str]]:
+    compiled = query.compile(dialect=engine.dialect)
+    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    return list(plan_nodes(plan[0]['Plan']))
+
+# Checked queries as (name, query, table, index that must be scanned)
+# None accepts any index on the table.
+def checks(connection) -> List[Tuple[str, object, str, Optional[str]]]:
+    user_id = connection.execute(
+        select(models.User.id).where(models.User.username.like(f"{USERNAME_PREFIX}%")).order_by(models.User.id).limit(1)
+    ).scalar()
+    if user_id is None:
+        raise SystemExit('No seeded users, run with --seed first')
+    alarm_id = connection.execute(select(models.Alarm.id).where(models.Alarm.user_id == user_id).limit(1)).scalar()
+    return [
+        ('alarms of user, first page', alarms_by_user_query(user_id, limit=100), 'alarms', 'ix_alarms_user_id_id'),
+        ('alarms of user, keyset page', alarms_by_user_query(user_id, after_id=alarm_id, limit=100), 'alarms', 'ix_alarms_user_id_id'),
+        ('alarms of user, cascade', select(models.Alarm.id).where(models.Alarm.user_id == user_id), 'alarms', 'ix_alarms_user_id_id'),
+        ('due alarms claimed by the database scheduler', claim_due_alarms_query(datetime.now(pytz.utc), 500), 'alarms', 'ix_alarms_next_fire_at'),
+        ('alarm job of alarm', select(models.AlarmJob).where(models.AlarmJob.alarm_id == alarm_id), 'alarm_jobs', None),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', action='store_true', help='Insert the plan check users and alarms first')
+    parser.add_argument('--cleanup', action='store_true', help='Delete the plan check users and their alarms, then exit')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--alarms-per-user', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.cleanup:
+        cleanup()
+        return
+    if args.seed:
+        seed(args.users, args.alarms_per_user, random.Random(42))
+
+    failed = 0
+    with engine.connect() as connection:
+        for name, query, table, index in checks(connection):
+            nodes = explain(connection, query)
+            scanned = {scanned_index for _, relation, scanned_index in nodes if relation == table and scanned_index}
+            ok = index in scanned if index else bool(scanned)
+            failed += not ok
+            print({'query': name, 'ok': ok, 'nodes': [node_type for node_type, _, _ in nodes], 'indexes': sorted(scanned)})
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compare response serialization of the hot user and alarm routes, before and after the lean path
+
+For each route, the response content is built and serialized the way the route
+used to (ORM objects or cached schemas validated again against the route's
+response_model, then rendered with the standard json module) and the way it
+does now (single schemas built with the trusted `from_db` constructors and
+serialized once by pydantic-core, alarm lists serialized from the rows by
+orjson). Runs offline, the database is not touched.
+
+Usage:
+    python -m benchmarks.serialization_benchmark --alarms 1 100 1000 10000
+"""
+import argparse
+import asyncio
+import time
+from collections import namedtuple
+from datetime import time as dt_time
+from typing import Callable, List
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import APIRoute, serialize_response
+from app.db import models
+from app.main import app
+from app.schemas import alarm_schemas, user_schemas
+from app.utils.responses import schema_response, user_adapter, alarm_adapter
+
+def route_field(path: str, method: str):
+    for route in app.routes:
+        if isinstance(route, APIRoute) and route.path == path and method in route.methods:
+            return route.response_field
+    raise SystemExit(f"No route {method} {path}")
+
+# Alarms as the ORM returns them, not attached to a session
+def orm_alarms(count: int) -> List[models.Alarm]:
+    return [
+        models.Alarm(id=i, user_id=1, message=f"Alarm {i}", time=dt_time(i % 24, i % 60), days_of_week=[0, 2, 4], is_active=True)
+        for i in range(count)
+    ]
+
+# The same alarms as rows of alarm_rows_by_user_query, named tuples stand in for result rows
+AlarmRow = namedtuple('AlarmRow', ['message', 'time', 'days_of_week', 'is_active', 'id', 'user_id'])
+
+def alarm_rows(count: int) -> List[AlarmRow]:
+    return [AlarmRow(alarm.message, alarm.time, alarm.days_of_week, alarm.is_active, alarm.id, alarm.user_id) for alarm in orm_alarms(count)]
+
+async def legacy(field, build: Callable[[], object]) -> bytes:
+    content = await serialize_response(field=field, response_content=build(), is_coroutine=True)
+    return JSONResponse(content).body
+
+async def measure(func: Callable, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = func()
+        if asyncio.iscoroutine(result):
+            await result
+    return (time.perf_counter() - start) / iterations
+
+async def main_async(alarm_counts: List[int], budget_seconds: float):
+    db_user = models.User(id=1, username='benchmark', phone_number='+14155552671', aws_phone_number_id='benchmark', version=1)
+    cached_user = user_schemas.User.model_validate(db_user)
+    alarms_1 = orm_alarms(1)
+    cases = [
+        (
+            'GET /users/{username}',
+            lambda: legacy(route_field('/users/{username}', 'GET'), lambda: cached_user),
+            lambda: schema_response(user_adapter, cached_user).body,
+        ),
+        (
+            'POST /alarms/',
+            lambda: legacy(route_field('/alarms/', 'POST'), lambda: alarm_schemas.Alarm.model_validate(alarms_1[0])),
+            lambda: schema_response(alarm_adapter, alarm_schemas.Alarm.from_db(alarms_1[0])).body,
+        ),
+    ]
+    list_field = route_field('/alarms/user/{username}', 'GET')
+    for count in alarm_counts:
+        alarms, rows = orm_alarms(count), alarm_rows(count)
+        cases.append((
+            f"GET /alarms/user/{{username}} ({count} alarms)",
+            lambda alarms=alarms: legacy(list_field, lambda: alarms),
+            lambda rows=rows: ORJSONResponse([row._asdict() for row in rows]).body,
+        ))
+
+    for name, before, after in cases:
+        # Size the iterations from a first call so every case runs for about the budget
+        once = await measure(before, 1)
+        iterations = max(1, int(budget_seconds / max(once, 1e-6)))
+        before_seconds = await measure(before, iterations)
+        after_seconds = await measure(after, iterations)
+        print({
+            'route': name,
+            'iterations': iterations,
+            'before_us': round(before_seconds * 1e6, 1),
+            'after_us': round(after_seconds * 1e6, 1),
+            'speedup': round(before_seconds / after_seconds, 2),
+        })
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alarms', type=int, nargs='+', default=[1, 100, 1000, 10000])
+    parser.add_argument('--seconds', type=float, default=1.0, help='Time spent per route and path')
+    args = parser.parse_args()
+    asyncio.run(main_async(args.alarms, args.seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark SMS dispatch throughput offline against the fake Pinpoint client
+
+Simulates a burst of alarms firing in the same second and measures how long
+the dispatch worker pool takes to drain it for several pool sizes. With
+--max-tps the fake client throttles like Pinpoint does, and --rate-limit sets
+the dispatcher's token bucket (0 to send unlimited and see the throttling).
+
+Usage:
+    PINPOINT_BACKEND=fake python -m benchmarks.sms_dispatch_benchmark --events 5000 --workers 8 32 64
+    PINPOINT_BACKEND=fake python -m benchmarks.sms_dispatch_benchmark --events 2000 --max-tps 100 --rate-limit 0 150
+"""
+import argparse
+import time
+from app.config import settings
+from app.utils.fake_pinpoint import FakePinpointSmsClient
+from app.utils.rate_limiter import AdaptiveTokenBucket
+from app.utils.sms_dispatcher import SmsDispatcher
+
+def run(events: int, workers: int, latency_ms: float, max_tps: float, rate_limit: float) -> dict:
+    client = FakePinpointSmsClient(latency_ms=latency_ms, max_tps=max_tps)
+
+    def send(event: dict) -> None:
+        client.send_text_message(
+            DestinationPhoneNumber=event['phone_number'],
+            OriginationIdentity=settings.end_user_messaging_sender_id_arn,
+            MessageBody=event['message'],
+            MessageType='TRANSACTIONAL'
+        )
+
+    rate_limiter = AdaptiveTokenBucket(
+        rate_per_second=rate_limit,
+        burst=settings.sms_rate_limit_burst,
+        min_rate_per_second=settings.sms_rate_limit_min_per_second,
+        recovery_per_second=settings.sms_rate_limit_recovery_per_second
+    )
+    dispatcher = SmsDispatcher(
+        send_func=send,
+        workers=workers,
+        queue_size=events,
+        rate_limiter=rate_limiter,
+        max_throttle_retries=settings.sms_throttle_max_retries
+    )
+    dispatcher.start()
+    start = time.perf_counter()
+    for i in range(events):
+        dispatcher.submit({'id': i, 'phone_number': '+15555550100', 'message': f"Alarm {i}"})
+    dispatcher.join()
+    elapsed = time.perf_counter() - start
+    stats = dispatcher.stats()
+    dispatcher.shutdown()
+
+    return {
+        'workers': workers,
+        'rate_limit': rate_limit,
+        'events': events,
+        'seconds': round(elapsed, 3),
+        'sends_per_second': round(stats['sent'] / elapsed, 1),
+        'max_queue_depth': stats['max_queue_depth'],
+        'failed': stats['failed'],
+        'throttled': stats['throttled'],
+        'deferred': stats['deferred'],
+        'final_rate': stats['rate_limit_per_second'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[10, 32, 64])
+    parser.add_argument('--latency-ms', type=float, default=settings.fake_pinpoint_latency_ms)
+    parser.add_argument('--max-tps', type=float, default=0, help='Sends per second the fake client accepts, 0 for no limit')
+    parser.add_argument('--rate-limit', type=float, nargs='+', default=[0], help='Token bucket rates to compare, 0 for no limit')
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        for rate_limit in args.rate_limit:
+            print(run(args.events, workers, args.latency_ms, args.max_tps, rate_limit))
+
+if __name__ == '__main__':
+    main()